@@ -6,6 +6,12 @@
 #
 
 import sys
+import re
+
+
+# Characters that matter when scanning outside of, and inside of, a quoted string.
+_specialChars = re.compile(r"['.;:]")
+_quoteChars = re.compile(r"['\\]")
 
 
 class ChunkError(Exception):
@@ -37,6 +43,7 @@ class Chunker:
     def __init__(self, line, semicolonComments=False):
         self.line = line
         self.semicolonComments = semicolonComments
+        self.pos = 0        # Scan position within the line
         self.chunks = []
 
         while True:
@@ -47,80 +54,76 @@ class Chunker:
                 self.chunks.append(chk)
 
     def _nextChunk(self):
-        t = ""
-        inQuote = False
-
-        while len(self.line) > 0:
-            c = self.line[0]
-            self.line = self.line[1:]
-
-            if inQuote:
-                # Only look for closing quote and escapes
-                if c == "'":
-                    inQuote = False
-                    t += c
-                elif c == "\\":
-                    # backslash
-                    if len(self.line) > 0:
-                        if self.line[0] == "\\":
-                            # Escaped backslash, leave alone and include second backslash
-                            t += c
-                            t += self.line[0]
-                            self.line = self.line[1:]
-                        elif self.line[0] == "'":
-                            # Escaped tick mark, leave alone
-                            t += c
-                            t += self.line[0]
-                            self.line = self.line[1:]
-                        else:
-                            # Maybe we should treat this as an error, but we don't?
-                            t += c
-                else:
-                    t += c
-                continue
+        line = self.line
+        start = self.pos
+        i = start
+
+        # The line is never copied while scanning, we just hop from one special character to the next
+        # and slice the chunk out once we know where it ends.
+        while True:
+            m = _specialChars.search(line, i)
+            if m is None:
+                end = len(line)
+                self.pos = end
+                break
 
-            if c == '.':
-                if len(self.line) > 0 and self.line[0] == '.':
+            i = m.start()
+            c = line[i]
+
+            if c == "'":
+                i = self._skipQuote(i + 1)
+            elif c == '.':
+                if line.startswith('.', i + 1):
                     # Two dots means comment, we are done parsing this line!
-                    self.line = ""
+                    end = i
+                    self.pos = len(line)
                     break
                 else:
-                    t += c
+                    i += 1
             elif c == ';':
+                end = i
                 if self.semicolonComments is True:
                     # In the alternate syntax, a semicolon is a comment character
-                    self.line = ""
-                    break
+                    self.pos = len(line)
                 else:
                     # Chunk delimiter
-                    break
-            elif c == ':':
-                # Chunk delimiter
+                    self.pos = i + 1
                 break
-            # elif c == ' ' or c == '\t':
-            #     # Space only matters if we are building a label
-            #     if self.firstColumn:
-            #         break;
-                # else:
-                #     t += c
-            elif c == "'":
-                t += c
-                inQuote = True
             else:
-                t += c
-
-        # All done with a token, or at least trying to generate a token.
-        # Do some error checks.
-        if inQuote:
-            raise NoClosingQuoteError()
+                # Colon, chunk delimiter
+                end = i
+                self.pos = i + 1
+                break
 
-        t = t.strip()    # Leading and trailing whitespace never signifigant
+        t = line[start:end].strip()    # Leading and trailing whitespace never signifigant
 
         if len(t) > 0:
             return t
         else:
             return None
 
+    # Skip over quoted text, starting just past the opening quote.
+    # Returns the position just past the closing quote.
+    def _skipQuote(self, i):
+        line = self.line
+
+        while True:
+            # Only look for closing quote and escapes
+            m = _quoteChars.search(line, i)
+            if m is None:
+                raise NoClosingQuoteError()
+
+            i = m.start()
+            if line[i] == "'":
+                return i + 1
+
+            # Backslash. An escaped backslash or tick mark is left alone, and anything
+            # else is just a backslash. (Maybe we should treat that as an error, but we don't?)
+            if line.startswith(('\\\\', "\\'"), i):
+                i += 2
+            else:
+                i += 1
+
 
 def chunkLine(line, sc=False):
     try:
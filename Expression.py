@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+# Expression
+#
+# Compiled expressions for my Cosmac 1802 Assembler.
+#
+# An expression is parsed once into a small tree of nodes, and the tree is kept in a cache
+# keyed by the expression text. Evaluating a tree only needs the current symbol table
+# and "here" address, which are provided by an environment object with these functions:
+#
+#   obtainTokenValue(token)  -> ( value, ebytes )
+#   buildBytes(value, numBytes) -> ebytes
+#   bailout(msg)
+#
+# and a trace attribute, the Trace.Tracers whose evaluator the evaluation is traced through.
+#
+
+import re
+import collections
+import threading
+
+import Parser
+
+
+# Numeric literals. Any other value token is a symbol, or "$" for the current address.
+HEX_LITERAL = re.compile(r'([0-9][0-9a-fA-F]*)H$')
+DEC_LITERAL = re.compile(r'([0-9]+)D?$')
+
+
+#
+# The node types follow the way the tokens are consumed when evaluating, which is
+# (for better or worse) right to left for binary operators:
+#
+#   A - B + C   ==>   A - (B + C)
+#
+# if accumValue is None:
+#             value - store it
+#             op - error
+#             unary - evalArg
+#             parens - evaluate the group
+#
+# if accumValue is set:
+#             value - error
+#             op - evaluate the rest of the expression
+#             unary - evalArg
+#             parens - error
+#
+# Each node's evalArg() returns a tuple of ( value, ebytes ), or ( None, None ) if a value
+# could not be obtained.
+#
+# Each node's addSymbols() adds the names of the symbols it references to a dict (used as an
+# ordered set).
+#
+
+
+def _finish(env, value, ebytes, maxBytes):
+    # recalculate the bytes
+    if value is not None:
+        ebytes = env.buildBytes(value, maxBytes)
+    return (value, ebytes)
+
+
+class Sequence:
+    """
+    A run of arguments, evaluated into a single value.
+
+    args - list of argument nodes
+    """
+
+    def __init__(self, args):
+        self.args = args
+
+    def evaluate(self, env, lineNumber, maxBytes):
+        accumValue = None
+        ebytes = None
+
+        for arg in self.args:
+            v, ebytes = arg.evalArg(env, lineNumber, accumValue, maxBytes)
+            if v is None:
+                break
+            accumValue = v
+            maxBytes = max(maxBytes, len(ebytes))
+
+        return _finish(env, accumValue, ebytes, maxBytes)
+
+    def addSymbols(self, names):
+        for arg in self.args:
+            arg.addSymbols(names)
+
+    # Returns a tuple of the names of the symbols referenced by the expression.
+    def symbols(self):
+        names = {}
+        self.addSymbols(names)
+        return tuple(names)
+
+    # Returns True if the expression is the low or high byte of an address (A.0, A.1, LOW, HIGH),
+    # with no other symbols after it, so its value is one byte whatever the symbols turn out to be.
+    def isAddressByte(self):
+        if not self.args or not isinstance(self.args[0], AddressByte):
+            return False
+        names = {}
+        for arg in self.args[1:]:
+            arg.addSymbols(names)
+        return not names
+
+
+class Group:
+    """
+    Parenthesized expression.
+    """
+
+    def __init__(self, text, sequence):
+        self.text = text
+        self.sequence = sequence
+
+    def evalArg(self, env, lineNumber, accumValue, maxBytes):
+        if accumValue is not None:
+            env.bailout("Line: %d   Expected operator but found parenthesized expression '%s'" % (lineNumber, self.text))
+
+        value, ebytes = self.sequence.evaluate(env, lineNumber, maxBytes)
+        if ebytes is not None:
+            maxBytes = max(maxBytes, len(ebytes))
+
+        return _finish(env, value, ebytes, maxBytes)
+
+    def addSymbols(self, names):
+        self.sequence.addSymbols(names)
+
+
+class AddressByte:
+    """
+    Unary operator - Low or high byte of an address. (A.0, A.1, LOW, HIGH)
+
+    text - the operator as written, for error messages
+    arg - the argument node, None if the expression ended
+    """
+
+    def __init__(self, text, lowByte, arg):
+        self.text = text
+        self.lowByte = lowByte
+        self.arg = arg
+
+    def evalArg(self, env, lineNumber, accumValue, maxBytes):
+        if self.arg is None:
+            env.bailout("Line: %d   Missing argument for %s" % (lineNumber, self.text))
+
+        v, ebytes = self.arg.evalArg(env, lineNumber, accumValue, maxBytes)
+        if v is None:
+            return (None, None)
+
+        if self.lowByte is True:
+            value = v & 0xFF
+        else:
+            value = (v >> 8) & 0xFF
+
+        return _finish(env, value, ebytes, 1)
+
+    def addSymbols(self, names):
+        if self.arg is not None:
+            self.arg.addSymbols(names)
+
+
+class BinaryOperator:
+    """
+    Binary operator, applied to the accumulated value and everything following the operator.
+    """
+
+    def __init__(self, op, rest):
+        self.op = op
+        self.rest = rest
+
+    def evalArg(self, env, lineNumber, accumValue, maxBytes):
+        if accumValue is None:
+            env.bailout("Line: %d   Found binary operator '%s' but expected value or unary operator" % (lineNumber, self.op))
+
+        v, ebytes = self.rest.evaluate(env, lineNumber, maxBytes)
+        if v is None:
+            env.bailout("Line: %d   Bad argument for operator '%s'" % (lineNumber, self.op))
+
+        env.trace.evaluator("Applying '%s' to %d and %d", self.op, accumValue, v)
+        if self.op == '+':
+            value = accumValue + v
+        elif self.op == '-':
+            value = accumValue - v
+        elif self.op == '*':
+            value = accumValue * v
+        else:
+            value = accumValue / v
+
+        return _finish(env, value, ebytes, max(maxBytes, len(ebytes)))
+
+    def addSymbols(self, names):
+        self.rest.addSymbols(names)
+
+
+class CharConstant:
+    """
+    A single quoted character, 'c'
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.value = ord(text[1])
+
+    def evalArg(self, env, lineNumber, accumValue, maxBytes):
+        if accumValue is not None:
+            env.bailout("Line: %d   Expected operator but found value '%s'" % (lineNumber, self.text))
+
+        return _finish(env, self.value, None, max(maxBytes, 1))
+
+    def addSymbols(self, names):
+        pass
+
+
+class Value:
+    """
+    Number, symbol, or the "here" address.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.isSymbol = text != "$" and HEX_LITERAL.match(text) is None and DEC_LITERAL.match(text) is None
+
+    def evalArg(self, env, lineNumber, accumValue, maxBytes):
+        if accumValue is not None:
+            env.bailout("Line: %d   Expected operator but found value '%s'" % (lineNumber, self.text))
+
+        value, ebytes = env.obtainTokenValue(self.text)
+        env.trace.evaluator("Token value is %s - %s", value, ebytes)
+        if value is None:
+            return (None, None)        # Could not obtain a value
+
+        return _finish(env, value, ebytes, max(maxBytes, len(ebytes)))
+
+    def addSymbols(self, names):
+        if self.isSymbol:
+            names[self.text] = None
+
+
+class SyntaxFault:
+    """
+    The rest of the expression could not be parsed.
+
+    The error is only raised if evaluation gets this far, which is the same point where
+    scanning the text would have hit it.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+    def evalArg(self, env, lineNumber, accumValue, maxBytes):
+        raise self.error
+
+    def addSymbols(self, names):
+        pass
+
+
+# ----------------------------------------------------------------
+# Compiling
+# ----------------------------------------------------------------
+
+def _compileSequence(parser, tokens, altSyntax):
+    args = []
+    while True:
+        arg = _compileArg(parser, tokens, altSyntax)
+        if arg is None:
+            break
+        args.append(arg)
+        if isinstance(arg, SyntaxFault):
+            break
+    return Sequence(args)
+
+
+def _compileArg(parser, tokens, altSyntax):
+    try:
+        tok = next(tokens, None)
+    except Parser.ParseError as err:
+        return SyntaxFault(err)
+
+    if tok is None:
+        return None
+
+    if tok.kind == Parser.GROUP:
+        return Group(tok.text, _compileSequence(parser, parser.tokens(tok.start, tok.end), altSyntax))
+
+    if tok.kind == Parser.OPERATOR:
+        return BinaryOperator(tok.text, _compileSequence(parser, tokens, altSyntax))
+
+    if tok.kind == Parser.SYMBOL:
+        if altSyntax is True:
+            ma = re.match(r'^(LOW|HIGH)$', tok.text, re.IGNORECASE)
+            if ma is not None:
+                return AddressByte(tok.text, tok.text.upper() == 'LOW', _compileArg(parser, tokens, altSyntax))
+        else:
+            ma = re.match(r'^A.([0-1])$', tok.text)
+            if ma is not None:
+                return AddressByte(tok.text, ma.group(1) == '0', _compileArg(parser, tokens, altSyntax))
+
+    if tok.kind == Parser.CHAR and re.fullmatch(r"'(.)'", tok.text):
+        return CharConstant(tok.text)
+
+    return Value(tok.text)
+
+
+class ExpressionCache:
+    """
+    Compiled expressions, keyed by the text and syntax. The least recently used entries
+    are dropped once the cache is full. The compiled trees are never modified, so one cache
+    is shared by every assembly in the process.
+
+    hits - number of lookups that found a compiled expression
+    misses - number of lookups that had to parse the text
+    """
+
+    def __init__(self, maxSize=4096):
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "%d expressions cached, %d hits, %d misses" % (len(self.entries), self.hits, self.misses)
+
+    def lookup(self, body, altSyntax):
+        key = (body, altSyntax)
+        with self.lock:
+            expr = self.entries.get(key)
+            if expr is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return expr
+
+            self.misses += 1
+            parser = Parser.Parser(body)
+            expr = _compileSequence(parser, parser.tokens(), altSyntax)
+            self.entries[key] = expr
+            if len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+            return expr
+
+    # Add expressions that were compiled before, keyed by their text, such as the ones kept in the
+    # token cache. These don't count as hits or misses.
+    def seed(self, expressions, altSyntax):
+        with self.lock:
+            for body, expr in expressions.items():
+                self.entries[(body, altSyntax)] = expr
+                self.entries.move_to_end((body, altSyntax))
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+
+cache = ExpressionCache()
+
+
+#
+# Returns the compiled form of the expression text, parsing it only if it isn't already cached.
+#
+def compileExpression(body, altSyntax=False):
+    return cache.lookup(body, altSyntax)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# ListingWriter
+#
+# Listing output for my Cosmac 1802 Assembler.
+#
+# The assembler hands the writer a compact record for each line of the listing, and the records are
+# only turned into text in batches, each written out with a single write:
+#
+#   0010 F8FF;         0012  START: LDI 0FFH
+#   0012 ;              0013
+#
+# Code longer than BYTES_PER_LINE carries on over as many lines as it needs.
+#
+# While the writer is held nothing is formatted. This is used in one-pass mode, where the bytes of
+# a line can still be patched after it has been listed.
+#
+
+
+BYTES_PER_LINE = 6
+
+
+class ListingWriter:
+    """
+    Buffered listing output.
+
+    dest - file the listing is written to
+    batchSize - number of records formatted and written at a time
+    held - True to keep all of the records until release() is called
+    records - the records waiting to be written, tuples of ( address, bytes, lineNumber, text ).
+              The bytes are None for a line with no code.
+    linesWritten - number of lines written so far
+    """
+
+    def __init__(self, dest, batchSize=4096):
+        self.dest = dest
+        self.batchSize = batchSize
+        self.held = False
+        self.records = []
+        self.linesWritten = 0
+
+    def __repr__(self):
+        return "%d records waiting%s" % (len(self.records), ", held" if self.held else "")
+
+    # A line that produced code. The bytes are not copied, so they must not change unless the
+    # writer is held.
+    def code(self, address, bytes, lineNumber, text):
+        self.records.append((address, bytes, lineNumber, text))
+        if len(self.records) >= self.batchSize and not self.held:
+            self.flush()
+
+    def noCode(self, address, lineNumber, text):
+        self.records.append((address, None, lineNumber, text))
+        if len(self.records) >= self.batchSize and not self.held:
+            self.flush()
+
+    def hold(self):
+        self.held = True
+
+    def release(self):
+        self.held = False
+        self.flush()
+
+    # Write text as it is, after the records before it.
+    def write(self, text):
+        self.flush()
+        self.dest.write(text)
+        self.linesWritten += text.count("\n")
+
+    def flush(self):
+        if self.records:
+            text = formatRecords(self.records)
+            self.dest.write(text)
+            self.linesWritten += text.count("\n")
+            self.records = []
+
+    # Write whatever can be written. Records that are still held are dropped, since their bytes
+    # were never completed.
+    def finish(self):
+        if not self.held:
+            self.flush()
+        self.records = []
+
+
+#
+# Returns the listing text for a list of records.
+#
+def formatRecords(records):
+    out = []
+    append = out.append
+    for address, bytes, lineNumber, text in records:
+        if bytes is None:
+            if text == "":
+                append("%04X ;              %04d\n" % (address, lineNumber))
+            else:
+                append("%04X ;              %04d  %s\n" % (address, lineNumber, text))
+        elif len(bytes) <= BYTES_PER_LINE:
+            if bytes:
+                append("%04X %-14s %04d  %s\n" % (address, bytes.hex().upper() + ";", lineNumber, text))
+        else:
+            hexStr = bytes.hex().upper()
+            append("%04X %-14s %04d  %s\n" % (address, hexStr[:BYTES_PER_LINE * 2] + ";", lineNumber, text))
+            for i in range(BYTES_PER_LINE, len(bytes), BYTES_PER_LINE):
+                append("%04X %s;\n" % (address + i, hexStr[i * 2:(i + BYTES_PER_LINE) * 2]))
+
+    return "".join(out)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# ObjectFile
+#
+# Relocatable object files for my Cosmac 1802 Assembler and its linker.
+#
+# A module assembled with --object is written as a JSON file holding:
+#
+#   sections - the code, in blocks. Code before the first ORG is relocatable, the linker decides
+#              where it goes, and its addresses are offsets from the start of the section. An ORG
+#              to an absolute address starts an absolute section, which stays where it is.
+#   labels - every label the module defines, as an offset into its section
+#   equates - the equates with a value that doesn't depend on where anything is placed
+#   expressions - the rest of the equates, which depend on relocatable or external symbols, as the
+#                 expression to resolve at link time
+#   fixups - each operand that couldn't be encoded until the module is placed: its kind (short and
+#            long branch, immediate, LOAD, DC, register), the expression, and where its bytes go.
+#
+# The fixups are encoded by the linker with the assembler's own operand functions, so the result is
+# exactly what assembling all of the modules as one source would produce.
+#
+
+import json
+
+
+FORMAT_VERSION = 1
+FORMAT_NAME = "cosmac-object"
+
+
+class ObjectFileError(Exception):
+    """Raised for a file that isn't an object file, or is from another version."""
+
+
+class Section:
+    """
+    A run of code that is placed as a unit.
+
+    origin - address of the start of the section. For a relocatable section this is 0 until the
+             linker places it.
+    relocatable - True if the linker decides where it goes
+    align - the section has to start on a multiple of this (256 if it uses PAGE)
+    blocks - list of ( offset, bytes ) of the code, offsets from the origin, in ascending order
+    """
+
+    def __init__(self, origin, relocatable, align=1):
+        self.origin = origin
+        self.relocatable = relocatable
+        self.align = align
+        self.blocks = []
+
+    def __repr__(self):
+        return "0x%04X  %d bytes%s" % (self.origin, self.size(), ", relocatable" if self.relocatable else "")
+
+    # Add code at an offset. Code straight after the last block is added on to it.
+    def add(self, offset, bytes):
+        if self.blocks:
+            lastOffset, last = self.blocks[-1]
+            if lastOffset + len(last) == offset:
+                last.extend(bytes)
+                return
+        self.blocks.append((offset, bytearray(bytes)))
+
+    # The number of bytes from the origin to the end of the last block.
+    def size(self):
+        if not self.blocks:
+            return 0
+        offset, data = self.blocks[-1]
+        return offset + len(data)
+
+
+class ObjectModule:
+    """
+    The contents of one object file.
+
+    source - name of the source file it was assembled from
+    sections - list of Section
+    labels - list of ( name, section, offset, lineNumber )
+    equates - list of ( name, value, bytes, lineNumber ) for the ones with a known value
+    expressions - list of ( name, body, lineNumber ) for the equates resolved at link time
+    fixups - list of ( kind, param, body, section, offset, width, originOffset, lineNumber ).
+             The bytes go at offset in the section, and originOffset is where the statement starts,
+             which is what "$" means in the expression.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sections = []
+        self.labels = []
+        self.equates = []
+        self.expressions = []
+        self.fixups = []
+
+    def __repr__(self):
+        return "%s: %d sections, %d symbols, %d fixups" % \
+            (self.source, len(self.sections), len(self.labels) + len(self.equates) + len(self.expressions), len(self.fixups))
+
+
+def writeObject(dest, module):
+    sections = [{"origin": s.origin, "relocatable": s.relocatable, "align": s.align,
+                 "blocks": [[offset, data.hex().upper()] for offset, data in s.blocks]} for s in module.sections]
+    doc = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "source": module.source,
+        "sections": sections,
+        "labels": module.labels,
+        "equates": [[name, value, data.hex().upper(), lineNumber] for name, value, data, lineNumber in module.equates],
+        "expressions": module.expressions,
+        "fixups": module.fixups
+    }
+    # One line for each entry of the lists, so the file can still be read.
+    out = []
+    for key, value in doc.items():
+        if isinstance(value, list):
+            items = ",\n  ".join(json.dumps(item) for item in value)
+            out.append(' "%s": [\n  %s\n ]' % (key, items) if value else ' "%s": []' % key)
+        else:
+            out.append(' "%s": %s' % (key, json.dumps(value)))
+    dest.write("{\n%s\n}\n" % ",\n".join(out))
+
+
+def readObject(src):
+    try:
+        doc = json.load(src)
+    except ValueError:
+        raise ObjectFileError("Not an object file")
+
+    if not isinstance(doc, dict) or doc.get("format") != FORMAT_NAME:
+        raise ObjectFileError("Not an object file")
+    if doc.get("version") != FORMAT_VERSION:
+        raise ObjectFileError("Unsupported object file version '%s'" % doc.get("version"))
+
+    try:
+        module = ObjectModule(doc["source"])
+        for s in doc["sections"]:
+            section = Section(s["origin"], s["relocatable"], s["align"])
+            section.blocks = [(offset, bytearray.fromhex(data)) for offset, data in s["blocks"]]
+            module.sections.append(section)
+        module.labels = [tuple(label) for label in doc["labels"]]
+        module.equates = [(name, value, bytes.fromhex(data), lineNumber) for name, value, data, lineNumber in doc["equates"]]
+        module.expressions = [tuple(e) for e in doc["expressions"]]
+        module.fixups = [tuple(f) for f in doc["fixups"]]
+    except (KeyError, TypeError, ValueError):
+        raise ObjectFileError("Damaged object file")
+
+    return module
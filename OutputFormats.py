@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# OutputFormats
+#
+# Program image output for my Cosmac 1802 Assembler.
+#
+#   hex - the image as hex digits, 16 bytes to a line, gaps padded with FF
+#   ihex - Intel hex records, 32 bytes to a record
+#   srec - Motorola S-records (S19, or S28 above 64K), 32 bytes to a record
+#   bin - the raw binary image, gaps padded with FF
+#
+# Every writer takes the open output file, the image as a list of ( address, data ) segments in
+# ascending order, and the address the image starts at (anything below it is left out of the hex
+# and binary images).
+#
+# The output is encoded a whole row or block at a time and written in chunks, so the complete image
+# is never built up as one string.
+#
+
+import binascii
+
+
+STREAM_CHUNK = 4096         # Bytes of the image encoded for each write (a multiple of the row sizes)
+RECORDS_PER_WRITE = 128     # Intel hex or S-records written at a time
+
+HEX_BYTES_PER_LINE = 16
+RECORD_BYTES = 32
+
+PADDING = 0xFF
+
+
+class OutputFormat:
+    """
+    One kind of output file.
+
+    name - the name used with --format
+    extension - added to the source's root name to make the output filename
+    writer - function(dest, segments, base) that writes the output
+    binary - True if the file has to be opened in binary mode
+    """
+
+    def __init__(self, name, extension, writer, binary=False):
+        self.name = name
+        self.extension = extension
+        self.writer = writer
+        self.binary = binary
+
+    def __repr__(self):
+        return "%s (%s)" % (self.name, self.extension)
+
+
+#
+# Yields the image from base up to its end in blocks of STREAM_CHUNK bytes (the last can be shorter),
+# with the gaps between segments padded.
+#
+def imageBlocks(segments, base):
+    buf = bytearray()
+    current = base
+
+    for address, data in segments:
+        end = address + len(data)
+        if end <= current:
+            continue        # Below the base
+        if address < current:
+            data = data[current - address:]
+            address = current
+
+        gap = address - current
+        while gap > 0:
+            n = min(gap, STREAM_CHUNK - len(buf))
+            buf.extend(bytes((PADDING,)) * n)
+            gap -= n
+            if len(buf) == STREAM_CHUNK:
+                yield bytes(buf)
+                buf.clear()
+
+        view = memoryview(data)
+        while len(view) > 0:
+            n = STREAM_CHUNK - len(buf)
+            buf.extend(view[:n])
+            view = view[n:]
+            if len(buf) == STREAM_CHUNK:
+                yield bytes(buf)
+                buf.clear()
+
+        current = end
+
+    if len(buf) > 0:
+        yield bytes(buf)
+
+
+def writeRawHex(dest, segments, base):
+    lineChars = HEX_BYTES_PER_LINE * 2
+    for block in imageBlocks(segments, base):
+        digits = binascii.hexlify(block).upper().decode('ascii')
+        text = "\n".join([digits[i:i + lineChars] for i in range(0, len(digits), lineChars)])
+        if len(block) % HEX_BYTES_PER_LINE == 0:
+            text += "\n"        # A full line always ends with a newline, a short last line doesn't.
+        dest.write(text)
+
+
+def writeBinary(dest, segments, base):
+    for block in imageBlocks(segments, base):
+        dest.write(block)
+
+
+#
+# Yields ( address, data ) for each record's worth of the segments. The records start at the
+# beginning of each segment.
+#
+def recordRows(segments):
+    for address, data in segments:
+        for offset in range(0, len(data), RECORD_BYTES):
+            yield (address + offset, data[offset:offset + RECORD_BYTES])
+
+
+def ihexRecord(kind, address, data):
+    total = len(data) + (address >> 8) + (address & 0xFF) + kind + sum(data)
+    return ":%02X%04X%02X%s%02X" % (len(data), address, kind, binascii.hexlify(data).upper().decode('ascii'), -total & 0xFF)
+
+
+def writeIntelHex(dest, segments, base):
+    records = []
+    upperAddress = 0
+
+    for address, data in recordRows(segments):
+        if address >> 16 > upperAddress:
+            # Extended linear address record, for anything past 64K
+            upperAddress = address >> 16
+            records.append(ihexRecord(4, 0, upperAddress.to_bytes(2, 'big')))
+
+        records.append(ihexRecord(0, address & 0xFFFF, data))
+        if len(records) >= RECORDS_PER_WRITE:
+            dest.write("\n".join(records) + "\n")
+            records = []
+
+    records.append(ihexRecord(1, 0, b''))
+    dest.write("\n".join(records) + "\n")
+
+
+def srecRecord(kind, address, addressBytes, data):
+    addr = address.to_bytes(addressBytes, 'big')
+    count = addressBytes + len(data) + 1
+    total = count + sum(addr) + sum(data)
+    return "S%s%02X%s%02X" % (kind, count, binascii.hexlify(addr + data).upper().decode('ascii'), ~total & 0xFF)
+
+
+def writeSRecords(dest, segments, base):
+    segments = list(segments)
+    end = max([address + len(data) for address, data in segments] or [0])
+    if end <= 0x10000:
+        dataKind, endKind, addressBytes = "1", "9", 2
+    else:
+        dataKind, endKind, addressBytes = "2", "8", 3
+
+    records = [srecRecord("0", 0, 2, b'')]
+    count = 0
+
+    for address, data in recordRows(segments):
+        records.append(srecRecord(dataKind, address, addressBytes, data))
+        count += 1
+        if len(records) >= RECORDS_PER_WRITE:
+            dest.write("\n".join(records) + "\n")
+            records = []
+
+    if count <= 0xFFFF:
+        records.append(srecRecord("5", count, 2, b''))
+    records.append(srecRecord(endKind, 0, addressBytes, b''))
+    dest.write("\n".join(records) + "\n")
+
+
+formats = {f.name: f for f in (
+    OutputFormat("hex", ".hex", writeRawHex),
+    OutputFormat("ihex", ".ihex", writeIntelHex),
+    OutputFormat("srec", ".srec", writeSRecords),
+    OutputFormat("bin", ".bin", writeBinary, binary=True)
+)}
+
+DEFAULT_FORMATS = ("hex", "ihex")
@@ -6,6 +6,8 @@
 #
 
 import sys
+import re
+import collections
 
 
 class ParseError(Exception):
@@ -28,156 +30,127 @@ class EmptyParenError(ParseError):
     pass
 
 
-# Break a line of text into an array of text delimited by whitespace, operators, etc.
+# Token kinds
+NUMBER = "number"
+SYMBOL = "symbol"
+OPERATOR = "operator"
+CHAR = "char"           # Quoted character(s), including the quotes
+GROUP = "group"         # Parenthesized expression, text is what is inside the parens
+
+
+# A single item from the line. The start and end are the column span of the text within the line.
+Token = collections.namedtuple("Token", "kind text start end")
+
+
+# A symbol or number runs until one of these characters.
+_word = re.compile(r"[^ \t,()'+\-*/]+")
+_space = re.compile(r"[ \t,]*")
+_quoteChars = re.compile(r"['\\]")
+
+
+# Break a line of text into a stream of tokens delimited by whitespace, operators, etc.
 #
+# The line is never modified, tokens are produced by walking a position through it.
 #
-# Parenthesized expressions are retained as a single item.
+# Parenthesized expressions are retained as a single item. The tokens inside of one are
+# obtained by calling tokens() again with the span of the group.
 #
 #   '(rats)'  -->  '(rats)'
 #   ('a'+'b') -->  'a'+'b'
 #
-# Returns ( token, parenthesized )
-#
-# token -
-# parenthesized -
-#
 class Parser:
     def __init__(self, line):
         self.line = line
-
-    def nextItem(self):
-        t = ""
-        parenLevel = 0
-        inQuote = False
-        parenthesized = False
-
-        while len(self.line) > 0:
-            c = self.line[0]
-            self.line = self.line[1:]
-
-            if parenLevel > 0:
-                # Only look for closing paren, another opening paren, or whitespace
-                if c == ')':
-                    parenLevel -= 1
-                    if parenLevel == 0:
-                        if len(t) > 0:
-                            break
-                        else:
-                            raise EmptyParenError()
-                    else:
-                        t += c
-                        continue
-                elif c == '(':
-                    parenLevel += 1
-                    t += c
-                    continue
-                elif c == ' ':
-                    if len(t) > 0:
-                        # trailing or internal whitespace, keep it
-                        t += c
-                    continue
-                else:
-                    t += c
-                    continue
-
-            if inQuote:
-                # Only look for closing quote or escape character
-                t += c
-                if c == "'":
-                    inQuote = False
-                    break
-                elif c == "\\":
-                    # backslash
-                    if len(self.line) > 0:
-                        if self.line[0] == "\\":
-                            # Escaped backslash, leave alone and include second backslash
-                            t += c
-                            t += self.line[0]
-                            self.line = self.line[1:]
-                        elif self.line[0] == "'":
-                            # Escaped tick mark, leave alone
-                            t += c
-                            t += self.line[0]
-                            self.line = self.line[1:]
-                        else:
-                            # Maybe we should treat this as an error, but we don't?
-                            t += c
-                else:
-                    continue
-
-            if c == " " or c == '\t':
-                if len(t) > 0:
-                    # trailing, we are done
-                    break
-                else:
-                    # leading, ignore it
-                    pass
-            # elif c == '.':
-            #     if len(self.line) > 0 and self.line[0] == '.':
-            #         # Two dots means comment
-            #         self.line = ""
-            #         break
-            # elif c == ';':
-            #     if self.semicolonComments == True:
-            #         # In the alternate syntax, a semicolon is a comment character
-            #         self.line = ""
-            #         break
-            #     else:
-            #         if len(t) > 0:
-            #             # Trailing, it is a delimiter. Leading we ignore it.
-            #             break
-            #         else:
-            #             pass
-            elif c == ',':
-                if len(t) > 0:
-                    # Trailing, it is a delimiter. Leading we ignore it.
-                    break
-                else:
-                    pass
-            elif c == '(':
-                if len(t) > 0:
-                    # Already accumulating an arg
-                    self.line = c + self.line      # pushback
-                    break
-                else:
-                    parenLevel = 1
-                    parenthesized = True
+        self._stream = None
+
+    # Generate the tokens found between start and end.
+    def tokens(self, start=0, end=None):
+        line = self.line
+        if end is None:
+            end = len(line)
+
+        i = _space.match(line, start, end).end()
+        while i < end:
+            c = line[i]
+
+            if c == '(':
+                tokStart, i = self._group(i + 1, end)
+                yield Token(GROUP, line[tokStart:i], tokStart, i)
+                i += 1
             elif c == ')':
                 raise MissingOpenParenError()
-                t += c
             elif c == "'":
-                if len(t) > 0:
-                    # Already accumulating an arg
-                    self.line = c + self.line      # pushback
-                    break
-                else:
-                    inQuote = True
-                    t += c
-            elif c == '+' or c == '-' or c == '*' or c == '/':
-                if len(t) > 0:
-                    self.line = c + self.line      # pushback
-                    break
-                else:
-                    t = c
-                    break
+                tokStart = i
+                i = self._quote(i + 1, end)
+                yield Token(CHAR, line[tokStart:i], tokStart, i)
+            elif c in "+-*/":
+                i += 1
+                yield Token(OPERATOR, c, i - 1, i)
             else:
-                t += c
+                m = _word.match(line, i, end)
+                tokStart, i = m.span()
+                if i < end and line[i] == ')':
+                    raise MissingOpenParenError()
+                text = m.group()
+                kind = NUMBER if text[0].isdigit() else SYMBOL
+                yield Token(kind, text, tokStart, i)
+
+            i = _space.match(line, i, end).end()
+
+    # Scan a parenthesized group, starting just past the open paren.
+    # Returns the span of the text inside the parens, with leading spaces dropped.
+    def _group(self, i, end):
+        line = self.line
+        while i < end and line[i] == ' ':
+            i += 1
+        start = i
+
+        parenLevel = 1
+        while i < end:
+            c = line[i]
+            if c == ')':
+                parenLevel -= 1
+                if parenLevel == 0:
+                    if i == start:
+                        raise EmptyParenError()
+                    return (start, i)
+            elif c == '(':
+                parenLevel += 1
+            i += 1
 
-        # All done with an argument, or at least trying to generate an argument.
-        # Do some error checks.
+        raise NoClosingParenError()
 
-        if inQuote:
-            raise NoClosingQuoteError()
+    # Scan a quoted string, starting just past the opening quote.
+    # Returns the position just past the closing quote.
+    def _quote(self, i, end):
+        line = self.line
+        while True:
+            # Only look for closing quote or escape character
+            m = _quoteChars.search(line, i, end)
+            if m is None:
+                raise NoClosingQuoteError()
+
+            i = m.start()
+            if line[i] == "'":
+                return i + 1
+
+            # Escaped backslash or tick mark, leave alone.
+            if line.startswith(('\\\\', "\\'"), i, end):
+                i += 2
+            else:
+                i += 1
 
-        if parenLevel > 0:
-            raise NoClosingParenError()
+    # Returns ( token, parenthesized ) for the next item, or ( None, None ) at the end of the line.
+    def nextItem(self):
+        if self._stream is None:
+            self._stream = self.tokens()
 
-        if len(t) > 0:
-            # print( "Parser next item:", t, parenthesized)
-            return (t, parenthesized)
-        else:
+        tok = next(self._stream, None)
+        if tok is None:
             return (None, None)
 
+        return (tok.text, tok.kind == GROUP)
+
 
 def parseLine(line):
     try:
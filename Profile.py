@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+# Profile
+#
+# Phase timing for my Cosmac 1802 Assembler (--profile).
+#
+# The Profiler is given to the Assembler as its phaseHook, and records the wall clock and CPU time
+# of each phase of the assembly. The steps of the output phase are reported under it:
+#
+#   Phase                   Wall ms     CPU ms
+#   pass1                     110.2      109.8
+#   resolve                     2.1        2.1
+#   pass2                      55.0       54.9
+#   output                     12.4       12.3
+#     listing                   6.0        6.0
+#     image                     2.2        2.2
+#     symbols                   4.1        4.1
+#   total                     179.7      179.1
+#
+# followed by the Assembler's counters (lines, chunks, calcExpression calls and so on). The same
+# report can be written as JSON, for charting the numbers from one build to the next.
+#
+# The MemoryProfiler (--memory) is a phaseHook too. It runs tracemalloc for the whole assembly, and
+# reports for each phase:
+#
+#   peak - the most memory traced at any point in the phase
+#   retained - how much more was traced at the end of the phase than at the start (negative if the
+#              phase freed more than it kept)
+#   sites - the lines of the assembler's own modules (cosmacasm.py, Chunker.py, Parser.py and so on)
+#           that allocated the most of what the phase retained
+#
+# The sites come from a tracemalloc snapshot at the start and end of each phase. Grouping a snapshot
+# by line takes seconds once there are a few hundred thousand blocks, so the steps of the output
+# phase only get the peak and retained bytes. What was allocated before the first phase (reading
+# the source, the imported symbols, the caches) is reported as "setup", and the sites holding the
+# most at the end are listed after the phases.
+#
+
+import json
+import linecache
+import os
+import time
+import tracemalloc
+
+
+SITE_COUNT = 5
+
+# The assembler's own modules are the ones in this directory, which the allocating sites are picked from.
+SITE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class Profiler:
+    """
+    phaseHook that times each phase of an assembly.
+
+    phases - [ name, depth, wall, cpu ] for each phase, in the order they started. The times are
+             in seconds, and None until the phase ends. Steps inside a phase have a greater depth.
+    stack - ( index into phases, wall start, cpu start ) of each phase that has started but not ended
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.stack = []
+
+    def __repr__(self):
+        return ", ".join("%s %.1f ms" % (name, wall * 1000) for name, __, wall, __ in self.phases if wall is not None)
+
+    def __call__(self, name, starting):
+        if starting:
+            self.phases.append([name, len(self.stack), None, None])
+            self.stack.append((len(self.phases) - 1, time.perf_counter(), time.process_time()))
+        else:
+            index, wallStart, cpuStart = self.stack.pop()
+            phase = self.phases[index]
+            phase[2] = time.perf_counter() - wallStart
+            phase[3] = time.process_time() - cpuStart
+
+    # Returns ( wall, cpu ), the sum of the phases that ended, not counting the steps inside them.
+    def total(self):
+        ended = [p for p in self.phases if p[1] == 0 and p[2] is not None]
+        return (sum(p[2] for p in ended), sum(p[3] for p in ended))
+
+    # Returns the report as a dict: the times of each phase, keyed by name (steps by "phase.step"),
+    # the total, and the counters.
+    def asDict(self, counters):
+        phases = {}
+        path = []
+        for name, depth, wall, cpu in self.phases:
+            del path[depth:]
+            path.append(name)
+            if wall is not None:
+                phases[".".join(path)] = {"wall": wall, "cpu": cpu}
+
+        wall, cpu = self.total()
+        return {"phases": phases, "total": {"wall": wall, "cpu": cpu}, "counters": dict(counters)}
+
+    def report(self, counters):
+        out = ["%-20s %10s %10s" % ("Phase", "Wall ms", "CPU ms")]
+        for name, depth, wall, cpu in self.phases:
+            if wall is not None:
+                out.append("%-20s %10.1f %10.1f" % ("  " * depth + name, wall * 1000, cpu * 1000))
+        wall, cpu = self.total()
+        out.append("%-20s %10.1f %10.1f" % ("total", wall * 1000, cpu * 1000))
+
+        out.append("")
+        for name, value in counters.items():
+            out.append("%-20s %10d" % (name, value))
+        return "\n".join(out)
+
+    # Write the report as JSON, with the MemoryProfiler's report in it if there is one.
+    def writeJSON(self, dest, counters, memory=None):
+        doc = self.asDict(counters)
+        if memory is not None:
+            doc["memory"] = memory.asDict()
+        json.dump(doc, dest, indent=1)
+        dest.write("\n")
+
+
+class MemoryProfiler:
+    """
+    phaseHook that follows the memory used by each phase of an assembly, with tracemalloc.
+
+    siteCount - number of allocating sites listed for each phase
+    phases - [ name, depth, peak, retained, sites ] for each phase, in the order they started.
+             Retained is None until the phase ends, and sites is None for the steps inside a
+             phase, which have a greater depth.
+    stack - ( index into phases, bytes traced at the start, site sizes at the start or None ) of
+            each phase that has started but not ended
+    setup - ( retained, sites ) of what was allocated before the first phase
+    final - the sites holding the most memory at the end of the last phase
+    startCurrent, startSizes - bytes traced, and the site sizes, when tracing started
+    """
+
+    def __init__(self, siteCount=SITE_COUNT):
+        self.siteCount = siteCount
+        self.phases = []
+        self.stack = []
+        self.setup = None
+        self.final = None
+        self.startCurrent = 0
+        self.startSizes = None
+
+    def __repr__(self):
+        return ", ".join("%s %.1f KB" % (p[0], p[2] / 1024) for p in self.phases if p[3] is not None)
+
+    # Start tracemalloc. This has to be done before the source file is read.
+    def start(self):
+        tracemalloc.start()
+        self.startSizes = siteSizes()
+        self.startCurrent = tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def __call__(self, name, starting):
+        if not tracemalloc.is_tracing():
+            return
+
+        # The peak since the last boundary belongs to every phase still running.
+        current, peak = tracemalloc.get_traced_memory()
+        for index, __, __ in self.stack:
+            self.phases[index][2] = max(self.phases[index][2], peak)
+
+        if starting:
+            sizes = siteSizes() if not self.stack else None
+            if self.setup is None:
+                self.setup = (current - self.startCurrent, topSites(self.startSizes, sizes, self.siteCount))
+            self.phases.append([name, len(self.stack), current, None, None])
+            self.stack.append((len(self.phases) - 1, current, sizes))
+        else:
+            index, startCurrent, startSizes = self.stack.pop()
+            phase = self.phases[index]
+            phase[3] = current - startCurrent
+            if startSizes is not None:
+                sizes = siteSizes()
+                phase[4] = topSites(startSizes, sizes, self.siteCount)
+                self.final = topSites({}, sizes, self.siteCount)
+
+        # Grouping the snapshot isn't part of any phase's peak.
+        tracemalloc.reset_peak()
+
+    def asDict(self):
+        def sitesAsList(sites):
+            return [{"site": site, "bytes": size, "blocks": count} for site, size, count in sites]
+
+        phases = {}
+        path = []
+        for name, depth, peak, retained, sites in self.phases:
+            del path[depth:]
+            path.append(name)
+            if retained is not None:
+                phases[".".join(path)] = {"peak": peak, "retained": retained}
+                if sites is not None:
+                    phases[".".join(path)]["sites"] = sitesAsList(sites)
+
+        out = {"phases": phases}
+        if self.setup is not None:
+            out["setup"] = {"retained": self.setup[0], "sites": sitesAsList(self.setup[1])}
+        if self.final is not None:
+            out["final"] = sitesAsList(self.final)
+        return out
+
+    def report(self):
+        out = ["%-20s %10s %12s" % ("Memory", "Peak KB", "Retained KB")]
+        if self.setup is not None:
+            out.append("%-20s %10s %12.1f" % ("setup", "", self.setup[0] / 1024))
+        for name, depth, peak, retained, __ in self.phases:
+            if retained is not None:
+                out.append("%-20s %10.1f %12.1f" % ("  " * depth + name, peak / 1024, retained / 1024))
+
+        out.append("")
+        out.append("Top allocating sites, by memory retained")
+        if self.setup is not None:
+            out.extend(formatSites("setup", self.setup[1]))
+        for name, __, __, retained, sites in self.phases:
+            if retained is not None and sites is not None:
+                out.extend(formatSites(name, sites))
+        if self.final is not None:
+            out.extend(formatSites("held at the end", self.final))
+        return "\n".join(out)
+
+
+#
+# Returns a phaseHook that calls each of the hooks. The first one is innermost, called last at the
+# start of a phase and first at the end, so the work of the others isn't counted in its times.
+#
+def chainHooks(hooks):
+    if len(hooks) == 1:
+        return hooks[0]
+
+    def hook(name, starting):
+        for h in (reversed(hooks) if starting else hooks):
+            h(name, starting)
+    return hook
+
+
+#
+# Returns the memory held by each line of the assembler's own modules, as a dict of "file:line" to
+# ( bytes, blocks ). This module is left out, so the profiling doesn't show up in its own report.
+#
+def siteSizes():
+    sizes = {}
+    for stat in tracemalloc.take_snapshot().statistics('lineno'):
+        frame = stat.traceback[0]
+        directory, filename = os.path.split(os.path.abspath(frame.filename))      # The main script's can be relative
+        if directory == SITE_DIRECTORY and filename != "Profile.py":
+            sizes["%s:%d" % (filename, frame.lineno)] = (stat.size, stat.count)
+    return sizes
+
+
+#
+# Returns ( "file:line", bytes, blocks ) of the count sites that grew the most from one dict of site
+# sizes to the next.
+#
+def topSites(before, after, count):
+    sites = []
+    for site, (size, blocks) in after.items():
+        oldSize, oldBlocks = before.get(site, (0, 0))
+        if size > oldSize:
+            sites.append((site, size - oldSize, blocks - oldBlocks))
+    sites.sort(key=lambda site: -site[1])
+    return sites[:count]
+
+
+def formatSites(title, sites):
+    out = ["  %s" % title]
+    if not sites:
+        out.append("    (none)")
+    for site, size, count in sites:
+        filename, lineno = site.rsplit(":", 1)
+        source = linecache.getline(os.path.join(SITE_DIRECTORY, filename), int(lineno)).strip()
+        out.append("    %10.1f KB %8d blocks  %-22s %s" % (size / 1024, count, site, source))
+    return out
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# ProgramImage
+#
+# The program image for my Cosmac 1802 Assembler.
+#
+# The whole 64K address space of the 1802 is kept in one preallocated bytearray, along with a
+# coverage map holding a 1 for every address that has been written. Adding code is a slice
+# assignment into each, and writing to an address twice is caught with a single search of the
+# coverage map.
+#
+# The output formats get the image as ( address, data ) segments, one for each run of written
+# addresses, where the data is a memoryview into the image so nothing is copied.
+#
+
+MEMORY_SIZE = 0x10000
+
+PADDING = 0xFF
+
+_ones = memoryview(b'\x01' * MEMORY_SIZE)     # Slices of this mark addresses as written
+
+
+class ImageError(Exception):
+    """Raised for code that doesn't fit in the image."""
+
+
+class ProgramImage:
+    """
+    The 1802's memory, as the program fills it in.
+
+    data - the contents of memory, PADDING where nothing has been written
+    coverage - one byte for each address, 1 if it has been written
+    size - number of bytes written
+    """
+
+    def __init__(self):
+        self.data = bytearray((PADDING,)) * MEMORY_SIZE
+        self.coverage = bytearray(MEMORY_SIZE)
+        self.size = 0
+
+    def __repr__(self):
+        return "%d bytes in %d segments" % (self.size, len(self.segments()))
+
+    def __len__(self):
+        return self.size
+
+    #
+    # Put the bytes into memory at the address. Raises ImageError if they go past the end of memory
+    # or overlap anything already written.
+    #
+    def add(self, address, bytes):
+        count = len(bytes)
+        end = address + count
+        if address < 0 or end > MEMORY_SIZE:
+            raise ImageError("Data written past the end of memory at 0x%04X" % max(address, MEMORY_SIZE))
+
+        overlap = self.coverage.find(1, address, end)
+        if overlap >= 0:
+            raise ImageError("Data written to address 0x%04X, which already has code" % overlap)
+
+        self.data[address:end] = bytes
+        self.coverage[address:end] = _ones[:count]
+        self.size += count
+
+    #
+    # Returns the list of ( address, data ) for each run of written addresses, in ascending order.
+    #
+    def segments(self):
+        segments = []
+        view = memoryview(self.data)
+        start = self.coverage.find(1)
+        while start >= 0:
+            end = self.coverage.find(0, start)
+            if end < 0:
+                end = MEMORY_SIZE
+            segments.append((start, view[start:end]))
+            start = self.coverage.find(1, end)
+        return segments
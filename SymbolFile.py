@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# SymbolFile
+#
+# Symbol files for my Cosmac 1802 Assembler.
+#
+# A symbol file holds the resolved symbols of an assembled program, so other programs (an add-on
+# ROM calling into the FIG-Forth kernel, say) can use them without assembling its source again.
+#
+# One symbol to a line, sorted by name:
+#
+#   ; Cosmac symbols 1 FIG_Forth.src
+#   COLD L 0100
+#   BSCR E 0008 08
+#
+# L is a label, with its address. E is an equate, with its value and then the bytes DC emits for it
+# (a hex literal keeps the number of digits it was written with, so they can't be rebuilt from the
+# value). Lines starting with a ; are comments.
+#
+
+FORMAT_VERSION = 1
+HEADER = "; Cosmac symbols"
+
+LABEL = "L"
+EQUATE = "E"
+
+
+class SymbolFileError(Exception):
+    """Raised for a file that isn't a symbol file, or a line that can't be read."""
+
+
+#
+# Write the symbols, a list of ( name, kind, value, bytes ) where kind is LABEL or EQUATE.
+#
+def writeSymbols(dest, symbols, sourceName):
+    out = ["%s %d %s\n" % (HEADER, FORMAT_VERSION, sourceName)]
+    for name, kind, value, bytes in sorted(symbols):
+        if kind == LABEL:
+            out.append("%s L %04X\n" % (name, value))
+        else:
+            out.append("%s E %04X %s\n" % (name, value, bytes.hex().upper()))
+    dest.write("".join(out))
+
+
+#
+# Returns the list of ( name, kind, value, bytes ) read from the file. Raises SymbolFileError with
+# the line number for anything it can't read.
+#
+def readSymbols(src):
+    lines = src.readlines()
+    if not lines or not lines[0].startswith(HEADER):
+        raise SymbolFileError("Not a symbol file")
+
+    fields = lines[0].split()
+    if len(fields) < 4 or fields[3] != str(FORMAT_VERSION):
+        raise SymbolFileError("Unsupported symbol file version '%s'" % " ".join(fields[3:4]))
+
+    symbols = []
+    for lineNumber, line in enumerate(lines[1:], 2):
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith(";"):
+            continue
+        try:
+            if fields[1] == LABEL and len(fields) == 3:
+                value = int(fields[2], 16)
+                symbols.append((fields[0], LABEL, value, value.to_bytes(2, 'big')))
+            elif fields[1] == EQUATE and len(fields) == 4:
+                symbols.append((fields[0], EQUATE, int(fields[2], 16), bytes.fromhex(fields[3])))
+            else:
+                raise ValueError()
+        except (ValueError, IndexError, OverflowError):
+            raise SymbolFileError("Line: %d   Bad symbol record '%s'" % (lineNumber, line.strip()))
+
+    return symbols
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# TokenCache
+#
+# On-disk cache of tokenized source for my Cosmac 1802 Assembler.
+#
+# Much like Python's __pycache__, the tokenized form of a source file is saved in an __asmcache__
+# directory next to it, so building the same source again doesn't have to chunk and parse it.
+#
+# An entry is keyed by a hash of the source text, plus a "salt" holding everything else that changes
+# how a source is tokenized: the syntax, and the code of the assembler itself. Anything changing just
+# misses the cache, there is nothing to invalidate. Once the directory grows past its size limit the
+# least recently used entries are deleted.
+#
+# What is saved is up to the caller, it only has to pickle.
+#
+
+import os
+import hashlib
+import pickle
+
+
+CACHE_DIRNAME = "__asmcache__"
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024
+FORMAT_VERSION = 1
+
+
+_fingerprints = {}      # Code fingerprints, keyed by the tuple of filenames
+
+
+#
+# Returns a hash of the contents of the given files, used to tell one version of the assembler
+# from another.
+#
+def codeFingerprint(filenames):
+    key = tuple(filenames)
+    fp = _fingerprints.get(key)
+    if fp is None:
+        h = hashlib.sha256()
+        for filename in key:
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+        fp = h.hexdigest()
+        _fingerprints[key] = fp
+    return fp
+
+
+class TokenCache:
+    """
+    The tokenized sources kept in one cache directory.
+
+    directory - where the entries are kept
+    salt - text mixed into every key along with the source
+    maxSize - total size of the entries in bytes, above which the least recently used are deleted
+    """
+
+    def __init__(self, directory, salt, maxSize=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.salt = salt
+        self.maxSize = maxSize
+
+    def __repr__(self):
+        return "%s (%d bytes max)" % (self.directory, self.maxSize)
+
+    #
+    # Returns the filename of the entry for a source file. The name is only there to make the
+    # directory readable, the entry is found by the hash.
+    #
+    def entryFilename(self, name, text):
+        h = hashlib.sha256()
+        h.update(("%d\n%s\n" % (FORMAT_VERSION, self.salt)).encode())
+        h.update(text.encode())
+        return os.path.join(self.directory, "%s.%s.tok" % (name, h.hexdigest()[:24]))
+
+    #
+    # Returns what was saved for the source text, or None if it isn't in the cache.
+    #
+    def load(self, name, text):
+        filename = self.entryFilename(name, text)
+        try:
+            with open(filename, 'rb') as f:
+                state = pickle.load(f)
+            os.utime(filename)      # Mark it as recently used
+        except (OSError, EOFError, ValueError, TypeError, AttributeError, ImportError, pickle.UnpicklingError):
+            return None
+        return state
+
+    #
+    # Save the state for the source text, and trim the cache back to its size limit.
+    #
+    # The file is written under a temporary name and renamed into place, so a build running at the
+    # same time never sees half of an entry. A cache that can't be written is not an error, the next
+    # build is just slower.
+    #
+    def save(self, name, text, state):
+        filename = self.entryFilename(name, text)
+        tempFilename = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tempFilename, 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempFilename, filename)
+        except OSError:
+            return
+
+        self.evict()
+
+    #
+    # Delete the least recently used entries until the total size is under the limit.
+    #
+    def evict(self):
+        entries = []
+        total = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".tok"):
+                        st = entry.stat()
+                        entries.append((st.st_mtime, st.st_size, entry.path))
+                        total += st.st_size
+        except OSError:
+            return
+
+        entries.sort()
+        for __, size, path in entries:
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass        # Another build may have got to it first
+            total -= size
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Trace
+#
+# Debug tracing for my Cosmac 1802 Assembler.
+#
+# Each subsystem has its own tracer, which is called with a format string and its arguments:
+#
+#   asm.trace.evaluator("Token value is %s - %s", value, ebytes)
+#
+# The formatting is only done if that tracer is turned on, so leaving trace calls in the
+# hot paths costs next to nothing at the normal verbosity.
+#
+#   tokenizer - lines, labels, chunks and statements
+#   evaluator - expressions and token values
+#   resolver - the symbol table
+#   emitter - code generation, conditionals and fixups
+#
+# Each Assembler has its own Tracers, so the assemblies in one process (cosmacbatch, cosmaclink or
+# the benchmarks) can be traced to different files, or not at all, without getting in each other's way.
+#
+
+
+import sys
+
+
+SUBSYSTEMS = ("tokenizer", "evaluator", "resolver", "emitter")
+
+
+class Tracer:
+    """
+    Trace output for one subsystem.
+
+    name - the subsystem name
+    enabled - True if the trace output is turned on
+    dest - file the traces are written to, None for stdout
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.enabled = False
+        self.dest = None
+
+    def __repr__(self):
+        return "%s %s" % (self.name, "on" if self.enabled else "off")
+
+    def __call__(self, msg, *args):
+        if self.enabled:
+            if args:
+                msg = msg % args
+            (self.dest or sys.stdout).write(msg + "\n")
+
+
+class Tracers:
+    """
+    The tracers of one assembly, all of them off to start with.
+
+    tokenizer, evaluator, resolver, emitter - the Tracer for each subsystem
+    """
+
+    def __init__(self):
+        self.tokenizer = Tracer("tokenizer")
+        self.evaluator = Tracer("evaluator")
+        self.resolver = Tracer("resolver")
+        self.emitter = Tracer("emitter")
+
+    def __repr__(self):
+        return ", ".join(repr(t) for t in self.all())
+
+    def all(self):
+        return (self.tokenizer, self.evaluator, self.resolver, self.emitter)
+
+    #
+    # Turn tracing on for the named subsystems (all of them for "all"), and off for the rest.
+    #
+    def enable(self, names):
+        if "all" in names:
+            names = SUBSYSTEMS
+
+        for name in names:
+            if name not in SUBSYSTEMS:
+                raise ValueError("Unknown trace subsystem '%s'" % name)
+
+        for tracer in self.all():
+            tracer.enabled = tracer.name in names
+
+    #
+    # Send the trace output to an open file, or back to stdout for None.
+    #
+    def setOutput(self, f):
+        for tracer in self.all():
+            tracer.dest = f
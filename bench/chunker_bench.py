@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Chunker benchmark
+#
+# Times Chunker.Chunker against the original character-at-a-time implementation, using the
+# DC lines from the FIG-Forth source. The DC operands are also joined into a few very long
+# lines, which is where the old quadratic behavior really shows up.
+#
+# Run from anywhere:  bench/chunker_bench.py
+#
+
+import os
+import sys
+import re
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Chunker      # noqa: E402
+
+
+FIG_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test", "FIG_Forth.src")
+
+
+class LegacyChunker:
+    """The scanner as it was before it went index based, kept here as the reference point."""
+
+    def __init__(self, line, semicolonComments=False):
+        self.line = line
+        self.semicolonComments = semicolonComments
+        self.chunks = []
+
+        while True:
+            chk = self._nextChunk()
+            if chk is None:
+                break
+            else:
+                self.chunks.append(chk)
+
+    def _nextChunk(self):
+        t = ""
+        inQuote = False
+
+        while len(self.line) > 0:
+            c = self.line[0]
+            self.line = self.line[1:]
+
+            if inQuote:
+                if c == "'":
+                    inQuote = False
+                    t += c
+                elif c == "\\":
+                    if len(self.line) > 0:
+                        if self.line[0] == "\\" or self.line[0] == "'":
+                            t += c
+                            t += self.line[0]
+                            self.line = self.line[1:]
+                        else:
+                            t += c
+                else:
+                    t += c
+                continue
+
+            if c == '.':
+                if len(self.line) > 0 and self.line[0] == '.':
+                    self.line = ""
+                    break
+                else:
+                    t += c
+            elif c == ';':
+                if self.semicolonComments is True:
+                    self.line = ""
+                break
+            elif c == ':':
+                break
+            elif c == "'":
+                t += c
+                inQuote = True
+            else:
+                t += c
+
+        if inQuote:
+            raise Chunker.NoClosingQuoteError()
+
+        t = t.strip()
+
+        if len(t) > 0:
+            return t
+        else:
+            return None
+
+
+def dcLines():
+    with open(FIG_SOURCE) as f:
+        return [line for line in f if re.match(r'^\w*\s+DC\s', line)]
+
+
+def longLines(lines, count):
+    """Join the DC operands into lines of roughly 'count' operands each."""
+    operands = []
+    for line in lines:
+        chunk = Chunker.Chunker(line).chunks[-1]
+        operands.extend(s.strip() for s in chunk[2:].split(','))
+
+    result = []
+    for i in range(0, len(operands), count):
+        result.append("\tDC " + ", ".join(operands[i:i + count]) + "\t.. generated\n")
+    return result
+
+
+def timeLines(cls, lines, number):
+    def run():
+        for line in lines:
+            cls(line)
+    return min(timeit.repeat(run, number=number, repeat=5)) / number
+
+
+def report(title, lines, number):
+    for line in lines:
+        if LegacyChunker(line).chunks != Chunker.Chunker(line).chunks:
+            print("*** Chunk mismatch for line '%s'" % line.rstrip())
+            sys.exit(-1)
+
+    chars = sum(len(line) for line in lines)
+    old = timeLines(LegacyChunker, lines, number)
+    new = timeLines(Chunker.Chunker, lines, number)
+    print("%-28s %6d lines %8d chars   legacy %9.3f ms   new %9.3f ms   speedup %6.1fx" %
+          (title, len(lines), chars, old * 1000, new * 1000, old / new))
+
+
+def main(argv):
+    lines = dcLines()
+
+    print("Chunker benchmark, best of 5")
+    report("FIG-Forth DC lines", lines, 20)
+    for count in (50, 200, 1000):
+        report("Joined DC, %d per line" % count, longLines(lines, count), 5)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv) or 0)
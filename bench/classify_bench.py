@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Statement classification benchmark
+#
+# Times the first-word table lookup in cosmacasm.Assembler.classifyChunk against the original chain of
+# regular expressions (IF, ELSE, ENDI, ORG, PAGE, END, DC, LOAD, then the generic mnemonic
+# match), over every chunk of the FIG-Forth source.
+#
+# Run from anywhere:  bench/classify_bench.py
+#
+
+import os
+import sys
+import re
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Chunker      # noqa: E402
+import cosmacasm    # noqa: E402
+
+
+FIG_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test", "FIG_Forth.src")
+
+
+def legacyClassify(chunk, first):
+    """The regular expression chain as it was, returning ( key, operand )."""
+    if first:
+        m = re.match(r'^IF\s+(.+)', chunk, re.IGNORECASE)
+        if m:
+            return ("IF", m.group(1))
+        m = re.match(r'^ELSE$', chunk, re.IGNORECASE)
+        if m:
+            return ("ELSE", "")
+        m = re.match(r'^ENDI$', chunk, re.IGNORECASE)
+        if m:
+            return ("ENDI", "")
+        m = re.match(r'^ORG\s+(.*)', chunk, re.IGNORECASE)
+        if m:
+            return ("ORG", m.group(1))
+        m = re.match(r'^PAGE(.*)', chunk, re.IGNORECASE)
+        if m:
+            return ("PAGE", m.group(1))
+        m = re.match(r'^END(.*)', chunk, re.IGNORECASE)
+        if m:
+            return ("END", m.group(1))
+
+    m = re.match(r'^DC\s+(.*)', chunk)
+    if m:
+        return ("DC", m.group(1))
+    m = re.match(r'^LOAD\s+(.*)', chunk)
+    if m:
+        return ("LOAD", m.group(1))
+    m = re.match(r'^(\w+)\s*(.*)', chunk)
+    if m and m.group(1) in cosmacasm.opTable:
+        return (m.group(1), m.group(2))
+    return (None, None)
+
+
+_asm = cosmacasm.Assembler()
+
+
+def newClassify(chunk, first):
+    key, stmt, operand = _asm.classifyChunk(chunk)
+    if stmt is None or operand is None or (not first and stmt.kind <= cosmacasm.STMT_DIRECTIVE):
+        return (None, None)
+    return (key, operand)
+
+
+def sourceChunks():
+    """Every chunk in the source, with a flag for the first chunk of a line."""
+    chunks = []
+    with open(FIG_SOURCE) as f:
+        for line in f:
+            if re.match(r'^\s*(\w+)\s+EQU\s+(.+)', line, re.IGNORECASE):
+                continue
+            m = re.match(r'^(\w+):?\s*(.*)', line)
+            if m:
+                line = m.group(2)
+            for i, chunk in enumerate(Chunker.Chunker(line).chunks):
+                chunks.append((chunk, i == 0))
+    return chunks
+
+
+def timeChunks(func, chunks, number):
+    def run():
+        for chunk, first in chunks:
+            func(chunk, first)
+    return min(timeit.repeat(run, number=number, repeat=5)) / number
+
+
+def main(argv):
+    chunks = sourceChunks()
+
+    for chunk, first in chunks:
+        if legacyClassify(chunk, first) != newClassify(chunk, first):
+            print("*** Classification mismatch for chunk '%s'" % chunk)
+            sys.exit(-1)
+
+    number = 20
+    old = timeChunks(legacyClassify, chunks, number)
+    new = timeChunks(newClassify, chunks, number)
+    print("Statement classification benchmark, best of 5")
+    print("%-28s %6d chunks   legacy %9.3f ms   new %9.3f ms   speedup %6.1fx" %
+          ("FIG-Forth", len(chunks), old * 1000, new * 1000, old / new))
+    print("%-28s %6s          legacy %9.3f us   new %9.3f us" %
+          ("Per chunk", "", old * 1e6 / len(chunks), new * 1e6 / len(chunks)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv) or 0)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Synthetic source generator
+#
+# Writes valid 1802 assembly source of any length, for measuring how the assembler scales. The
+# source is a run of generated routines, each made of:
+#
+#   an EQU chain - each equate refers to the next one, which is defined after it, so resolving
+#                  the first takes as many steps as the chain is long
+#   code - immediate loads of the equates, a LOAD of the next routine's table, register ops, and a
+#          long branch to the next routine, with labels on some of the lines
+#   conditionals - IF blocks nested as deep as asked for, with an ELSE that is turned off
+#   a DC table - alternating label references and byte values
+#
+# The "next" routine of a routine is the one the forward reference depth ahead of it, wrapping
+# round to the start for the last few, so most references are forward ones.
+#
+# Every routine has the same shape, so its size in lines and bytes is known before any of them are
+# written. The 1802 only has 64K, so once CODE_BUDGET bytes of routines have been written the rest
+# of the lines are filler that produces no code: more EQU chains, and routines in IF blocks that are
+# turned off (which are still tokenized, but skipped). Up to about 40,000 lines (with the default
+# settings) the whole source is code. The routines in the filler have no lines with more than one
+# statement, since only the first statement of a line is skipped in an IF block that is turned off.
+#
+# Run from anywhere:  bench/gensrc.py [options] LINES > prog.src      (LINES can be like 10k or 1M)
+#
+
+import argparse
+import random
+import sys
+
+
+CODE_BUDGET = 0xF000
+
+DC_PER_LINE = 8
+
+
+class SourceGenerator:
+    """
+    Generates a synthetic source.
+
+    labelDensity - fraction of the code lines that get a label of their own
+    forwardDepth - how many routines ahead the references of a routine go
+    equChain - number of equates in each EQU chain
+    dcTable - number of entries in each DC table
+    nesting - how deep the IF blocks of each routine are nested
+    seed - seed for the random choices (labels and values), so a source can be made again
+    """
+
+    def __init__(self, labelDensity=0.25, forwardDepth=4, equChain=6, dcTable=16, nesting=2, seed=1802):
+        self.labelDensity = labelDensity
+        self.forwardDepth = forwardDepth
+        self.equChain = max(equChain, 1)
+        self.dcTable = max(dcTable, 1)
+        self.nesting = nesting
+        self.seed = seed
+
+    def __repr__(self):
+        return "labels %.2f, forward %d, EQU chain %d, DC table %d, nesting %d" % \
+            (self.labelDensity, self.forwardDepth, self.equChain, self.dcTable, self.nesting)
+
+    # Returns the source as a list of lines, exactly count of them.
+    def generate(self, count):
+        rand = random.Random(self.seed)
+        out = [
+            "\t.. Generated source, %d lines: %s\n" % (count, self),
+            "ON\tEQU 1\n",
+            "OFF\tEQU 0\n",
+            "\n"
+        ]
+
+        lineCount, byteCount = self.routineSize()
+        routines = min(max((count - len(out) - 1) // lineCount, 1), CODE_BUDGET // byteCount)
+
+        for r in range(routines):
+            out.extend(self.routine(rand, r, (r + self.forwardDepth) % routines, "R"))
+
+        # Filler, with no code, up to the count.
+        f = 0
+        while count - len(out) - 1 >= lineCount + 2:
+            if f % 2:
+                out.append("\tIF OFF\n")
+                out.extend(self.routine(rand, f, f, "X", multiple=False))
+                out.append("\tENDI\n")
+            else:
+                out.extend(self.equates("F%d" % f, f))
+            f += 1
+        while len(out) < count - 1:
+            out.append("\t.. filler\n")
+
+        out.append("\tEND\n")
+        return out
+
+    # Returns the number of lines and bytes of code in a routine.
+    def routineSize(self):
+        lines = self.routine(random.Random(0), 0, 0, "R")
+        code = 2 + 1 + 2 + 1 + 6 + 1 + 1 + 2 + 1 + 2 + 3 + 2
+        table = sum(2 if i % 2 == 0 else 1 for i in range(self.dcTable))
+        return (len(lines), code + table)
+
+    # The EQU chain, ending in a value.
+    def equates(self, prefix, n):
+        lines = []
+        for i in range(self.equChain - 1):
+            lines.append("%s_E%d\tEQU %s_E%d + %d\n" % (prefix, i, prefix, i + 1, i + 1))
+        lines.append("%s_E%d\tEQU %d\n" % (prefix, self.equChain - 1, n & 0x3F))
+        return lines
+
+    # A routine, with its references going to the target routine. With multiple False, every line
+    # has just one statement.
+    def routine(self, rand, r, target, prefix, multiple=True):
+        name = "%s%d" % (prefix, r)
+        lines = ["\t.. ---- Routine %s\n" % name]
+        lines.extend(self.equates(name, r))
+
+        code = [
+            "LDI A.0(%s_E0)" % name,
+            "PLO R7",
+            "LDI A.1(%s_E0)" % name,
+            "PHI R7",
+            "LOAD R8, %sT%d" % (prefix, target),
+            "SEX R2",
+            "LDN R8",
+            "ADI 0%02XH" % rand.randrange(256),
+            "STR R2",
+            ("GLO R%X; PLO R%X" if multiple else "GLO R%X .. PLO R%X") % (rand.randrange(16), rand.randrange(16))
+        ]
+
+        # The first line always has the routine's label.
+        lines.append("%s:\t%s\n" % (name, code[0]))
+        for i, text in enumerate(code[1:], 1):
+            if rand.random() < self.labelDensity:
+                lines.append("%s_L%d:\t%s\n" % (name, i, text))
+            else:
+                lines.append("\t%s\n" % text)
+
+        # Two bytes of code whatever the nesting.
+        if self.nesting > 0:
+            lines.extend("\tIF ON\n" for __ in range(self.nesting))
+            lines.extend(["\tINC R9\n", "\tIF OFF\n", "\tLBR %s\n" % name, "\tELSE\n", "\tDEC R9\n", "\tENDI\n"])
+            lines.extend("\tENDI\n" for __ in range(self.nesting))
+        else:
+            lines.extend(["\tINC R9\n", "\tDEC R9\n"])
+
+        lines.append("\tLBR %s%d\n" % (prefix, target))
+
+        refs = ("%s%d" % (prefix, target), "%sT%d" % (prefix, target), "%sT%d" % (prefix, r), name)
+        entries = []
+        for i in range(self.dcTable):
+            if i % 2 == 0:
+                entries.append(refs[i // 2 % len(refs)])
+            else:
+                entries.append("%d" % rand.randrange(256))
+        label = "%sT%d:" % (prefix, r)
+        for i in range(0, len(entries), DC_PER_LINE):
+            lines.append("%s\tDC %s\n" % (label, ", ".join(entries[i:i + DC_PER_LINE])))
+            label = ""
+
+        lines.append("\n")
+        return lines
+
+
+def line_count(x):
+    multiplier = {"K": 1000, "M": 1000000}.get(x[-1:].upper(), 1)
+    return int(x[:-1] if multiplier > 1 else x) * multiplier
+
+
+# Add the options for the shape of the source to an ArgumentParser.
+def addGeneratorOptions(parser):
+    parser.add_argument("--labels", type=float, dest="labelDensity", default=0.25,
+                        help="Fraction of the code lines with a label (default 0.25)")
+    parser.add_argument("--forward", type=int, dest="forwardDepth", default=4,
+                        help="How many routines ahead the references go (default 4)")
+    parser.add_argument("--equ-chain", type=int, dest="equChain", default=6,
+                        help="Length of each EQU chain (default 6)")
+    parser.add_argument("--dc-table", type=int, dest="dcTable", default=16,
+                        help="Number of entries in each DC table (default 16)")
+    parser.add_argument("--nesting", type=int, dest="nesting", default=2,
+                        help="Depth of the nested IF blocks (default 2)")
+    parser.add_argument("--seed", type=int, dest="seed", default=1802)
+
+
+def generatorFromOptions(options):
+    return SourceGenerator(options.labelDensity, options.forwardDepth, options.equChain,
+                           options.dcTable, options.nesting, options.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic 1802 source for benchmarking.")
+
+    parser.add_argument("lines", type=line_count, metavar="LINES",
+                        help="Number of lines, like 5000, 10k or 1M")
+    parser.add_argument("-o", "--output", dest="output", default=None, metavar="FILE",
+                        help="File to write the source to (default is stdout)")
+    addGeneratorOptions(parser)
+
+    options = parser.parse_args(argv)
+
+    lines = generatorFromOptions(options).generate(options.lines)
+
+    if options.output is None:
+        sys.stdout.writelines(lines)
+    else:
+        with open(options.output, 'w') as f:
+            f.writelines(lines)
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Output format benchmark
+#
+# Times the OutputFormats writers on a ProgramImage against the original output path (a raw hex
+# string built up a byte at a time from bincopy's binary image, and bincopy's Intel hex string
+# written in one go), for a full 64K image and for the FIG-Forth image. Both write to the null
+# device, and the output of the two is checked to be the same first.
+#
+# The assembler no longer needs bincopy, it is only used here for the original path.
+#
+# Run from anywhere:  bench/hexout_bench.py
+#
+
+import os
+import random
+import sys
+import timeit
+
+import bincopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cosmacasm        # noqa: E402
+import OutputFormats    # noqa: E402
+import ProgramImage     # noqa: E402
+
+
+FIG_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test", "FIG_Forth.src")
+
+
+def legacyHexStrings(data):
+    """The raw hex text as dataToHexStrings() used to build it."""
+    buf = ""
+    bytes = 0
+    for b in data:
+        buf = buf + "%02X" % b
+        bytes += 1
+        if bytes >= 16:
+            buf += "\n"
+            bytes = 0
+
+    return buf
+
+
+def legacyOutput(binfile, base, hexDest, recDest):
+    hexDest.write(legacyHexStrings(binfile.as_binary(minimum_address=base)))
+    recDest.write(binfile.as_ihex())
+
+
+def newOutput(image, base, hexDest, recDest):
+    segments = image.segments()
+    OutputFormats.writeRawHex(hexDest, segments, base)
+    OutputFormats.writeIntelHex(recDest, segments, base)
+
+
+def fullImage():
+    """64K of random code, in a few blocks with gaps between them."""
+    rng = random.Random(1802)
+    image = ProgramImage.ProgramImage()
+    address = 0
+    for size in (0x3000, 0x5000, 0x4000, 0x3D00):
+        image.add(address, bytes(rng.randrange(256) for __ in range(size)))
+        address += size + 0x100
+    return image, 0
+
+
+def figImage():
+    asm = cosmacasm.Assembler(verbose=0, displayFlag=True, writeListing=False)
+    with open(FIG_SOURCE) as src:
+        asm.assembleFile(src)
+    return asm.image, asm.programBase
+
+
+def binfileOf(image):
+    """The image as a bincopy BinFile, for the original path."""
+    binfile = bincopy.BinFile()
+    for address, data in image.segments():
+        binfile.add_binary(bytes(data), address)
+    return binfile
+
+
+class Collector:
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+
+def main(argv):
+    print("Output format benchmark, best of 5")
+
+    for name, (image, base) in (("64K image", fullImage()), ("FIG-Forth", figImage())):
+        binfile = binfileOf(image)
+        old = (Collector(), Collector())
+        new = (Collector(), Collector())
+        legacyOutput(binfile, base, *old)
+        newOutput(image, base, *new)
+        if ["".join(c.parts) for c in old] != ["".join(c.parts) for c in new]:
+            print("*** Output mismatch for %s" % name)
+            sys.exit(-1)
+
+        number = 3
+        with open(os.devnull, 'w') as dest:
+            oldTime = min(timeit.repeat(lambda: legacyOutput(binfile, base, dest, dest), number=number, repeat=5)) / number
+            newTime = min(timeit.repeat(lambda: newOutput(image, base, dest, dest), number=number, repeat=5)) / number
+
+        print("%-28s %6d bytes  legacy %9.3f ms   new %9.3f ms   speedup %6.1fx" %
+              (name, len(image), oldTime * 1000, newTime * 1000, oldTime / newTime))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv) or 0)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Listing writer benchmark
+#
+# Times the batched formatting in ListingWriter against the original way of producing the listing
+# (building each line's hex string a byte at a time, and one write per listing line), for every
+# line of the FIG-Forth listing. Both write to the null device.
+#
+# Run from anywhere:  bench/listing_bench.py
+#
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cosmacasm        # noqa: E402
+import ListingWriter    # noqa: E402
+
+
+FIG_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test", "FIG_Forth.src")
+
+
+class RecordingWriter(ListingWriter.ListingWriter):
+    """Keeps every record instead of writing them."""
+
+    def __init__(self, dest):
+        super().__init__(dest)
+        self.held = True
+        self.all = []
+
+    def code(self, address, bytes, lineNumber, text):
+        self.all.append((address, bytes, lineNumber, text))
+
+    def noCode(self, address, lineNumber, text):
+        self.all.append((address, None, lineNumber, text))
+
+
+def listingRecords():
+    """The records for the FIG-Forth listing."""
+    asm = cosmacasm.Assembler(verbose=0, displayFlag=True)
+    asm.listing = RecordingWriter(None)
+    with open(FIG_SOURCE) as src:
+        asm.assembleFile(src)
+    return asm.listing.all
+
+
+def legacyListing(records, dest):
+    """The listing as emitCode() and emitNoCode() used to write it."""
+    def emitListing(text):
+        dest.write(text + "\n")
+
+    for startAddr, bytes, lineNumber, curLine in records:
+        if bytes is None:
+            if curLine == "":
+                emitListing("%04X ;              %04d" % (startAddr, lineNumber))
+            else:
+                emitListing("%04X ;              %04d  %s" % (startAddr, lineNumber, curLine))
+            continue
+
+        hexStr = ""
+        overflow = False
+        for byte in bytes:
+            pair = "%02X" % byte
+            hexStr += pair
+            if len(hexStr) >= (ListingWriter.BYTES_PER_LINE * 2):
+                hexStr += ';'
+                if overflow is False:
+                    emitListing("%04X %-14s %04d  %s" % (startAddr, hexStr, lineNumber, curLine))
+                    hexStr = ""
+                    overflow = True
+                else:
+                    emitListing("%04X %s" % (startAddr, hexStr))
+                    hexStr = ""
+                startAddr += ListingWriter.BYTES_PER_LINE
+
+        if hexStr != "":
+            hexStr += ';'
+            if overflow is False:
+                emitListing("%04X %-14s %04d  %s" % (startAddr, hexStr, lineNumber, curLine))
+            else:
+                emitListing("%04X %s" % (startAddr, hexStr))
+
+
+def newListing(records, dest):
+    writer = ListingWriter.ListingWriter(dest)
+    for address, bytes, lineNumber, text in records:
+        if bytes is None:
+            writer.noCode(address, lineNumber, text)
+        else:
+            writer.code(address, bytes, lineNumber, text)
+    writer.finish()
+
+
+class Collector:
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+
+def main(argv):
+    records = listingRecords()
+
+    old, new = Collector(), Collector()
+    legacyListing(records, old)
+    newListing(records, new)
+    if "".join(old.parts) != "".join(new.parts):
+        print("*** Listing mismatch")
+        sys.exit(-1)
+
+    number = 10
+    with open(os.devnull, 'w') as dest:
+        oldTime = min(timeit.repeat(lambda: legacyListing(records, dest), number=number, repeat=5)) / number
+        newTime = min(timeit.repeat(lambda: newListing(records, dest), number=number, repeat=5)) / number
+
+    print("Listing writer benchmark, best of 5")
+    print("%-28s %6d records  legacy %9.3f ms   new %9.3f ms   speedup %6.1fx" %
+          ("FIG-Forth", len(records), oldTime * 1000, newTime * 1000, oldTime / newTime))
+    print("%-28s %6d writes   legacy %9s      new %9d" % ("", len(old.parts), "", len(new.parts)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv) or 0)
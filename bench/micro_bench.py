@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+# Hot path micro-benchmarks
+#
+# Times the inner loops of the assembler one at a time:
+#
+#   chunker          Chunker.Chunker on the body of every source line
+#   parser.tokens    Parser.Parser.tokens on every expression (what Expression compiles from)
+#   parser.nextItem  Parser.Parser.nextItem on every expression
+#   compile          Expression compiling every expression, with nothing cached
+#   obtainTokenValue Assembler.obtainTokenValue on every number and symbol in the expressions
+#   calcExpression   Assembler.calcExpression on every expression (compiled ones are cached)
+#   assembleDC       Assembler.assembleDC on every DC operand
+#   assembleChunk    Assembler.assembleChunk on every instruction
+#
+# The inputs are the real ones from the test sources (FIG-Forth and the test*.src files), each of
+# which is assembled first, so the symbol table is complete. The DC operands and instructions are
+# then found by stepping through the line records again, so each one is timed at the address it
+# really has, which matters for the short branches.
+#
+# Each benchmark runs its whole set of inputs as one loop. The number of loops in a run is picked so
+# a run takes at least --min-time, and the min and median of --repeat runs are reported, per loop
+# and per call, along with how far the median is above the min (a high spread means a noisy
+# machine, and the numbers shouldn't be trusted).
+#
+# Run from anywhere:  bench/micro_bench.py [--repeat N] [--min-time SECONDS] [NAME...]
+#
+
+import argparse
+import gc
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Chunker          # noqa: E402
+import cosmacasm        # noqa: E402
+import Expression       # noqa: E402
+import Parser           # noqa: E402
+
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test")
+SOURCES = ("FIG_Forth.src", "test.src", "test_dc.src", "test_exp.src")
+
+
+class Samples:
+    """
+    The inputs to the benchmarks, from the assembled test sources.
+
+    bodies - the text of each source line after its label
+    expressions - ( asm, expression ) for each operand expression and equate body
+    tokens - ( asm, address, token ) for each number and symbol in the expressions
+    dcs - ( asm, address, operand ) for each DC
+    chunks - ( asm, address, chunk ) for each instruction
+    """
+
+    def __init__(self):
+        self.bodies = []
+        self.expressions = []
+        self.tokens = []
+        self.dcs = []
+        self.chunks = []
+
+    def __repr__(self):
+        return "%d lines, %d expressions, %d tokens, %d DC, %d instructions" % \
+            (len(self.bodies), len(self.expressions), len(self.tokens), len(self.dcs), len(self.chunks))
+
+    def addSource(self, path):
+        asm = cosmacasm.Assembler(verbose=0, writeListing=False)
+        with open(path) as src:
+            asm.assembleFile(src)
+
+        for line, __, __ in asm.sourceLines:
+            self.bodies.append(cosmacasm.tokenizeLine(line, False).body)
+
+        # Step through the code again, without emitting it, to find each statement's address.
+        table = cosmacasm.statementTables[False]
+        asm.address = 0
+        for (line, asm.fileName, asm.lineNumber), rec in zip(asm.sourceLines, asm.lineRecords):
+            for op, operand in rec.statements:
+                if op is None:
+                    continue
+                address = asm.address
+                if op == "EQU":
+                    self.addExpression(asm, address, operand)
+                    continue
+
+                table[op].handler(asm, operand)
+
+                if op == "DC":
+                    self.dcs.append((asm, address, operand))
+                    for item in operand.split(","):
+                        if not item.strip().startswith("'"):
+                            self.addExpression(asm, address, item.strip())
+                elif op == "LOAD":
+                    self.addExpression(asm, address, operand.split(",", 1)[1].strip())
+                elif op in cosmacasm.opTable:
+                    self.chunks.append((asm, address, ("%s %s" % (op, operand)).strip()))
+                    if operand and not cosmacasm.isRegisterLiteral(operand):
+                        self.addExpression(asm, address, operand)
+
+    def addExpression(self, asm, address, expression):
+        self.expressions.append((asm, expression))
+        parser = Parser.Parser(expression)
+        spans = [(0, None)]
+        while spans:
+            for tok in parser.tokens(*spans.pop()):
+                if tok.kind == Parser.GROUP:
+                    spans.append((tok.start, tok.end))
+                elif tok.kind in (Parser.NUMBER, Parser.SYMBOL) or tok.text == "$":
+                    self.tokens.append((asm, address, tok.text))
+
+
+#
+# The benchmarks, name to a function that is given the Samples and returns ( loop, calls ): the
+# function that runs one loop over the inputs, and the number of calls it makes.
+#
+def benchChunker(samples):
+    bodies = samples.bodies
+
+    def loop():
+        for body in bodies:
+            Chunker.Chunker(body)
+    return (loop, len(bodies))
+
+
+def benchParserTokens(samples):
+    texts = [expression for __, expression in samples.expressions]
+
+    def loop():
+        for text in texts:
+            for __ in Parser.Parser(text).tokens():
+                pass
+    return (loop, len(texts))
+
+
+def benchParserNextItem(samples):
+    texts = [expression for __, expression in samples.expressions]
+
+    def loop():
+        for text in texts:
+            parser = Parser.Parser(text)
+            while parser.nextItem()[0] is not None:
+                pass
+    return (loop, len(texts))
+
+
+def benchCompile(samples):
+    texts = [expression for __, expression in samples.expressions]
+    uncached = Expression.ExpressionCache(maxSize=0)
+
+    def loop():
+        for text in texts:
+            uncached.lookup(text, False)
+    return (loop, len(texts))
+
+
+def benchObtainTokenValue(samples):
+    tokens = samples.tokens
+
+    def loop():
+        for asm, address, token in tokens:
+            asm.address = address
+            asm.obtainTokenValue(token)
+    return (loop, len(tokens))
+
+
+def benchCalcExpression(samples):
+    expressions = samples.expressions
+
+    def loop():
+        for asm, expression in expressions:
+            asm.calcExpression(0, expression)
+    return (loop, len(expressions))
+
+
+def benchAssembleDC(samples):
+    dcs = samples.dcs
+
+    def loop():
+        for asm, address, operand in dcs:
+            asm.address = address
+            asm.assembleDC(operand)
+    return (loop, len(dcs))
+
+
+def benchAssembleChunk(samples):
+    chunks = samples.chunks
+
+    def loop():
+        for asm, address, chunk in chunks:
+            asm.address = address
+            asm.assembleChunk(chunk)
+    return (loop, len(chunks))
+
+
+benchmarks = {
+    "chunker": benchChunker,
+    "parser.tokens": benchParserTokens,
+    "parser.nextItem": benchParserNextItem,
+    "compile": benchCompile,
+    "obtainTokenValue": benchObtainTokenValue,
+    "calcExpression": benchCalcExpression,
+    "assembleDC": benchAssembleDC,
+    "assembleChunk": benchAssembleChunk
+}
+
+
+class Result:
+    """
+    Timing of one benchmark.
+
+    calls - number of calls in a loop
+    loops - number of loops in each run
+    times - seconds per loop for each run
+    """
+
+    def __init__(self, calls, loops, times):
+        self.calls = calls
+        self.loops = loops
+        self.times = times
+
+    def __repr__(self):
+        return "%d calls x %d loops, min %.6f s" % (self.calls, self.loops, self.min())
+
+    def min(self):
+        return min(self.times)
+
+    def median(self):
+        return statistics.median(self.times)
+
+    def spread(self):
+        return self.median() / self.min() - 1
+
+
+def timeLoops(loop, loops):
+    startTime = time.perf_counter()
+    for __ in range(loops):
+        loop()
+    return time.perf_counter() - startTime
+
+
+#
+# Run a loop for at least minTime seconds per run, repeat times. The garbage collector is off
+# while the runs are timed, as it is with timeit.
+#
+def measure(loop, calls, repeat=7, minTime=0.2):
+    loop()      # Warm up
+    loops = 1
+    while timeLoops(loop, loops) < minTime:
+        loops *= 2
+
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        times = [timeLoops(loop, loops) / loops for __ in range(repeat)]
+    finally:
+        if gcEnabled:
+            gc.enable()
+    return Result(calls, loops, times)
+
+
+def loadSamples():
+    samples = Samples()
+    for name in SOURCES:
+        samples.addSource(os.path.join(TEST_DIR, name))
+    return samples
+
+
+#
+# Run the benchmarks with the given names (all of them if there are none). Returns a dict of the
+# Result for each, keyed by name.
+#
+def run(names=(), repeat=7, minTime=0.2, samples=None):
+    if samples is None:
+        samples = loadSamples()
+
+    results = {}
+    for name, bench in benchmarks.items():
+        if names and name not in names:
+            continue
+        loop, calls = bench(samples)
+        results[name] = measure(loop, calls, repeat, minTime)
+    return results
+
+
+def printResults(results):
+    print("%-18s %7s %7s %12s %12s %10s %10s %7s" %
+          ("", "calls", "loops", "min us", "median us", "min ns", "median ns", "spread"))
+    for name, r in results.items():
+        print("%-18s %7d %7d %12.1f %12.1f %10.0f %10.0f %6.1f%%" %
+              (name, r.calls, r.loops * len(r.times), r.min() * 1e6, r.median() * 1e6,
+               r.min() / r.calls * 1e9, r.median() / r.calls * 1e9, r.spread() * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the assembler's hot paths on the inputs from the test sources.")
+
+    parser.add_argument("names", nargs="*", metavar="NAME",
+                        help="Benchmarks to run: %s (default is all of them)" % ", ".join(benchmarks))
+    parser.add_argument("-r", "--repeat", type=int, dest="repeat", default=7,
+                        help="Number of timed runs of each benchmark (default 7)")
+    parser.add_argument("-t", "--min-time", type=float, dest="minTime", default=0.2,
+                        help="Shortest time for a run, in seconds (default 0.2)")
+
+    options = parser.parse_args(argv)
+    for name in options.names:
+        if name not in benchmarks:
+            parser.error("unknown benchmark '%s'" % name)
+
+    samples = loadSamples()
+    print("Hot path micro-benchmarks, %s" % samples)
+    print("Times are per loop (us) and per call (ns), over %d runs\n" % options.repeat)
+
+    printResults(run(options.names, options.repeat, options.minTime, samples))
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+# Performance regression gate
+#
+# Runs the benchmark set and compares it with the baseline in test/perf_baseline.json. The exit
+# status is 1, with the slower phases named, if the throughput or the peak memory of any phase got
+# worse by more than is allowed.
+#
+# The benchmark set:
+#
+#   FIG_Forth    a full assembly of test/FIG_Forth.src, every phase (see scale_bench.py)
+#   gen20k       a full assembly of a 20,000 line generated source (see gensrc.py), every phase
+#   micro        the hot path micro-benchmarks (see micro_bench.py), each one a phase
+#
+# Each assembly is timed --repeat times, and the best time is used. Throughput is lines per second
+# for the assembly phases, and calls per second for the micro-benchmarks. The peak memory of each
+# assembly phase is the lower of two more runs with tracemalloc, as one run now and then peaks a few
+# hundred KB higher than the rest.
+#
+# The baseline can come from another machine, so throughput is normalized by the time a fixed loop
+# of plain Python takes (the calibration) before it is compared. The calibration is run just before
+# each case, so it also makes up for a machine that gets faster or slower as the gate runs.
+#
+# The threshold is noise-aware. The noise of a phase is how far the median of its times is above the
+# best, and a phase is only slower if its throughput dropped by more than the --tolerance, or twice
+# the noise (in the baseline or in this run, whichever is more), if that is larger. The noise term is
+# capped at NOISE_CAP, so a noisy run can't widen the limit until nothing fails. Peak memory is
+# allowed to grow by --memory-tolerance, plus MEMORY_SLACK bytes for the small phases.
+#
+# Timings on a busy machine can be off by more than that from one run of the gate to the next, so a
+# case that fails is run again, up to --retries times, keeping the best throughput of each phase. A
+# real regression stays slow every time.
+#
+# The micro-benchmarks are in the report, but they don't fail the gate. Each one is a few hundred
+# microseconds of work, and on a shared machine their rates move by 25-50% from one run to the next
+# with no change to the code, which is more than any allowance for noise can cover. The assemblies
+# run the same code paths for long enough to be measured.
+#
+# Run from anywhere:  bench/perf_gate.py               compare with the baseline
+#                     bench/perf_gate.py --update      write the baseline from this run
+#
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cosmacasm        # noqa: E402
+import gensrc           # noqa: E402
+import micro_bench      # noqa: E402
+import scale_bench      # noqa: E402
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test", "perf_baseline.json")
+BASELINE_VERSION = 1
+
+FIG_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test", "FIG_Forth.src")
+GENERATED_LINES = 20000
+
+MEMORY_SLACK = 64 * 1024
+
+NOISE_CAP = 0.25
+
+
+# Returns the best time, in seconds, of a fixed loop of dict, string and integer work, which is
+# what the assembler mostly does.
+def calibrate(repeat=5):
+    def work():
+        table = {}
+        for i in range(200000):
+            key = "L%d" % (i % 2000)
+            table[key] = table.get(key, 0) + (i & 0xFF)
+        return len(table)
+
+    times = []
+    for __ in range(repeat):
+        startTime = time.perf_counter()
+        work()
+        times.append(time.perf_counter() - startTime)
+    return round(min(times), 6)
+
+
+# The throughput and noise of a phase from its times.
+def phaseStats(count, times):
+    best = min(times)
+    if best <= 0:
+        return {"rate": 0.0, "noise": 0.0}
+    return {"rate": round(count / best, 1), "noise": round(statistics.median(times) / best - 1, 4)}
+
+
+#
+# Assemble a source repeat times, and twice more for the memory. Returns the stats for each phase,
+# and the whole assembly as "total".
+#
+def benchAssembly(path, repeat):
+    with open(path) as f:
+        lines = sum(1 for __ in f)
+
+    runs = [scale_bench.assemble(path) for __ in range(repeat)]
+    traced = [scale_bench.assemble(path, trackMemory=True) for __ in range(2)]
+
+    phases = {}
+    for name in cosmacasm.PHASES:
+        phases[name] = phaseStats(lines, [r.times[name] for r in runs])
+        phases[name]["peak"] = min(t.peaks[name] for t in traced)
+    phases["total"] = phaseStats(lines, [r.total for r in runs])
+    phases["total"]["peak"] = min(max(t.peaks.values()) for t in traced)
+    return {"lines": lines, "phases": phases}
+
+
+def benchFigForth(directory, repeat, minTime):
+    path = os.path.join(directory, "FIG_Forth.src")
+    shutil.copyfile(FIG_SOURCE, path)
+    return benchAssembly(path, repeat)
+
+
+def benchGenerated(directory, repeat, minTime):
+    path = os.path.join(directory, "gen20k.src")
+    with open(path, 'w') as f:
+        f.writelines(gensrc.SourceGenerator().generate(GENERATED_LINES))
+    return benchAssembly(path, repeat)
+
+
+def benchMicro(directory, repeat, minTime):
+    phases = {}
+    for name, result in micro_bench.run(repeat=repeat, minTime=minTime).items():
+        phases[name] = phaseStats(result.calls, result.times)
+    return {"phases": phases}
+
+
+# The benchmark set, name to the function that runs it.
+cases = {
+    "FIG_Forth": benchFigForth,
+    "gen20k": benchGenerated,
+    "micro": benchMicro
+}
+
+# The cases that are only reported, and never fail the gate.
+reportOnly = {"micro"}
+
+
+#
+# Run the benchmark set, or just the cases named. Returns the results, in the form they are kept in
+# the baseline.
+#
+def runBenchmarks(repeat, minTime, names=None, log=print):
+    results = {
+        "version": BASELINE_VERSION,
+        "python": platform.python_version(),
+        "cases": {}
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, bench in cases.items():
+            if names is None or name in names:
+                log("Running %s..." % name)
+                calibration = calibrate()
+                results["cases"][name] = bench(directory, repeat, minTime)
+                results["cases"][name]["calibration"] = calibration
+    return results
+
+
+#
+# Fold the results of a run again into the earlier ones, keeping the best of each. The rates of the
+# run again are scaled to the earlier calibration of the case.
+#
+def mergeResults(results, again):
+    for name, case in again["cases"].items():
+        scale = case["calibration"] / results["cases"][name]["calibration"]
+        phases = results["cases"][name]["phases"]
+        for phase, stats in case["phases"].items():
+            stats["rate"] *= scale
+            if stats["rate"] > phases[phase]["rate"]:
+                peak = phases[phase].get("peak")
+                phases[phase] = stats
+                if peak is not None:
+                    stats["peak"] = min(peak, stats["peak"])
+
+
+class Check:
+    """
+    The comparison of one measurement with the baseline.
+
+    case, phase - what was measured
+    metric - "rate" or "peak"
+    baseline, current - the values (rates normalized by the calibration)
+    change - the fraction it got worse by (negative if it got better)
+    limit - the most it is allowed to get worse by
+    gated - False if the case is only reported, and can't fail
+    """
+
+    def __init__(self, case, phase, metric, baseline, current, change, limit):
+        self.case = case
+        self.phase = phase
+        self.metric = metric
+        self.baseline = baseline
+        self.current = current
+        self.change = change
+        self.limit = limit
+        self.gated = case not in reportOnly
+
+    def __repr__(self):
+        return "%s %s %s %+.1f%% (limit %.1f%%)" % (self.case, self.phase, self.metric, self.change * 100, self.limit * 100)
+
+    def failed(self):
+        return self.gated and self.change > self.limit
+
+    def describe(self):
+        if self.metric == "rate":
+            return "%s %s is %.1f%% slower (allowed %.1f%%)" % (self.case, self.phase, self.change * 100, self.limit * 100)
+        return "%s %s peak memory is %.1f%% higher (allowed %.1f%%)" % (self.case, self.phase, self.change * 100, self.limit * 100)
+
+
+#
+# Compare the results with the baseline. Returns the list of Check for every measurement that is
+# in both.
+#
+def compare(baseline, results, tolerance, memoryTolerance):
+    checks = []
+
+    for case, base in baseline["cases"].items():
+        current = results["cases"].get(case)
+        if current is None:
+            continue
+        scale = current["calibration"] / base["calibration"]
+        for phase, b in base["phases"].items():
+            c = current["phases"].get(phase)
+            if c is None:
+                continue
+
+            # Rates as if this machine ran the calibration as fast as the baseline's did.
+            baseRate = b["rate"]
+            rate = c["rate"] * scale
+            change = 1 - rate / baseRate if baseRate > 0 else 0.0
+            limit = max(tolerance, min(2 * max(b["noise"], c["noise"]), NOISE_CAP))
+            checks.append(Check(case, phase, "rate", baseRate, rate, change, limit))
+
+            if "peak" in b and "peak" in c:
+                change = c["peak"] / b["peak"] - 1 if b["peak"] > 0 else 0.0
+                limit = memoryTolerance + MEMORY_SLACK / b["peak"] if b["peak"] > 0 else memoryTolerance
+                checks.append(Check(case, phase, "peak", b["peak"], c["peak"], change, limit))
+    return checks
+
+
+def printChecks(checks):
+    print("%-10s %-18s %-5s %14s %14s %8s %8s" % ("case", "phase", "", "baseline", "current", "worse", "allowed"))
+    for check in checks:
+        if check.metric == "rate":
+            values = "%12.0f/s %12.0f/s" % (check.baseline, check.current)
+        else:
+            values = "%11.2f MB %11.2f MB" % (check.baseline / 1e6, check.current / 1e6)
+        if check.gated:
+            allowed = "%7.1f%%" % (check.limit * 100)
+        else:
+            allowed = "%8s" % "(report)"
+        print("%-10s %-18s %-5s %s %7.1f%% %s%s" %
+              (check.case, check.phase, check.metric, values, check.change * 100, allowed,
+               "  ***" if check.failed() else ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the assembler's benchmarks with the stored baseline.")
+
+    parser.add_argument("--update", action="store_true", dest="update", default=False,
+                        help="Write the baseline from this run instead of comparing with it")
+    parser.add_argument("--baseline", dest="baseline", default=BASELINE_FILE, metavar="FILE",
+                        help="Baseline file (default is test/perf_baseline.json)")
+    parser.add_argument("-r", "--repeat", type=int, dest="repeat", default=5,
+                        help="Number of timed runs of each benchmark (default 5)")
+    parser.add_argument("-t", "--min-time", type=float, dest="minTime", default=0.1,
+                        help="Shortest time for a run of a micro-benchmark, in seconds (default 0.1)")
+    parser.add_argument("--retries", type=int, dest="retries", default=2,
+                        help="Number of times a case that fails is run again (default 2)")
+    parser.add_argument("--tolerance", type=float, dest="tolerance", default=0.15,
+                        help="Drop in throughput allowed, as a fraction, before the noise is counted (default 0.15)")
+    parser.add_argument("--memory-tolerance", type=float, dest="memoryTolerance", default=0.05,
+                        help="Growth in peak memory allowed, as a fraction (default 0.05)")
+
+    options = parser.parse_args(argv)
+
+    if not options.update:
+        try:
+            with open(options.baseline) as f:
+                baseline = json.load(f)
+        except OSError as err:
+            print("*** Unable to read the baseline '%s': %s" % (options.baseline, err.strerror))
+            return 2
+        if baseline.get("version") != BASELINE_VERSION:
+            print("*** The baseline is from another version of this script, run it with --update")
+            return 2
+
+    results = runBenchmarks(options.repeat, options.minTime)
+
+    if options.update:
+        with open(options.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write("\n")
+        print("Baseline written to %s" % options.baseline)
+        return 0
+
+    checks = compare(baseline, results, options.tolerance, options.memoryTolerance)
+    for __ in range(options.retries):
+        failed = set(check.case for check in checks if check.failed())
+        if not failed:
+            break
+        print("Running again: %s" % ", ".join(sorted(failed)))
+        mergeResults(results, runBenchmarks(options.repeat, options.minTime, failed))
+        checks = compare(baseline, results, options.tolerance, options.memoryTolerance)
+
+    print()
+    printChecks(checks)
+
+    failed = [check for check in checks if check.failed()]
+    if failed:
+        print()
+        for check in failed:
+            print("*** %s" % check.describe())
+        return 1
+
+    print()
+    print("No regressions.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Scaling benchmark
+#
+# Assembles generated sources (see gensrc.py) from 1,000 up to 1,000,000 lines, and reports the time
+# and peak memory of each phase of the assembly, through the Assembler's phaseHook: pass 1,
+# resolveSymbols, pass 2, and writing the output files (listing, hex and Intel hex).
+#
+# Each source is assembled twice: once for the times, and once with tracemalloc running for the
+# peak memory, since tracing slows everything down. The peak of a phase is the most memory traced
+# at any point during it, so it includes what the phases before it left behind. The expression
+# cache is emptied before each assembly, so each one starts out like a fresh run of cosmacasm.py.
+#
+# Run from anywhere:  bench/scale_bench.py [--no-memory] [SIZES...]       (sizes like 5000, 10k or 1M)
+#
+# The shape of the sources can be changed with the same options as gensrc.py, like --labels 0.5 or
+# --equ-chain 20.
+#
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cosmacasm        # noqa: E402
+import Expression       # noqa: E402
+import gensrc           # noqa: E402
+
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+
+
+class PhaseRecorder:
+    """
+    phaseHook that records how long each phase takes, and if tracemalloc is running, its peak memory.
+    The steps of the output phase are timed too, but their peaks are left in the phase's.
+
+    times - seconds for each phase and step, keyed by name
+    peaks - peak bytes traced during each phase, keyed by name
+    total - seconds for the whole assembly
+    startTimes - when each phase or step that hasn't ended yet started, keyed by name
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.peaks = {}
+        self.total = None
+        self.startTimes = {}
+
+    def __repr__(self):
+        return "%s  %s" % (self.times, self.peaks)
+
+    def __call__(self, name, starting):
+        tracing = tracemalloc.is_tracing() and name in cosmacasm.PHASES
+        if starting:
+            if tracing:
+                tracemalloc.reset_peak()
+            self.startTimes[name] = time.perf_counter()
+        else:
+            self.times[name] = time.perf_counter() - self.startTimes.pop(name)
+            if tracing:
+                self.peaks[name] = tracemalloc.get_traced_memory()[1]
+
+
+#
+# Assemble a source file, with its output files written next to it. Returns the PhaseRecorder.
+#
+def assemble(path, trackMemory=False):
+    Expression.cache = Expression.ExpressionCache()
+    recorder = PhaseRecorder()
+    asm = cosmacasm.Assembler(verbose=0, phaseHook=recorder)
+    gc.collect()
+
+    if trackMemory:
+        tracemalloc.start()
+    startTime = time.perf_counter()
+    try:
+        with open(path) as src:
+            asm.process(src)
+    finally:
+        recorder.total = time.perf_counter() - startTime
+        if trackMemory:
+            tracemalloc.stop()
+    return recorder
+
+
+#
+# Generate and assemble a source of each size. Returns a dict, keyed by size, of
+# ( timed PhaseRecorder, traced PhaseRecorder or None ).
+#
+def run(sizes, generator, trackMemory=True, log=print):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path = os.path.join(directory, "gen%d.src" % size)
+            with open(path, 'w') as f:
+                f.writelines(generator.generate(size))
+
+            log("Assembling %d lines..." % size)
+            timed = assemble(path)
+            traced = assemble(path, trackMemory=True) if trackMemory else None
+            results[size] = (timed, traced)
+    return results
+
+
+def printResults(results):
+    phases = cosmacasm.PHASES
+
+    print()
+    print("Time, ms")
+    print("%9s" % "lines" + "".join("%11s" % p for p in phases) + "%11s %13s" % ("total", "lines/s"))
+    for size, (timed, traced) in results.items():
+        columns = "".join("%11.1f" % (timed.times.get(p, 0) * 1000) for p in phases)
+        print("%9d%s%11.1f %13.0f" % (size, columns, timed.total * 1000, size / timed.total))
+
+    if all(traced is not None for timed, traced in results.values()):
+        print()
+        print("Peak memory, MB")
+        print("%9s" % "lines" + "".join("%11s" % p for p in phases) + "%13s" % "bytes/line")
+        for size, (timed, traced) in results.items():
+            peak = max(traced.peaks.values())
+            columns = "".join("%11.2f" % (traced.peaks.get(p, 0) / 1e6) for p in phases)
+            print("%9d%s%13.0f" % (size, columns, peak / size))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the assembler's phases on generated sources of increasing size.")
+
+    parser.add_argument("sizes", nargs="*", type=gensrc.line_count, metavar="SIZE",
+                        help="Numbers of lines (default is 1k 10k 100k 1M)")
+    parser.add_argument("--no-memory", action="store_false", dest="trackMemory", default=True,
+                        help="Skip the traced runs for peak memory")
+    gensrc.addGeneratorOptions(parser)
+
+    options = parser.parse_args(argv)
+
+    generator = gensrc.generatorFromOptions(options)
+    print("Scaling benchmark, generated sources: %s" % generator)
+
+    results = run(options.sizes or DEFAULT_SIZES, generator, options.trackMemory)
+    printResults(results)
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
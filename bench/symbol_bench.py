@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Symbol table benchmark
+#
+# Builds a symbol table of generated labels and equates with the slotted Symbol class, and with a
+# copy of the original one (a __dict__ per symbol, and a bytearray built for every label), and
+# compares the memory each table holds, the time to build it, and the time a full garbage
+# collection takes while it is alive.
+#
+# The equate bodies are compiled before anything is measured, so only the symbols are counted.
+#
+# Run from anywhere:  bench/symbol_bench.py [labels]
+#
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cosmacasm        # noqa: E402
+
+
+class LegacySymbol:
+    """The Symbol class before it had slots."""
+
+    def __init__(self, asm, name, body=None, value=None):
+        self.lineNumber = asm.lineNumber
+        self.name = name
+        self.value = value
+        self.body = body
+        self.ebytes = None
+        self.refs = ()
+
+        if body is not None:
+            self.type = "equ"
+            self.refs = asm.compileExpression(body).symbols()
+        elif value is not None:
+            self.type = "label"
+            self.ebytes = asm.buildBytes(value, 2)
+
+
+def symbolSource(count):
+    """Names and bodies for count labels and count / 4 equates, as the tokenizer would hand them over."""
+    labels = [("L%05d" % i, None, (i * 3) & 0xFFFF) for i in range(count)]
+    equates = [("E%05d" % i, "L%05d + %d" % (i, i & 0xFF), None) for i in range(count // 4)]
+    # Each name as a fresh string, the way it comes out of a source line.
+    return [("".join(list(name)), body, value) for name, body, value in labels + equates]
+
+
+def buildTable(symbolClass, asm, source):
+    table = {}
+    for lineNumber, (name, body, value) in enumerate(source):
+        asm.lineNumber = lineNumber
+        sym = symbolClass(asm, name, body=body, value=value)
+        table[sym.name] = sym
+    return table
+
+
+def measure(symbolClass, source):
+    asm = cosmacasm.Assembler(verbose=0, displayFlag=True)
+    for __, body, __ in source:
+        if body is not None:
+            asm.compileExpression(body)
+
+    gc.collect()
+    tracemalloc.start()
+    startTime = time.perf_counter()
+    table = buildTable(symbolClass, asm, source)
+    buildTime = time.perf_counter() - startTime
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # The same again untraced, for a fair time.
+    del table
+    gc.collect()
+    startTime = time.perf_counter()
+    table = buildTable(symbolClass, asm, source)
+    buildTime = time.perf_counter() - startTime
+
+    gcTime = min(timeGC() for __ in range(5))
+    del table
+    return size, buildTime, gcTime
+
+
+def timeGC():
+    startTime = time.perf_counter()
+    gc.collect()
+    return time.perf_counter() - startTime
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 40000
+    source = symbolSource(count)
+
+    print("Symbol table benchmark, %d labels and %d equates" % (count, count // 4))
+    results = {}
+    for name, symbolClass in (("legacy", LegacySymbol), ("slotted", cosmacasm.Symbol)):
+        size, buildTime, gcTime = measure(symbolClass, source)
+        results[name] = size
+        print("%-10s %10d bytes  %6.1f bytes/symbol   build %8.2f ms   gc %8.2f ms" %
+              (name, size, size / len(source), buildTime * 1000, gcTime * 1000))
+
+    print("Memory saved %.0f%%" % (100 - results["slotted"] * 100 / results["legacy"]))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv) or 0)
@@ -21,10 +21,6 @@
 #
 #
 # ------------------------------------------
-# sudo pip3 install bincopy
-# https://pypi.python.org/pypi/bincopy
-#
-# ------------------------------------------
 # Assemble 1802 source
 #
 # Produce hex file
@@ -44,77 +40,84 @@ import os
 import sys
 import argparse
 import re
+import time
+import difflib
+import pickle
 
 import Chunker
-import Parser
-
-import bincopy
-
-
-listingDest = None
-
-hexDest = None
-
-recDest = None
-
-address = 0
-
-passNumber = 1
-lineNumber = 0        # The line number being processed
-curLine = None        # Set to the full current line being processed
-
-symbols = {}
-
-BYTES_PER_LINE = 6
-
-binfile = None      # Program image
-
-conditionalStack = []    # stack of ConditionalBlock objects
-
-okToEmitCode = True        # This is set by the if/else/endif statements as needed.
-
-
-#
-# Configuration variables
-#
-verbose = 1
-sizeLimit = None
-programBase = 0
-displayFlag = False
-altSyntax = False
+import Expression
+import Trace
+import TokenCache
+import ListingWriter
+import OutputFormats
+import ProgramImage
+import SymbolFile
+import ObjectFile
+import Profile
 
 
 # ----------------------------------------------------------------
-# File read/write
+#
 # ----------------------------------------------------------------
 
 
-# ----------------------------------------------------------------
-#
-# ----------------------------------------------------------------
+# Symbol kinds
+SYMBOL_LABEL = 0
+SYMBOL_EQUATE = 1
+SYMBOL_IMPORTED = 2     # Read from a symbol file, already resolved
+
+symbolKindNames = ("label", "equ", "imp")
 
 
 class Symbol:
     """
-    name --
-    type - "label", "equ"
+    name - interned, so the symbol table and the compiled expressions share one copy
+    lineNumber - line the symbol is defined on (0 for an imported symbol)
+    value - the symbol's value, None until it is resolved
+    body - an equate's expression, None for a label or an imported symbol
+    kind - SYMBOL_LABEL, SYMBOL_EQUATE or SYMBOL_IMPORTED
+    refs - names of the symbols referenced by an equate's body
+    ebytes - bytes for the value as DC would emit it. A label's are made from its value when asked for,
+             an equate's are kept from evaluating its body (in valueBytes), and an imported symbol's
+             come from the file.
+
+    Programs can have tens of thousands of labels, so the attributes are slots, and a label only
+    holds its name, line number and value.
     """
 
-    def __init__(self, name, body=None, value=None):
-        self.lineNumber = lineNumber
-        self.name = name
+    __slots__ = ("lineNumber", "name", "value", "body", "kind", "refs", "valueBytes")
+
+    def __init__(self, asm, name, body=None, value=None):
+        self.lineNumber = asm.lineNumber
+        self.name = sys.intern(name)
         self.value = value
         self.body = body
-        self.ebytes = None
+        self.valueBytes = None
+        self.refs = ()
 
         if body is not None:
-            self.type = "equ"
+            self.kind = SYMBOL_EQUATE
+            self.refs = asm.compileExpression(body).symbols()
         elif value is not None:
             # A value means this was created from a label, which is a 16-bit address.
-            self.type = "label"
-            self.ebytes = buildBytes(value, 2)
+            self.kind = SYMBOL_LABEL
+            if value > 0xFFFF:
+                asm.bailout("Value too high error (16-bits), line %d, value %d" % (asm.lineNumber, value))
         else:
-            bailout("Symbols must have a body or a value when created '%s'" % self.name)
+            asm.bailout("Symbols must have a body or a value when created '%s'" % self.name)
+
+    # A symbol read from a symbol file, with its value and bytes already known.
+    @classmethod
+    def imported(cls, name, value, valueBytes):
+        sym = cls.__new__(cls)
+        sym.lineNumber = 0
+        sym.name = sys.intern(name)
+        sym.value = value
+        sym.body = None
+        sym.kind = SYMBOL_IMPORTED
+        sym.refs = ()
+        sym.valueBytes = valueBytes
+        return sym
 
     def __repr__(self):
         if self.value is None:
@@ -124,16 +127,34 @@ class Symbol:
         return "{ %16s  %4d  %5s  %8s  %s }" % \
             (self.name, self.lineNumber, self.type, v, self.body)
 
+    @property
+    def type(self):
+        return symbolKindNames[self.kind]
+
+    @property
+    def ebytes(self):
+        if self.kind == SYMBOL_LABEL:
+            return self.value.to_bytes(2, 'big')
+        return self.valueBytes
+
+    # Returns true if all of the symbols this one references already have values.
+    def refsResolved(self, symbols):
+        for name in self.refs:
+            sym = symbols.get(name)
+            if sym is None or sym.value is None:
+                return False
+        return True
+
     # Returns true if symbol was resolved
-    def resolve(self):
-        logDebug("Resolving symbol %s" % self.name)
+    def resolve(self, asm):
+        asm.trace.resolver("Resolving symbol %s", self.name)
         if self.value is None:
             if self.body is None:
-                bailout("Trying to resolve symbol '%s', but no body" % self.name)
-            self.value, self.ebytes = calcExpression(self.lineNumber, self.body)    # FRAK
+                asm.bailout("Trying to resolve symbol '%s', but no body" % self.name)
+            self.value, self.valueBytes = asm.calcExpression(self.lineNumber, self.body)    # FRAK
             if self.value is None:
                 return False
-        logDebug("Symbol '%s' resolved as %d - %s" % (self.name, self.value, self.ebytes))
+        asm.trace.resolver("Symbol '%s' resolved as %d - %s", self.name, self.value, self.ebytes)
         return True
 
 
@@ -166,1188 +187,2323 @@ class ConditionalBlock:
             return False
 
 
-class Error(Exception):
-    """Exception raised for errors.
-
-    Attributes:
-        message -- explanation of the error
+class Fixup:
+    """
+    An operand that could not be evaluated when its line was assembled in one-pass mode.
+    The bytes are patched once the symbol table is complete.
+
+    kind - key into fixupEncoders
+    param - opcode base or register needed by the encoder
+    body - the operand expression
+    address - address of the first byte to patch
+    width - number of bytes to patch
+    origin - address of the statement, which is what "$" means in the expression
+    lineNumber - line of the statement
+    target, offset - the line's bytearray, and where the patch goes in it
+    section - index of the Section the statement is in (object files)
     """
 
-    def __init__(self, message):
-        self.message = message
+    def __init__(self, kind, param, body, addr, width, origin, lineNumber):
+        self.lineNumber = lineNumber
+        self.kind = kind
+        self.param = param
+        self.body = body
+        self.address = addr
+        self.width = width
+        self.origin = origin
+        self.target = None
+        self.offset = None
+        self.section = None
 
+    def __repr__(self):
+        return "{ 0x%04X  %d  %4d  %s  %s }" % (self.address, self.width, self.lineNumber, self.kind, self.body)
 
-#
-# Value can be a number, or a string. If a string, it represents a symbol or equation that
-# will need to be resolved after the first pass completes.
-#
-def addSymbol(sym):
-    global symbols
-    if sym.name in symbols:
-        daddr = symbols[sym.name].lineNumber
-        bailout("Line: %d   Duplicate symbol '%s'.  Original definition at line %d" % (lineNumber, sym.name, daddr))
-    symbols[sym.name] = sym
-    sym.resolve()   # We try here because some can be resolved, but this may fail, which is fine.
-    # We do another resolve step after the first pass completes.
 
+# LineRecord kinds
+LINE_BLANK = "blank"        # Nothing but whitespace, comments, or a label
+LINE_EQUATE = "equ"
+LINE_SKIPPED = "skip"       # Inside a conditional block that is turned off
+LINE_CODE = "code"          # Directives and/or instructions
 
-#
-# An address from a label
-#
-# FOO
-#      ..code...
-#
-def addSymbolLabel(name, value):
-    sym = Symbol(name, value=value)
-    addSymbol(sym)
-    return sym
 
+class LineRecord:
+    """
+    How pass 1 handled a line of source, so pass 2 can produce the code without classifying it again.
+
+    kind - one of the LINE_ kinds
+    label - label to confirm the address of on pass 2 (or the name of an equate), or None
+    statements - tuple of ( op, operand ) pairs. The op is a mnemonic, "DC", "LOAD", "ORG", "PAGE", "END",
+                 "EQU" (with the equate's body), or None for a statement that only shows up in the listing.
+    size - number of code bytes produced on pass 1
+    cond - True if code was being emitted at the start of the line
+    """
 
-#
-# Add an equate
-#
-# We just store the body in this call, it will be resolved after the first pass completes.
-#
-def addSymbolEquate(name, body):
-    sym = Symbol(name, body=body)
-    addSymbol(sym)
-    return sym
+    __slots__ = ("kind", "label", "statements", "size", "cond")
 
+    def __init__(self, kind, label, statements, size, cond):
+        self.kind = kind
+        self.label = label
+        self.statements = statements
+        self.size = size
+        self.cond = cond
 
-def confirmSymbolAddress(name, value):
-    sym = symbols[name]
-    if value != sym.value:
-        bailout("Line: %d   Label '%s' had different address in each pass.  Pass #1=0x%04X, Pass #2=0x%04X" % (lineNumber, name, sym.value, value))
+    def __repr__(self):
+        return "{ %5s  %s  %s  %d  %s }" % (self.kind, self.label, self.statements, self.size, self.cond)
 
+    def __eq__(self, other):
+        return self.astuple() == other.astuple()
 
-#
-# Resolve all of the symbols in the symbol table
-#
-def resolveSymbols():
-    global symbols
+    def astuple(self):
+        return (self.kind, self.label, self.statements, self.size, self.cond)
 
-    if verbose > 1:
-        print("=========================== Resolve Symbols ==============================")
-    elif verbose > 0:
-        print("Resolve symbols...")
 
-    lastFailCount = None
-    while True:
-        logDebug("Symbols resolution pass")
-        failCount = 0
-        for key in symbols:
-            sym = symbols[key]
-            success = sym.resolve()
-            if success is False:
-                failCount += 1
-
-        if failCount == 0:
-            break
+_noCodeRecords = {}     # Shared records for lines with no label and no statements, keyed by ( kind, cond )
 
-        if lastFailCount is not None:
-            if failCount >= lastFailCount:
-                # This iteration through the table didn't improve. Do an error logging pass.
-                for key in symbols:
-                    sym = symbols[key]
-                    if sym.value is None:
-                        print("*** Line: %d  unable to resolve symbol '%s', expression is '%s'" % (sym.lineNumber, key, sym.body))
-                sys.exit(-1)
-
-        lastFailCount = failCount
-
-
-def dumpSymbols():
-    global symbols, listingDest
-    listingDest.write("\n\n------------------- Symbols by Name ----------------------\n")
-    keys = list(symbols.keys())
-    keys.sort()
-    for key in keys:
-        listingDest.write("%16s : %s\n" % (key, symbols[key]))
-
-    listingDest.write("\n\n")
-    for key in keys:
-        sym = symbols[key]
-        if sym.type == "label":
-            v = "%04X" % sym.value
-            listingDest.write("%s : %s\n" % (key, v))
-
-
-def buildBytes(value, numBytes):
-    if numBytes == 1:
-        if value > 0xFF:
-            bailout("Value too high error (8-bits), line %d, value %d" % (lineNumber, value))
-    elif numBytes == 2:
-        if value > 0xFFFF:
-            bailout("Value too high error (16-bits), line %d, value %d" % (lineNumber, value))
-    else:
-        bailout("Num bytes for conversion cannot exceed 2, line %d" % (lineNumber))
 
-    ebytes = bytearray()
-    if numBytes == 2:
-        high = (value >> 8) & 0xFF
-        ebytes.append(high)
+def noCodeRecord(kind, cond):
+    rec = _noCodeRecords.get((kind, cond))
+    if rec is None:
+        rec = LineRecord(kind, None, (), 0, cond)
+        _noCodeRecords[(kind, cond)] = rec
+    return rec
 
-    low = value & 0xFF
-    ebytes.append(low)
 
-    return ebytes
+# LineTokens kinds
+TOKENS_EQUATE = "equ"
+TOKENS_LABEL = "label"
+TOKENS_PLAIN = "plain"      # No label
+TOKENS_MACRO = "macro"      # Start of a macro definition, the label is its name and the body its parameters
 
 
-#
-# Obtain the value for a single token.
-#
-# Returns a tuple of ( value, bytes ). Will return None if a value could not be obtained.
-#
-# Examples:
-#   7EH
-#   99
-#   RATS
-#   12AA55FFH
-#   0AA12AA55FFH
-#
-def obtainTokenValue(token):
-    logDebug("Obtaining token value of '%s'" % token)
-    ebytes = bytearray()
+class LineTokens:
+    """
+    A line of source split into its label and chunks by tokenizeLine(). This only depends on the
+    text of the line and the syntax, so it is worked out once for each distinct line, and can be
+    kept in the token cache.
+
+    kind - one of the TOKENS_ kinds
+    label - the label, or the name of the equate, or None
+    body - the text after the label, or the equate's body
+    chunks - list of the chunks in the body, or None if it couldn't be chunked
+    error - the ChunkError raised chunking the body, or None
+    """
 
-    # Is this the "here" address?
-    if token == "$":
-        ebytes = buildBytes(address, 2)
-        return (address, ebytes)
+    __slots__ = ("kind", "label", "body", "chunks", "error")
 
-    # Look for a hexadecimal value. These can be very long.
-    m = re.match(r'([0-9][0-9a-fA-F]*)H$', token)
-    if m:
-        # Hex value
-        s = m.group(1)
-        logDebug("Obtained hex value for '%s'" % s)
-
-        # Convert to a sequence of bytes. (the DC directive needs this behavior)
-        ss = s
-        if len(s) & 1:
-            # Odd might mean leading zero
-            if s[0] == '0':
-                # Remove the leading zero
-                ss = s[1:]
-            else:
-                # Add a leading zero!
-                ss = "0" + ss
+    def __init__(self, kind, label, body, chunks, error):
+        self.kind = kind
+        self.label = label
+        self.body = body
+        self.chunks = chunks
+        self.error = error
 
-        while len(ss) > 0:
-            d = ss[:2]
-            ebytes.append(int(d, 16))
-            ss = ss[2:]
+    def __repr__(self):
+        return "{ %5s  %s  %s  %s }" % (self.kind, self.label, self.chunks, self.error)
 
-        return (int(s, 16), ebytes)
+    def astuple(self):
+        return (self.kind, self.label, self.body, self.chunks, self.error)
 
-    # Look for a decimal value.
-    m = re.match(r'([0-9]+)D?$', token)
-    if m:
-        # Always return just one byte because no real way to know how many bytes intended so at least be predictable?
-        s = m.group(1)
-        logDebug("Obtained dec value for '%s'" % s)
-        v = int(s, 10)
-        bc = 1
-        if v > 0xFF:
-            bc = 2
-        return (v, buildBytes(v, bc))
-
-    # Is it a Symbol?
-    if token in symbols:
-        logDebug("Obtained symbol value for token '%s'" % token)
-        sym = symbols[token]
-        return (sym.value, sym.ebytes)
-
-    # If we get here, we failed to
-    logDebug("Failed to obtain value for '%s'" % token)
-    return (None, None)
+    # Returns the chunks. The error from chunking the body is only raised once they are needed,
+    # since a line in a conditional block that is turned off never gets that far.
+    def getChunks(self):
+        if self.error is not None:
+            raise self.error
+        return self.chunks
 
 
-#
-# Parses a constant, symbol, or equation and returns the numeric value.
-#
-# Returns a tuple of ( value, ebytes ). Will return None if a value could not be obtained.
-#
-# If no value available, returns None.
-# If any component was an address, the address flag will be true.
-# If any component was a symbol, the literal flag will be false.
-# Bytes is returned only if the the expression was a single hex token.
-#
-# Examples:
-#   9
-#   0FBH
-#   14H
-#   0FC00H
-#   MICE
-#   BSCR-8
-#   ROMVAR + 1AH
-#    A.0(BEEP)
-#    MICE + HIGH START
-#    MICE + HIGH START + 4
-#
-def calcExpression(lineNumber, body):
-    logDebug("Calc expression '%s'" % body)
-    parser = Parser.Parser(body)
-    return evaluate(lineNumber, parser, 1)
+# Since equates are allowed to start in the first column, we have to test for them first to prevent
+# them from being treated as a label.
+_equateLine = re.compile(r'^\s*(\w+)\s+EQU\s+(.+)', re.IGNORECASE)
+_labelLine = re.compile(r'^(\w+):?\s*(.*)')
+_macroLine = re.compile(r'^\s*(\w+)\s+MACRO(?:\s+(.*)|\s*$)', re.IGNORECASE)
 
 
-#
-#
-#
-def evaluate(lineNumber, parser, maxBytes):
-    logDebug("+++ Evaluate '%s'" % parser.line)
+def tokenizeLine(line, altSyntax):
+    m = _equateLine.match(line)
+    if m:
+        kind, label, body = TOKENS_EQUATE, m.group(1), m.group(2)
+    else:
+        m = _macroLine.match(line)
+        # (Something like "DC MACRO" is a statement using a symbol called MACRO.)
+        if m and m.group(1).upper() not in statementTables[altSyntax]:
+            kind, label, body = TOKENS_MACRO, m.group(1), m.group(2) or ""
+        else:
+            m = _labelLine.match(line)
+            if m:
+                kind, label, body = TOKENS_LABEL, m.group(1), m.group(2)
+            else:
+                kind, label, body = TOKENS_PLAIN, None, line
 
-    accumValue = None
-    ebytes = None
+    # This does get rid of comments, which is important.
+    try:
+        chunks = Chunker.Chunker(body, semicolonComments=altSyntax).chunks
+        error = None
+    except Chunker.ChunkError as err:
+        chunks = None
+        error = err
 
-    while True:
-        v, ebytes = evalArg(lineNumber, parser, accumValue, maxBytes)
-        if v is not None:
-            logDebug("arg evaluated to %d - %s" % (v, ebytes))
-            accumValue = v
-            maxBytes = max(maxBytes, len(ebytes))
-        else:
-            break
+    return LineTokens(kind, label, body, chunks, error)
 
-    # recalculate the bytes
-    if accumValue is not None:
-        logDebug("Recalculate the byte array. Max bytes %d" % maxBytes)
-        ebytes = buildBytes(accumValue, maxBytes)
 
-    logDebug("--- Evaluate returning %s : %s" % (accumValue, ebytes))
-    return (accumValue, ebytes)
+MAX_MACRO_DEPTH = 32    # Macros calling macros, deeper than this is taken to be a macro calling itself
 
 
-# evalArg - Parse value, parenthesized expression, binary op, or unary op
-#
-# if accumValue is None:
-#             value - store it
-#             op - error
-#             unary - evalArg
-#             parens - eval subParser
-#
-# if accumValue is set:
-#             value - error
-#             op - parseValue
-#             unary - parseValue
-#             parens - error
-
-def evalArg(lineNumber, parser, accumValue, maxBytes):
-    s, parenthesized = parser.nextItem()
-    logDebug("Parsed '%s'" % s)
-    if s is None:
-        # Finished
-        return (None, None)
+class Macro:
+    """
+    A macro, defined by MACRO and ENDM.
+
+    The lines of the body are tokenized once, as they are defined, into templates: the text and
+    each part of the LineTokens are kept as a list of pieces, where a piece is either text or the
+    index of a parameter. Expanding the macro only joins the pieces back up with the arguments in
+    place of the parameters, nothing is chunked again.
+
+    name - name of the macro
+    params - names of the parameters, in order
+    lineNumber - line the MACRO is on
+    pattern - regex matching the parameter names as whole words, and quoted strings (which are
+              left alone), or None if there are no parameters. A parameter called A doesn't match
+              the A of the A.0 and A.1 operators.
+    lines - ( text, kind, label, body, chunks, error ) template for each line of the body
+    expansions - the expanded lines for each tuple of arguments the macro has been called with
+    """
 
-    if parenthesized:
-        if accumValue is None:
-            # Needs to be broken down further, recurse with the paren contents
-            subParser = Parser.Parser(s)
-            logDebug("calling evaluate for parenthesized expression '%s'" % s)
-            value, ebytes = evaluate(lineNumber, subParser, maxBytes)
-            if ebytes is not None:
-                maxBytes = max(maxBytes, len(ebytes))
-        else:
-            bailout("Line: %d   Expected operator but found parenthesized expression '%s'" % (lineNumber, s))
-    else:
-        # Single atomic token
+    __slots__ = ("name", "params", "lineNumber", "pattern", "lines", "expansions")
+
+    def __init__(self, name, params, lineNumber):
+        self.name = name
+        self.params = params
+        self.lineNumber = lineNumber
+        self.pattern = None
+        if params:
+            names = [r"A(?!\.[01]\b)" if p == "A" else p for p in params]
+            self.pattern = re.compile(r"'(?:[^'\\]|\\.)*'|\b(%s)\b" % "|".join(names))
+        self.lines = []
+        self.expansions = {}
 
-        # Check for single argument operators.
-        # A.0, A.1, HIGH, LOW
+    def __repr__(self):
+        return "%s(%s)  %d lines" % (self.name, ", ".join(self.params), len(self.lines))
+
+    # Add a line to the body, given its text and its LineTokens.
+    def addLine(self, line, tokens):
+        split = self.splitPieces
+        chunks = None if tokens.chunks is None else [split(chunk) for chunk in tokens.chunks]
+        label = None if tokens.label is None else split(tokens.label)
+        self.lines.append((split(line), tokens.kind, label, split(tokens.body), chunks, tokens.error))
+
+    # Returns the text broken into a list of pieces, with each parameter as its index.
+    def splitPieces(self, text):
+        if self.pattern is None:
+            return [text]
+
+        pieces = []
+        pos = 0
+        for m in self.pattern.finditer(text):
+            if m.group(1) is not None:
+                pieces.append(text[pos:m.start()])
+                pieces.append(self.params.index(m.group(1)))
+                pos = m.end()
+        pieces.append(text[pos:])
+        return pieces
 
-        if altSyntax is True:
-            ma = re.match(r'^(LOW|HIGH)$', s, re.IGNORECASE)
-        else:
-            ma = re.match(r'^A.([0-1])$', s)
+    #
+    # Returns the body with the arguments in place of the parameters, as a list of ( text, tokens ).
+    # Each set of arguments is only expanded once.
+    #
+    def expand(self, args):
+        lines = self.expansions.get(args)
+        if lines is None:
+            def join(pieces):
+                return "".join(args[p] if isinstance(p, int) else p for p in pieces)
 
-        if ma is not None:
-            # Unary Operator - Low or high byte of address
-            logDebug("Get address byte")
-            v, ebytes = evalArg(lineNumber, parser, accumValue, maxBytes)
-            maxBytes = 1
+            lines = []
+            for text, kind, label, body, chunks, error in self.lines:
+                tokens = LineTokens(kind, None if label is None else join(label), join(body),
+                                    None if chunks is None else [join(chunk) for chunk in chunks], error)
+                lines.append((join(text), tokens))
+            self.expansions[args] = lines
+        return lines
 
-            if altSyntax is True:
-                lowByte = s.upper() == 'LOW'
-            else:
-                lowByte = ma.group(1) == '0'
 
-            if lowByte is True:
-                value = v & 0xFF
-            else:
-                value = (v >> 8) & 0xFF
+_argument = re.compile(r"\s*((?:'(?:[^'\\]|\\.)*'|\((?:[^()]|\([^()]*\))*\)|[^,'()])*)\s*(,|$)")
 
-        elif re.match(r'\s*([\-\+\*\/])', s) is not None:
-            # Binary Operator
 
-            if accumValue is None:
-                bailout("Line: %d   Found binary operator '%s' but expected value or unary operator" % (lineNumber, s))
-            else:
-                v, ebytes = evaluate(lineNumber, parser, maxBytes)
-                if v is None:
-                    bailout("Line: %d   Bad argument for operator '%s'" % (lineNumber, s))
-
-                logDebug("Adding %d to %d" % (v, accumValue))
-                if s == '+':
-                    value = accumValue + v
-                if s == '-':
-                    value = accumValue - v
-                if s == '*':
-                    value = accumValue * v
-                if s == '/':
-                    value = accumValue / v
-
-                maxBytes = max(maxBytes, len(ebytes))
-        else:
-            # Not an operator, must be a value
+# Returns the tuple of arguments of a macro call, split at the commas that aren't in a quoted string
+# or parentheses. Returns None if the quotes or parentheses don't match up.
+def splitArguments(text):
+    text = text.strip()
+    if text == "":
+        return ()
 
-            if accumValue is None:
+    args = []
+    pos = 0
+    while True:
+        m = _argument.match(text, pos)
+        if m is None:
+            return None
+        args.append(m.group(1).strip())
+        if m.group(2) != ",":
+            break
+        pos = m.end()
+    return tuple(args)
 
-                # A character constant?
-                m = re.match(r"'(.)'", s)
-                if m:
-                    s = m.group(1)
-                    chars = list(s)
-                    value = ord(chars[0])
-                    maxBytes = max(maxBytes, 1)
-                else:
 
-                    value, ebytes = obtainTokenValue(s)
-                    logDebug("Token value is %s - %s" % (value, ebytes))
-                    if value is None:
-                        return (None, None)        # Could not obtain a value
-                    maxBytes = max(maxBytes, len(ebytes))
-            else:
-                bailout("Line: %d   Expected operator but found value '%s'" % (lineNumber, s))
+CACHE_VERSION = 2
 
-    # recalculate the bytes
-    if value is not None:
-        logDebug("Recalculate the byte array. Max bytes %d" % maxBytes)
-        ebytes = buildBytes(value, maxBytes)
 
-    logDebug("--- Evaluate returning %s : %s" % (value, ebytes))
-    return (value, ebytes)
+# Phases of an assembly, as they are given to the phaseHook. In one-pass and object builds pass 2 is
+# applying the fixups, and object builds have no resolve phase (the linker does that).
+PHASE_PASS1 = "pass1"
+PHASE_RESOLVE = "resolve"
+PHASE_PASS2 = "pass2"
+PHASE_OUTPUT = "output"
 
+PHASES = (PHASE_PASS1, PHASE_RESOLVE, PHASE_PASS2, PHASE_OUTPUT)
 
-# ----------------------------------------------------------------
-#
-# ----------------------------------------------------------------
+# Steps of the output phase, given to the phaseHook while it is in that phase: writing the listing,
+# the program image (or object file), and the symbol table at the end of the listing.
+STEP_LISTING = "listing"
+STEP_IMAGE = "image"
+STEP_SYMBOLS = "symbols"
 
 
-#
-# If a symbol is involved, return two bytes
-# If not, return bytes that the values represent.
-#
-# I think we count the hex digits to determine how many bytes to generate...
-#
-# Examples:
-#   DC RATS
-#   DC NOOP-7
-#   DC 085H, 'LIMI', 0D4H
-#   DC 8
-#
-def assembleDC(body):
-    global address
+class BuildCache:
+    """
+    What an incremental build found on each line of the source. It is saved next to the source
+    so the next incremental build only has to reprocess the lines that changed, or whose addresses
+    or symbols moved.
+
+    config - the options that change what a line produces
+    files - for each source file, keyed by its absolute path, a tuple of its lines and where each of
+            them is in the lists below (the first time it was included, if it was more than once)
+    records - LineRecord for each line
+    pass1Refs - the symbols each line looked up on pass 1, tuple of ( name, state ) pairs
+    addresses - the address at the start of each line on pass 2
+    code - the bytes each line produced, or None for lines with no code
+    pass2Refs - the symbols each line looked up on pass 2
+
+    A symbol's state is a tuple of its value and bytes, or None if it had no value.
+    """
 
-    logDebug("Assemble DC '%s'" % body)
+    def __init__(self, config):
+        self.config = config
+        self.files = {}
+        self.records = []
+        self.pass1Refs = []
+        self.addresses = []
+        self.code = []
+        self.pass2Refs = []
 
-    startAddr = address
+    #
+    # Returns the BuildCache saved in a file, or None if there isn't a usable one.
+    #
+    @staticmethod
+    def load(filename, config):
+        try:
+            with open(filename, 'rb') as f:
+                version, savedConfig, state = pickle.load(f)
+        except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+            return None
+
+        if version != CACHE_VERSION or savedConfig != config:
+            return None
+
+        files, records, pass1Refs, addresses, code, pass2Refs = state
+        cache = BuildCache(config)
+        cache.files = files
+        cache.records = [LineRecord(*rec) for rec in records]
+        cache.pass1Refs = pass1Refs
+        cache.addresses = addresses
+        cache.code = code
+        cache.pass2Refs = pass2Refs
+        return cache
+
+    # Only plain types are saved, so the file can be read whichever script wrote it.
+    def save(self, filename):
+        records = [rec.astuple() for rec in self.records]
+        state = (self.files, records, self.pass1Refs, self.addresses, self.code, self.pass2Refs)
+        with open(filename, 'wb') as f:
+            pickle.dump((CACHE_VERSION, self.config, state), f, pickle.HIGHEST_PROTOCOL)
 
-    bytes = bytearray()
+    #
+    # Returns a list with the index of the matching cached line for each of the given lines of a
+    # source file, or None for lines that are new or changed.
+    #
+    def matchLines(self, key, lines):
+        matches = [None] * len(lines)
+        if key not in self.files:
+            return matches
 
-    # Break up into chunks
-    chunks = body.split(',')
-    for chunk in chunks:
-        chunk = chunk.strip()
-        m = re.match(r"'(.+)'", chunk)
-        if m:
-            s = m.group(1)
-            chars = list(s)
-            for c in chars:
-                bytes.append(ord(c))
-        else:
-            v, ebytes = calcExpression(lineNumber, chunk)   # FRAK
-            # print( "Literal expression evaluated to %s %s" % ( v, ebytes ) )
-            # logDebug( ebytes )
-            if v is None:
-                if passNumber == 1:
-                    # Forward ref ok for 1st pass
-                    v = 0
-                    ebytes = b'\00\00'
-                else:
-                    bailout("Line: %d   Unresolved expression '%s'" % (lineNumber, chunk))
-            if ebytes is not None:
-                # Sequence of bytes
-                bytes.extend(ebytes)
+        cachedLines, indexes = self.files[key]
+        matcher = difflib.SequenceMatcher(None, cachedLines, lines, autojunk=False)
+        for a, b, size in matcher.get_matching_blocks():
+            matches[b:b + size] = indexes[a:a + size]
+        return matches
 
-    address += len(bytes)
-    return (startAddr, bytes)
 
+class Error(Exception):
+    """Exception raised for errors.
 
-def assembleLOAD(body):
-    """Process the LOAD macro.
-    Syntax is "LOAD Rn, <addr>
+    Attributes:
+        message -- explanation of the error
     """
-    global address
-
-    logDebug("Assemble LOAD '%s'" % body)
 
-    startAddr = address
-    bytes = bytearray()
+    def __init__(self, message):
+        self.message = message
 
-    m = re.match(r"\s*R([0-9A-F])\s*,\s*(.+)\s*", body)
-    if m:
-        r = int(m.group(1), 16)
-        exp = m.group(2)
-        a, _ = calcExpression(lineNumber, exp)
+    def __str__(self):
+        return self.message
 
-        if a is None:
-            if passNumber == 1:
-                # Forward ref ok for 1st pass
-                a = 0
-            else:
-                bailout("Line: %d   Unresolved expression '%s'" % (lineNumber, exp))
 
-        bytes.append(0xF8)
-        bytes.append(a // 256)
-        bytes.append(0xB0 + r)
+# Returns True if a line record has nothing but code (no directives).
+def isCodeOnly(rec, table):
+    for op, __ in rec.statements:
+        if op is None or table[op].kind < STMT_PSEUDO:
+            return False
+    return True
 
-        bytes.append(0xF8)
-        bytes.append(a % 256)
-        bytes.append(0xA0 + r)
-    else:
-        bailout("Line: %d   Invalid LOAD '%s'" % (lineNumber, body))
 
-    address += len(bytes)
-    return (startAddr, bytes)
+# The code that decides how source is tokenized, which is part of the token cache's key.
+def tokenizerFiles():
+    return (__file__, Chunker.__file__, Expression.__file__, Expression.Parser.__file__)
 
 
-def parseRegister(arg):
-    m = re.match(r'^R?([0-9A-F])', arg)
-    if m is not None:
-        return int(m.group(1), 16)
-    else:
-        if passNumber == 1:
-            # symbols not resolved yet
-            return 0
-        v, __ = calcExpression(lineNumber, arg)
-        # print( v, aflag, lflag, ebytes )
-        if v is not None:
-            if v < 0 or v > 15:
-                bailout("Line: %d  Invalid register value %d for '%s'" % (lineNumber, v, arg))
-            else:
-                return v
-        else:
-            bailout("Line: %d  Invalid register '%s'" % (lineNumber, arg))
-
-
-def assembleRegOp(opBase, arg, bytes):
-    r = parseRegister(arg)
-    bytes.append(opBase + r)
-
-
-def assembleLoadN(opBase, arg, bytes):
-    r = parseRegister(arg)
-    if r == 0:
-        bailout("Line: %d   Register for Load N operation cannot be zero" % lineNumber)
-    bytes.append(opBase + r)
-
-
-# Parses a value or an address. Address must use the A.0() or A.1() formats
-def assembleImmediate(opBase, arg, bytes):
-    if passNumber == 1:
-        bytes.append(0)
-        bytes.append(0)
-        return
-
-    v, __ = calcExpression(lineNumber, arg)
-    if v is None:
-        bailout("Line: %d   Invalid argument (immediate) '%s'" % (lineNumber, arg))
-    elif v > 0xFF:
-        bailout("Line: %d   Argument out of range, must be 0-255" % lineNumber)
-
-    bytes.append(opBase)
-    bytes.append(v)
-
-
-# Takes an address argument and emits the LSB
-# If the MSB differs from the immediate args address MSB, declare a branch range error
-def assembleShortBranch(opBase, arg, bytes):
-    if passNumber == 1:
-        bytes.append(0)
-        bytes.append(0)
-        return
-
-    v, __ = calcExpression(lineNumber, arg)    # FRAK
-    if v is None:
-        bailout("Line: %d   Invalid argument (short branch)" % lineNumber)
-    logDebug("SB arg addr is 0x%04X" % (address + 1))
-    a_page = (address + 1) >> 8 & 0xFF
-    b_page = (v) >> 8 & 0xFF
-    if a_page != b_page:
-        bailout("Line: %d   Branch out of range" % lineNumber)
-    bytes.append(opBase)
-    bytes.append(v & 0xFF)
-
-
-# Takes an address argument and emits the MSB and LSB
-def assembleLongBranch(opBase, arg, bytes):
-    if passNumber == 1:
-        bytes.append(0)
-        bytes.append(0)
-        bytes.append(0)
-        return
-
-    v, __ = calcExpression(lineNumber, arg)    # FRAK
-    if v is None:
-        bailout("Line: %d   Invalid argument (long branch)" % lineNumber)
-    bytes.append(opBase)
-    bytes.append(v >> 8 & 0xFF)
-    bytes.append(v & 0xFF)
-
-
-# Parses an integer value 1-7
-def assembleInputOutput(opBase, arg, bytes):
-    m = re.match(r'^([0-7]$)', arg)
-    if m:
-        bytes.append(opBase + int(m.group(1), 10))
-    else:
-        bailout("Line: %d   IO port must be 1-7" % lineNumber)
+def isRegisterLiteral(arg):
+    return re.match(r'^R?([0-9A-F])$', arg) is not None
 
 
-#  mnemonic : [opcode], [func]
-#  opcode may be a base opcode used by the func (e.g. DEC)
-#  if no func, opcode used as-is
-opTable = {
-    "IDLE": (0x00, None),
-    "LDN": (0x00, assembleLoadN),
-    "INC": (0x10, assembleRegOp),
-    "DEC": (0x20, assembleRegOp),
-
-    "BR": (0x30, assembleShortBranch),
-    "BQ": (0x31, assembleShortBranch),
-    "BZ": (0x32, assembleShortBranch),
-    "BDF": (0x33, assembleShortBranch),
-    "BPZ": (0x33, assembleShortBranch),
-    "BGE": (0x33, assembleShortBranch),
-    "B1": (0x34, assembleShortBranch),
-    "B2": (0x35, assembleShortBranch),
-    "B3": (0x36, assembleShortBranch),
-    "B4": (0x37, assembleShortBranch),
-    "NBR": (0x38, None),
-    "SKP": (0x38, None),
-    "BNQ": (0x39, assembleShortBranch),
-    "BNZ": (0x3A, assembleShortBranch),
-    "BNF": (0x3B, assembleShortBranch),
-    "BM": (0x3B, assembleShortBranch),
-    "BL": (0x3B, assembleShortBranch),
-    "BN1": (0x3C, assembleShortBranch),
-    "BN2": (0x3D, assembleShortBranch),
-    "BN3": (0x3E, assembleShortBranch),
-    "BN4": (0x3F, assembleShortBranch),
+# Returns True if the expression uses "$", the address of the statement.
+def usesHere(body):
+    return "$" in re.sub(r"'.'", "", body)
 
-    "LDA": (0x40, assembleRegOp),
 
-    "STR": (0x50, assembleRegOp),
+# ----------------------------------------------------------------
+# Statement classification
+# ----------------------------------------------------------------
 
-    "IRX": (0x60, None),
+STMT_CONDITIONAL = 0    # IF, ELSE, ENDI - processed even inside a conditional block that is turned off
+STMT_DIRECTIVE = 1      # ORG, PAGE, END
+STMT_PSEUDO = 2         # DC (DB in the alternate syntax), LOAD
+STMT_INSTRUCTION = 3    # Everything in the opTable
 
-    "OUT": (0x60, assembleInputOutput),    # 61 - 67
-    # 68 Reserved
-    "INP": (0x68, assembleInputOutput),    # 69 - 6F
 
-    "RET": (0x70, None),
-    "DIS": (0x71, None),
-    "LDXA": (0x72, None),
-    "STXD": (0x73, None),
-    "ADC": (0x74, None),
-    "SDB": (0x75, None),
-    "SHRC": (0x76, None),
-    "RSHR": (0x76, None),
-    "SMB": (0x77, None),
-    "SAV": (0x78, None),
-    "MARK": (0x79, None),
-    "REQ": (0x7A, None),
-    "SEQ": (0x7B, None),
-    "ADCI": (0x7C, assembleImmediate),
-    "SDBI": (0x7D, assembleImmediate),
-    "SHLC": (0x7E, None),
-    "RSHL": (0x7E, None),
-    "SMBI": (0x7F, assembleImmediate),
+class Statement:
+    """
+    Entry in the statement table.
+
+    kind - one of the STMT_ values. Directives (conditional or not) are only recognized as the
+           first chunk of a line, and are not case sensitive.
+    handler - called with the Assembler and the operand text. Pseudo-ops and instructions return
+              a tuple of starting address and a byte array of the machine code.
+    args - called with the whitespace following the first word and the rest of the chunk, returns
+           the operand text, or None if the chunk isn't in the form the statement needs.
+    """
 
-    "GLO": (0x80, assembleRegOp),
-    "GHI": (0x90, assembleRegOp),
+    __slots__ = ("kind", "handler", "args")
 
-    "PLO": (0xA0, assembleRegOp),
-    "PHI": (0xB0, assembleRegOp),
+    def __init__(self, kind, handler, args):
+        self.kind = kind
+        self.handler = handler
+        self.args = args
 
-    "LBR": (0xC0, assembleLongBranch),
-    "LBQ": (0xC1, assembleLongBranch),
-    "LBZ": (0xC2, assembleLongBranch),
-    "LBDF": (0xC3, assembleLongBranch),
-    "NOP": (0xC4, None),
-    "LSNQ": (0xC5, None),
-    "LSNZ": (0xC6, None),
-    "LSNF": (0xC7, None),
-    "LSKP": (0xC8, None),
-    "NLBR": (0xC8, None),
-    "LBNQ": (0xC9, assembleLongBranch),
-    "LBNZ": (0xCA, assembleLongBranch),
-    "LBNF": (0xCB, assembleLongBranch),
-    "LSIE": (0xCC, None),
-    "LSQ": (0xCD, None),
-    "LSZ": (0xCE, None),
-    "LSDF": (0xCF, None),
 
-    "SEP": (0xD0, assembleRegOp),
+# Argument forms
+def argsRequired(sep, rest):
+    return rest if sep != "" else None
 
-    "SEX": (0xE0, assembleRegOp),
 
-    "LDX": (0xF0, None),
-    "OR": (0xF1, None),
-    "AND": (0xF2, None),
-    "XOR": (0xF3, None),
-    "ADD": (0xF4, None),
-    "SD": (0xF5, None),
-    "SHR": (0xF6, None),
-    "SM": (0xF7, None),
-    "LDI": (0xF8, assembleImmediate),
-    "ORI": (0xF9, assembleImmediate),
-    "ANI": (0xFA, assembleImmediate),
-    "XRI": (0xFB, assembleImmediate),
-    "ADI": (0xFC, assembleImmediate),
-    "SDI": (0xFD, assembleImmediate),
-    "SHL": (0xFE, None),
-    "SMI": (0xFF, assembleImmediate)
-}
+def argsNone(sep, rest):
+    return "" if rest == "" else None
 
 
-# Returns a tuple of starting address and a byte array of the machine code.
-def assembleChunk(chunk):
-    global address
+def argsAny(sep, rest):
+    return rest
 
-    # Get the opcode and optional argument
-    m = re.match(r'^(\w+)\s*(.*)', chunk)
-    if m is None:
-        bailout("Line: %d  Invalid line '%s'" % (lineNumber, chunk))
-
-    bytes = bytearray()
-    startAddr = address
-
-    opcode = m.group(1)
-    mnemonic = m.group(1)
-    arg = m.group(2)
-    logDebug("Chunk '%s'  opcode '%s'  arg '%s'" % (chunk, opcode, arg))
-
-    if mnemonic in opTable:
-        opbase, func = opTable[mnemonic]
-        if func:
-            logDebug("Calling opcode func {0}".format(func))
-            func(opbase, arg, bytes)
-        elif opbase is not None:
-            logDebug("Appending opbase {0}".format(opbase))
-            bytes.append(opbase)
-        else:
-            bailout("Internal error - invalid table for opcode '%s'" % mnemonic)
-    else:
-        bailout("Line: %d  Invalid mnemonic '%s'" % (lineNumber, chunk))
 
-    address += len(bytes)
-    return (startAddr, bytes)
+_firstWord = re.compile(r'(\w+)(\s*)(.*)')
 
+# Any other first word starting with one of these is that directive, as in "PAGE2" or "END.".
+_prefixDirectives = ("PAGE", "END")
 
-# ----------------------------------------------------------------
-#
-# ----------------------------------------------------------------
 
-# Emit the results of a line of code.
-#
-# This will also deal with breaking the hex bytes flow to the next line if the width is too great.
-#
-def emitCode(startAddr, bytes):
-    global binfile
+class Assembler:
+    """
+    One assembly. All of the state lives here, so any number of these can be used in one process.
+
+    Configuration:
+    sizeLimit - maximum size of the program image, or None
+    programBase - base offset of the program image
+    altSyntax - True for the alternate assembler syntax
+    onePass - True to assemble in a single pass, patching forward references afterwards
+    objectMode - True to write a relocatable object file for cosmaclink.py instead of the program
+                 image. The assembly is done in one pass, and the fixups are left for the linker.
+    verbose - 0 quiet, 1 verbose, 2 noisy
+    displayFlag - True to send the output to the terminal instead of files
+    writeDeps - True to write a make dependency file next to the source
+    writeListing - False to skip producing the listing
+    formats - names of the OutputFormats to write the program image in
+    exportSymbols - True to write the program's symbols to a symbol file next to the source
+    importFiles - symbol files whose symbols are defined before the source is assembled
+    incremental - True to save a BuildCache next to the source, and use the last one to only
+                  reprocess what changed
+    cacheTokens - True to keep the tokenized source in the TokenCache, and use it when the source
+                  hasn't changed
+    phaseHook - called with the name of each phase of the assembly (one of PHASES) and True as it
+                starts, then False when it ends. It is called the same way for the steps of the
+                output phase (STEP_LISTING and so on), between the start and end of the phase.
+                None for no hook.
+
+    State:
+    address - the address being assembled
+    passNumber, lineNumber - where the assembly is
+    curLine - the full current line being processed
+    symbols - symbol table, name to Symbol
+    image - the ProgramImage
+    conditionalStack - stack of ConditionalBlock objects
+    okToEmitCode - this is set by the if/else/endif statements as needed
+    fixups - Fixup objects for operands waiting on the symbol table (one-pass mode)
+    deferredCode - ( address, bytes, lineNumber ) of the code held back from the program image until
+                   the fixups are applied (one-pass mode)
+    listing - the ListingWriter, or None if there is no listing
+    sections - the ObjectFile.Section objects of the module (object files)
+    sectionIndex - index of the section being assembled into (object files)
+    symbolSections - the index of the section each symbol was defined in, keyed by name (object files)
+    lineRecords - LineRecord for each source line, built on pass 1 and replayed on pass 2
+    sourceLines - ( text, filename, lineNumber ) for each source line, in the same order as the
+                  records. Included files are spliced in after their INCLUDE line.
+    sourceName - name of the main source file
+    fileName - name of the source file the current line is in
+    sourceFiles - the lines of each included file, keyed by its absolute path, read once per run
+    includeStack - absolute paths of the files being processed on pass 1, to catch recursion
+    pendingInclude - ( filename, lines ) of a file to process after the current line
+    macros - the Macro objects defined so far, keyed by name
+    macroDef - the Macro whose body is being read, between its MACRO and ENDM
+    pendingExpansion - the ( text, tokens ) lines of a macro call to process after the current line
+    macroDepth - number of macro expansions being processed, one inside the other
+    dependencies - the main source file, every file it included, and the imported symbol files
+    importedFrom - the symbol file each imported symbol came from, keyed by name
+    resolveStats - statistics from the last resolveSymbols() call
+    chunkCount - number of chunks processed (for --profile)
+    calcCount - number of calcExpression() calls (for --profile)
+    cacheFilename - where the BuildCache is kept (incremental builds)
+    refLog - the symbols looked up while processing a line, name to state (incremental builds)
+    reprocessed - number of lines the last incremental build processed again
+    lineTokens - LineTokens for each distinct line of source, keyed by its text
+    expressions - compiled expressions, keyed by their text, for the token cache to keep (only filled in
+                  with cacheTokens)
+    tokenCache - the TokenCache the source is kept in, or None
+    tokenCacheHit - True if the tokenized source was found in the cache
+    trace - the Trace.Tracers for this assembly's debug output, all off until they are enabled
+    """
 
-    if startAddr < programBase:
-        bailout("Data written to address 0x%04X below the program base of 0x%04X" % (startAddr, programBase))
+    def __init__(self, sizeLimit=None, programBase=0, altSyntax=False, onePass=False, verbose=1, displayFlag=False,
+                 incremental=False, cacheTokens=False, writeDeps=False, writeListing=True,
+                 formats=OutputFormats.DEFAULT_FORMATS, exportSymbols=False, importFiles=(), objectMode=False,
+                 phaseHook=None):
+        self.sizeLimit = sizeLimit
+        self.programBase = programBase
+        self.altSyntax = altSyntax
+        self.onePass = onePass or objectMode
+        self.objectMode = objectMode
+        self.verbose = verbose
+        self.displayFlag = displayFlag
+        self.incremental = incremental
+        self.cacheTokens = cacheTokens
+        self.writeDeps = writeDeps
+        self.writeListing = writeListing
+        self.formats = formats
+        self.exportSymbols = exportSymbols
+        self.importFiles = importFiles
+        self.phaseHook = phaseHook
+
+        self.listingDest = None
+        self.listing = None
+        self.outputDests = []
+
+        self.address = 0
+        self.passNumber = 1
+        self.lineNumber = 0
+        self.curLine = None
+        self.symbols = {}
+        self.resolveStats = None
+        self.chunkCount = 0
+        self.calcCount = 0
+        self.image = ProgramImage.ProgramImage()
+        self.conditionalStack = []
+        self.okToEmitCode = True
+        self.fixups = []
+        self.deferredCode = None
+        self.sections = []
+        self.sectionIndex = None
+        self.symbolSections = {}
+        self.lineRecords = []
+        self.sourceLines = []
+        self.sourceName = None
+        self.fileName = None
+        self.sourceFiles = {}
+        self.includeStack = []
+        self.pendingInclude = None
+        self.macros = {}
+        self.macroDef = None
+        self.pendingExpansion = None
+        self.macroDepth = 0
+        self.dependencies = []
+        self.importedFrom = {}
+        self.cacheFilename = None
+        self.refLog = None
+        self.reprocessed = 0
+        self.lineTokens = {}
+        self.expressions = {}
+        self.tokenCache = None
+        self.tokenCacheHit = False
+        self.trace = Trace.Tracers()
 
-    # Add bytes to the program image
-    binfile.add_binary(bytes, startAddr)
-
-    hexStr = ""
-    overflow = False
-    for byte in bytes:
-        pair = "%02X" % byte
-        hexStr += pair
-        if len(hexStr) >= (BYTES_PER_LINE * 2):
-            hexStr += ';'
-            if overflow is False:
-                emitListing("%04X %-14s %04d  %s" % (startAddr, hexStr, lineNumber, curLine))
-                hexStr = ""
-                overflow = True
-            else:
-                emitListing("%04X %s" % (startAddr, hexStr))
-                hexStr = ""
-            startAddr += BYTES_PER_LINE
-
-    if hexStr != "":
-        hexStr += ';'
-        if overflow is False:
-            emitListing("%04X %-14s %04d  %s" % (startAddr, hexStr, lineNumber, curLine))
-        else:
-            emitListing("%04X %s" % (startAddr, hexStr))
+    #
+    # Value can be a number, or a string. If a string, it represents a symbol or equation that
+    # will need to be resolved after the first pass completes.
+    #
+    def addSymbol(self, sym):
+        if sym.name in self.importedFrom:
+            self.bailout("Line: %d   Duplicate symbol '%s'.  Original definition in symbol file %s" % (self.lineNumber, sym.name, self.importedFrom[sym.name]))
+        if sym.name in self.symbols:
+            daddr = self.symbols[sym.name].lineNumber
+            self.bailout("Line: %d   Duplicate symbol '%s'.  Original definition at line %d" % (self.lineNumber, sym.name, daddr))
+        self.symbols[sym.name] = sym
+        if self.objectMode:
+            self.symbolSections[sym.name] = self.sectionIndex
+        if sym.refsResolved(self.symbols):
+            # Resolve now if we can, since "$" is the address of this line.
+            sym.resolve(self)
+        # The rest are resolved after the first pass completes.
 
+    #
+    # An address from a label
+    #
+    # FOO
+    #      ..code...
+    #
+    def addSymbolLabel(self, name, value):
+        sym = Symbol(self, name, value=value)
+        self.addSymbol(sym)
+        return sym
 
-def processEquate(label, body):
-    body = body.strip()
+    #
+    # Add an equate
+    #
+    # We just store the body in this call, it will be resolved after the first pass completes.
+    #
+    def addSymbolEquate(self, name, body):
+        sym = Symbol(self, name, body=body)
+        self.addSymbol(sym)
+        return sym
 
-    if passNumber == 1:
-        addSymbolEquate(label, body)
-    emitNoCode()
+    #
+    # Define the symbols from each of the symbol files, before the source is assembled.
+    #
+    def importSymbols(self):
+        for filename in self.importFiles:
+            self.fileName = filename
+            try:
+                with open(filename) as f:
+                    records = SymbolFile.readSymbols(f)
+            except OSError as err:
+                self.bailout("Unable to read symbol file: %s" % err.strerror)
+            except SymbolFile.SymbolFileError as err:
+                self.bailout(str(err))
+
+            for name, kind, value, valueBytes in records:
+                if name in self.importedFrom:
+                    self.bailout("Symbol '%s' is also defined in symbol file %s" % (name, self.importedFrom[name]))
+                self.symbols[name] = Symbol.imported(name, value, valueBytes)
+                self.importedFrom[name] = filename
+
+            self.dependencies.append(filename)
+            self.logVerbose("Imported %d symbols from %s" % (len(records), filename))
+        self.fileName = self.sourceName
 
+    #
+    # Write the symbols defined by the program to a symbol file. Imported symbols are left out,
+    # they belong to the files they came from.
+    #
+    def writeSymbolFile(self, filename):
+        records = []
+        for sym in self.symbols.values():
+            if sym.kind == SYMBOL_LABEL:
+                records.append((sym.name, SymbolFile.LABEL, sym.value, None))
+            elif sym.kind == SYMBOL_EQUATE:
+                records.append((sym.name, SymbolFile.EQUATE, sym.value, sym.ebytes))
+
+        with open(filename, 'w') as f:
+            SymbolFile.writeSymbols(f, records, os.path.basename(self.sourceName))
+
+    def confirmSymbolAddress(self, name, value):
+        sym = self.symbols[name]
+        if value != sym.value:
+            self.bailout("Line: %d   Label '%s' had different address in each pass.  Pass #1=0x%04X, Pass #2=0x%04X" % (self.lineNumber, name, sym.value, value))
 
-def processOrigin(body):
-    global address
+    #
+    # Resolve all of the symbols in the symbol table
+    #
+    # The equates are resolved in dependency order, walking each one's references depth first
+    # so that every symbol is evaluated exactly once. A reference back to a symbol already on
+    # the walk is a circular definition.
+    #
+    def resolveSymbols(self):
+        if self.verbose > 1:
+            print("=========================== Resolve Symbols ==============================")
+        elif self.verbose > 0:
+            print("Resolve symbols...")
+
+        startTime = time.perf_counter()
+        resolvedCount = 0
+        walkCount = 0
+        maxDepth = 0
+        depths = {}         # Name to dependency depth, for the symbols resolved here
+        failed = set()
+
+        for sym in list(self.symbols.values()):
+            if sym.value is not None or sym.name in failed:
+                continue
 
-    v, __ = calcExpression(lineNumber, body)
-    if v is None:
-        bailout("Line: %d  Unable to resolve origin address for '%s'" % (lineNumber, body))
+            # Each stack entry is a symbol and an iterator over the names it references.
+            walkCount += 1
+            stack = [(sym, iter(sym.refs))]
+            onStack = {sym.name}
+            while stack:
+                cur, refs = stack[-1]
+                name = next(refs, None)
+
+                if name is None:
+                    # All references visited, now this one can be evaluated.
+                    stack.pop()
+                    onStack.discard(cur.name)
+                    if cur.resolve(self) is True:
+                        resolvedCount += 1
+                        depth = 1 + max([depths.get(n, 0) for n in cur.refs], default=0)
+                        depths[cur.name] = depth
+                        maxDepth = max(maxDepth, depth)
+                    else:
+                        failed.add(cur.name)
+                    continue
+
+                dep = self.symbols.get(name)
+                if dep is None or dep.value is not None or dep.name in failed:
+                    # Undefined symbols leave the expression unresolved, which is reported below.
+                    continue
+
+                if dep.name in onStack:
+                    path = [s.name for s, __ in stack]
+                    path = path[path.index(dep.name):] + [dep.name]
+                    self.bailout("Line: %d  circular reference for symbol '%s': %s" % (dep.lineNumber, dep.name, " -> ".join(path)))
+
+                stack.append((dep, iter(dep.refs)))
+                onStack.add(dep.name)
+
+        self.resolveStats = {"resolved": resolvedCount, "walks": walkCount, "depth": maxDepth, "seconds": time.perf_counter() - startTime}
+        self.logVerbose("Resolved %d symbols, dependency depth %d, %.1f ms" %
+                        (resolvedCount, maxDepth, self.resolveStats["seconds"] * 1000))
+
+        if failed:
+            errors = []
+            for key in self.symbols:
+                sym = self.symbols[key]
+                if sym.value is None:
+                    errors.append("Line: %d  unable to resolve symbol '%s', expression is '%s'" % (sym.lineNumber, key, sym.body))
+            self.bailout("\n*** ".join(errors))
+
+    def dumpSymbols(self):
+        out = ["\n\n------------------- Symbols by Name ----------------------\n"]
+        keys = [name for name in self.symbols if name not in self.importedFrom]     # Imported ones are in their own listing
+        keys.sort()
+        for key in keys:
+            out.append("%16s : %s\n" % (key, self.symbols[key]))
+
+        out.append("\n\n")
+        for key in keys:
+            sym = self.symbols[key]
+            if sym.kind == SYMBOL_LABEL:
+                v = "%04X" % sym.value
+                out.append("%s : %s\n" % (key, v))
+
+        self.listing.write("".join(out))
+
+    def buildBytes(self, value, numBytes):
+        if numBytes == 1:
+            if value > 0xFF:
+                self.bailout("Value too high error (8-bits), line %d, value %d" % (self.lineNumber, value))
+        elif numBytes == 2:
+            if value > 0xFFFF:
+                self.bailout("Value too high error (16-bits), line %d, value %d" % (self.lineNumber, value))
+        else:
+            self.bailout("Num bytes for conversion cannot exceed 2, line %d" % (self.lineNumber))
 
-    emitNoCode()
-    address = v
+        ebytes = bytearray()
+        if numBytes == 2:
+            high = (value >> 8) & 0xFF
+            ebytes.append(high)
 
+        low = value & 0xFF
+        ebytes.append(low)
 
-def processPage():
-    global address
+        return ebytes
 
-    emitNoCode()
+    #
+    # Obtain the value for a single token.
+    #
+    # Returns a tuple of ( value, bytes ). Will return None if a value could not be obtained.
+    #
+    # Examples:
+    #   7EH
+    #   99
+    #   RATS
+    #   12AA55FFH
+    #   0AA12AA55FFH
+    #
+    def obtainTokenValue(self, token):
+        self.trace.evaluator("Obtaining token value of '%s'", token)
+        ebytes = bytearray()
 
-    if address & 0xFF != 0:
-        # Adjust the address to the next 256-byte page start
-        page = address >> 8 & 0xFF
-        page += 1
+        # Is this the "here" address?
+        if token == "$":
+            ebytes = self.buildBytes(self.address, 2)
+            return (self.address, ebytes)
 
-        address = page << 8
+        # Look for a hexadecimal value. These can be very long.
+        m = Expression.HEX_LITERAL.match(token)
+        if m:
+            # Hex value
+            s = m.group(1)
+            self.trace.evaluator("Obtained hex value for '%s'", s)
+
+            # Convert to a sequence of bytes. (the DC directive needs this behavior)
+            ss = s
+            if len(s) & 1:
+                # Odd might mean leading zero
+                if s[0] == '0':
+                    # Remove the leading zero
+                    ss = s[1:]
+                else:
+                    # Add a leading zero!
+                    ss = "0" + ss
 
+            while len(ss) > 0:
+                d = ss[:2]
+                ebytes.append(int(d, 16))
+                ss = ss[2:]
 
-def processIf(body):
-    global okToEmitCode
+            return (int(s, 16), ebytes)
 
-    emitNoCode()
+        # Look for a decimal value.
+        m = Expression.DEC_LITERAL.match(token)
+        if m:
+            # Always return just one byte because no real way to know how many bytes intended so at least be predictable?
+            s = m.group(1)
+            self.trace.evaluator("Obtained dec value for '%s'", s)
+            v = int(s, 10)
+            bc = 1
+            if v > 0xFF:
+                bc = 2
+            return (v, self.buildBytes(v, bc))
+
+        # Is it a Symbol?
+        if token in self.symbols:
+            self.trace.evaluator("Obtained symbol value for token '%s'", token)
+            sym = self.symbols[token]
+            if self.refLog is not None:
+                self.refLog.setdefault(token, self.symbolState(token))
+            return (sym.value, sym.ebytes)
+
+        # If we get here, we failed to
+        self.trace.evaluator("Failed to obtain value for '%s'", token)
+        if self.refLog is not None:
+            self.refLog.setdefault(token, None)
+        return (None, None)
 
-    v, __ = calcExpression(lineNumber, body)
-    if v is None:
-        bailout("Line: %d  Unable to resolve conditional expression for '%s'" % (lineNumber, body))
-    c = ConditionalBlock(okToEmitCode, v != 0)
-    conditionalStack.append(c)
-    okToEmitCode = c.state
-    logDebug("cblock %s" % c)
-    logDebug("Ok to emit code = %d" % okToEmitCode)
+    # Returns a tuple of the value and bytes of a symbol, or None if it has no value (yet).
+    def symbolState(self, name):
+        sym = self.symbols.get(name)
+        if sym is None or sym.value is None:
+            return None
+        return (sym.value, bytes(sym.ebytes))
+
+    # Returns True if all of the symbols still have the given states.
+    def refsUnchanged(self, refs):
+        for name, state in refs:
+            if self.symbolState(name) != state:
+                return False
+        return True
 
+    #
+    # Returns the compiled form of the expression text, from the shared Expression.cache. With the
+    # token cache, the compiled expressions are kept to be saved with the tokens.
+    #
+    def compileExpression(self, body):
+        expr = Expression.compileExpression(body, self.altSyntax)
+        if self.cacheTokens:
+            self.expressions[body] = expr
+        return expr
 
-def processElse():
-    global okToEmitCode
-    emitNoCode()
-    if len(conditionalStack) < 1:
-        bailout("Line: %d: Found a conditional block 'else' while not in a conditional block" % lineNumber)
-    f = conditionalStack[-1].blockToElse()
-    if f is False:
-        bailout("Line: %d: Found a second conditional block 'else' while already in an else block" % lineNumber)
-    okToEmitCode = conditionalStack[-1].state
-    logDebug("cblock %s" % conditionalStack[0])
-    logDebug("Ok to emit code = %d" % okToEmitCode)
+    #
+    # Parses a constant, symbol, or equation and returns the numeric value.
+    #
+    # Returns a tuple of ( value, ebytes ). Will return None if a value could not be obtained.
+    #
+    # If no value available, returns None.
+    # If any component was an address, the address flag will be true.
+    # If any component was a symbol, the literal flag will be false.
+    # Bytes is returned only if the the expression was a single hex token.
+    #
+    # Examples:
+    #   9
+    #   0FBH
+    #   14H
+    #   0FC00H
+    #   MICE
+    #   BSCR-8
+    #   ROMVAR + 1AH
+    #    A.0(BEEP)
+    #    MICE + HIGH START
+    #    MICE + HIGH START + 4
+    #
+    def calcExpression(self, lineNumber, body):
+        self.trace.evaluator("Calc expression '%s'", body)
+        self.calcCount += 1
+        expr = self.compileExpression(body)
+        return expr.evaluate(self, lineNumber, 1)
 
+    # ----------------------------------------------------------------
+    #
+    # ----------------------------------------------------------------
 
-def processEndif():
-    global okToEmitCode
-    emitNoCode()
-    if len(conditionalStack) < 1:
-        bailout("Line: %d: Found a conditional block 'end' while not in a conditional block" % lineNumber)
+    #
+    # If a symbol is involved, return two bytes
+    # If not, return bytes that the values represent.
+    #
+    # I think we count the hex digits to determine how many bytes to generate...
+    #
+    # Examples:
+    #   DC RATS
+    #   DC NOOP-7
+    #   DC 085H, 'LIMI', 0D4H
+    #   DC 8
+    #
+    def assembleDC(self, body):
+        self.trace.emitter("Assemble DC '%s'", body)
 
-    conditionalStack.pop()
-    if len(conditionalStack) > 0:
-        okToEmitCode = conditionalStack[-1].state
-        logDebug("cblock %s" % conditionalStack[0])
-    else:
-        okToEmitCode = True
-    logDebug("Ok to emit code = %d" % okToEmitCode)
+        startAddr = self.address
 
+        bytes = bytearray()
 
-# Emit the contents of a source line that generated no code.
-#
-# This only emits text during pass 2, so it can be called during pass 1 with no ill effects.
-#
-def emitNoCode():
-    if passNumber == 2:
-        if curLine == "":
-            emitListing("%04X ;              %04d" % (address, lineNumber))
+        # Break up into chunks
+        chunks = body.split(',')
+        for chunk in chunks:
+            chunk = chunk.strip()
+            m = re.match(r"'(.+)'", chunk)
+            if m:
+                s = m.group(1)
+                chars = list(s)
+                for c in chars:
+                    bytes.append(ord(c))
+            else:
+                v, ebytes = self.calcExpression(self.lineNumber, chunk)   # FRAK
+                # print( "Literal expression evaluated to %s %s" % ( v, ebytes ) )
+                # self.trace.emitter("%s", ebytes)
+                if v is None or (self.objectMode and self.needsRelocation(chunk)):
+                    if self.passNumber == 1:
+                        # Forward ref ok for 1st pass
+                        # The low or high byte of an address is one byte, anything else is an address.
+                        width = 1 if self.compileExpression(chunk).isAddressByte() else 2
+                        if self.onePass:
+                            self.fixups.append(Fixup("dc", None, chunk, self.address + len(bytes), width, self.address, self.lineNumber))
+                        v = 0
+                        ebytes = b'\00' * width
+                    else:
+                        self.bailout("Line: %d   Unresolved expression '%s'" % (self.lineNumber, chunk))
+                if ebytes is not None:
+                    # Sequence of bytes
+                    bytes.extend(ebytes)
+
+        self.address += len(bytes)
+        return (startAddr, bytes)
+
+    def assembleLOAD(self, body):
+        """Process the LOAD macro.
+        Syntax is "LOAD Rn, <addr>
+        """
+
+        self.trace.emitter("Assemble LOAD '%s'", body)
+
+        startAddr = self.address
+        bytes = bytearray()
+
+        m = re.match(r"\s*R([0-9A-F])\s*,\s*(.+)\s*", body)
+        if m:
+            r = int(m.group(1), 16)
+            exp = m.group(2)
+            if not self.deferOperand("load", r, exp, bytes, 6):
+                bytes.extend(self.loadOperand(r, exp))
         else:
-            emitListing("%04X ;              %04d  %s" % (address, lineNumber, curLine))
+            self.bailout("Line: %d   Invalid LOAD '%s'" % (self.lineNumber, body))
 
+        self.address += len(bytes)
+        return (startAddr, bytes)
 
-# ----------------------------------------------------------------
-#
-# ----------------------------------------------------------------
-
-#
-# Process a line of source
-#
-#
-def processLine(line):
-    global curLine
+    def loadOperand(self, r, exp):
+        a, _ = self.calcExpression(self.lineNumber, exp)
+        if a is None:
+            self.bailout("Line: %d   Unresolved expression '%s'" % (self.lineNumber, exp))
 
-    # line = line.rstrip()    # remove trailing whitespace
+        return bytearray((0xF8, a // 256, 0xB0 + r, 0xF8, a % 256, 0xA0 + r))
 
-    logDebug("------- Line '%s'" % line)
+    def parseRegister(self, arg):
+        m = re.match(r'^R?([0-9A-F])$', arg)
+        if m is not None:
+            return int(m.group(1), 16)
+        else:
+            # Only reached once the register's symbols have values: deferOperand() holds it back
+            # until then.
+            v, __ = self.calcExpression(self.lineNumber, arg)
+            # print( v, aflag, lflag, ebytes )
+            if v is not None:
+                if v < 0 or v > 15:
+                    self.bailout("Line: %d  Invalid register value %d for '%s'" % (self.lineNumber, v, arg))
+                else:
+                    return v
+            else:
+                self.bailout("Line: %d  Invalid register '%s'" % (self.lineNumber, arg))
 
-    curLine = line.rstrip()    # remove trailing whitespace, just because printing it on on the listing is silly.
+    #
+    # Returns True if an expression can't be evaluated until the module is linked, because it
+    # references a symbol that is relocatable or not defined yet (or is external), or uses "$" in a
+    # relocatable section. (object files)
+    #
+    def needsRelocation(self, body):
+        for name in self.compileExpression(body).symbols():
+            if not self.isAbsoluteSymbol(name):
+                return True
+        return usesHere(body) and self.sections[self.sectionIndex].relocatable
+
+    # Returns True if the symbol has a value that doesn't change when the module is placed.
+    def isAbsoluteSymbol(self, name):
+        sym = self.symbols.get(name)
+        if sym is None or sym.value is None:
+            return False
+        if sym.kind == SYMBOL_IMPORTED:
+            return True
+        section = self.sections[self.symbolSections[name]]
+        if sym.kind == SYMBOL_LABEL:
+            return not section.relocatable
+        if usesHere(sym.body) and section.relocatable:
+            return False
+        return all(self.isAbsoluteSymbol(ref) for ref in sym.refs)
 
-    # Some statements are only valid in a single chunk per line scenario, such as equates.
-    # FOO equ 0
     #
-    # Some statements are only valid as the first chunk, such as equates and conditionals.
+    # Checks whether an operand has to wait for the symbol table. If so, zeros are reserved for it
+    # and True is returned.
+    #
+    # On pass 1 of a normal assembly operands are never evaluated. In one-pass mode the operand is
+    # evaluated right away if everything it references already has a value, otherwise a fixup is
+    # recorded so the bytes can be patched once the symbol table is complete. For an object file
+    # the fixup is left for the linker if the operand depends on where the module is placed.
+    #
+    def deferOperand(self, kind, param, arg, bytes, width):
+        if self.passNumber == 2:
+            return False
 
-    # Equate?
-    # Since equates are allowed to start in the first column, we have to test for them first to prevent
-    # them from being treated as a label.
-    m = re.match(r'^\s*(\w+)\s+EQU\s+(.+)', line, re.IGNORECASE)
-    if m:
-        # Line is an equate
-        if not okToEmitCode:
-            # No code emit also means don't process an equate
-            emitNoCode()
-            return
+        if self.objectMode:
+            if not self.needsRelocation(arg):
+                return False
+            self.fixups.append(Fixup(kind, param, arg, self.address + len(bytes), width, self.address, self.lineNumber))
+        elif self.onePass:
+            expr = self.compileExpression(arg)
+            if all(name in self.symbols and self.symbols[name].value is not None for name in expr.symbols()):
+                return False
+            self.fixups.append(Fixup(kind, param, arg, self.address + len(bytes), width, self.address, self.lineNumber))
 
-        label = m.group(1)
-        body = m.group(2)
-        logDebug("Equate: '%s'   body '%s'" % (label, body))
-        # The remainder of the equate line (everything after the "equ") must be a single chunk.
-        chunker = Chunker.Chunker(body, semicolonComments=altSyntax)
-        logDebug("chunks: %s" % chunker.chunks)
-        if len(chunker.chunks) != 1:
-            bailout("Line: %d  Equate body parse failed" % lineNumber)
-        logDebug("Equate: '%s'   value chunk '%s'" % (label, chunker.chunks[0]))
-        processEquate(label, chunker.chunks[0])
-        return
-
-    # Label?
-    m = re.match(r'^(\w+):?\s*(.*)', line)
-    if m:
-        # Line has a label
-        if not okToEmitCode:
-            # No code emit also means don't process an equate
-            emitNoCode()
+        bytes.extend(b'\00' * width)
+        return True
+
+    def assembleRegOp(self, opBase, arg, bytes):
+        if not isRegisterLiteral(arg) and self.deferOperand("reg", opBase, arg, bytes, 1):
             return
+        bytes.extend(self.registerOperand(opBase, arg))
 
-        label = m.group(1)
-        body = m.group(2)
-        logDebug("Label: '%s'   remainder '%s'" % (label, body))
-        if passNumber == 1:
-            # Add it to the symbol table!
-            addSymbolLabel(label, address)
-        elif passNumber == 2:
-            # Make sure the address matches, for sanity checking.
-            confirmSymbolAddress(label, address)
+    def registerOperand(self, opBase, arg):
+        r = self.parseRegister(arg)
+        return bytearray((opBase + r,))
 
-        line = body   # Basically strip the label from the line, then it gets processed as usual.
+    def assembleLoadN(self, opBase, arg, bytes):
+        if not isRegisterLiteral(arg) and self.deferOperand("regn", opBase, arg, bytes, 1):
+            return
+        bytes.extend(self.loadNOperand(opBase, arg))
+
+    def loadNOperand(self, opBase, arg):
+        r = self.parseRegister(arg)
+        if r == 0:
+            self.bailout("Line: %d   Register for Load N operation cannot be zero" % self.lineNumber)
+        return bytearray((opBase + r,))
+
+    # Parses a value or an address. Address must use the A.0() or A.1() formats
+    def assembleImmediate(self, opBase, arg, bytes):
+        bytes.append(opBase)
+        if not self.deferOperand("imm", opBase, arg, bytes, 1):
+            bytes.extend(self.immediateOperand(opBase, arg))
+
+    def immediateOperand(self, opBase, arg):
+        v, __ = self.calcExpression(self.lineNumber, arg)
+        if v is None:
+            self.bailout("Line: %d   Invalid argument (immediate) '%s'" % (self.lineNumber, arg))
+        elif v > 0xFF:
+            self.bailout("Line: %d   Argument out of range, must be 0-255" % self.lineNumber)
+
+        return bytearray((v,))
+
+    # Takes an address argument and emits the LSB
+    # If the MSB differs from the immediate args address MSB, declare a branch range error
+    def assembleShortBranch(self, opBase, arg, bytes):
+        bytes.append(opBase)
+        if not self.deferOperand("sbranch", opBase, arg, bytes, 1):
+            bytes.extend(self.shortBranchOperand(opBase, arg))
+
+    def shortBranchOperand(self, opBase, arg):
+        v, __ = self.calcExpression(self.lineNumber, arg)    # FRAK
+        if v is None:
+            self.bailout("Line: %d   Invalid argument (short branch)" % self.lineNumber)
+        self.trace.emitter("SB arg addr is 0x%04X", self.address + 1)
+        a_page = (self.address + 1) >> 8 & 0xFF
+        b_page = (v) >> 8 & 0xFF
+        if a_page != b_page:
+            self.bailout("Line: %d   Branch out of range" % self.lineNumber)
+
+        return bytearray((v & 0xFF,))
+
+    # Takes an address argument and emits the MSB and LSB
+    def assembleLongBranch(self, opBase, arg, bytes):
+        bytes.append(opBase)
+        if not self.deferOperand("lbranch", opBase, arg, bytes, 2):
+            bytes.extend(self.longBranchOperand(opBase, arg))
+
+    def longBranchOperand(self, opBase, arg):
+        v, __ = self.calcExpression(self.lineNumber, arg)    # FRAK
+        if v is None:
+            self.bailout("Line: %d   Invalid argument (long branch)" % self.lineNumber)
+
+        return bytearray((v >> 8 & 0xFF, v & 0xFF))
+
+    def dcOperand(self, param, chunk):
+        v, ebytes = self.calcExpression(self.lineNumber, chunk)
+        if v is None:
+            self.bailout("Line: %d   Unresolved expression '%s'" % (self.lineNumber, chunk))
+        return ebytes
+
+    # Parses an integer value 1-7
+    def assembleInputOutput(self, opBase, arg, bytes):
+        m = re.match(r'^([0-7]$)', arg)
+        if m:
+            bytes.append(opBase + int(m.group(1), 10))
+        else:
+            self.bailout("Line: %d   IO port must be 1-7" % self.lineNumber)
 
-    # We call this first off, even though in some cases we don't actually want things
-    # chunked up (such as for equates)
-    # This does get rid of comments, which is important.
-    chunker = Chunker.Chunker(line, semicolonComments=altSyntax)
+    # Returns a tuple of starting address and a byte array of the machine code.
+    def assembleChunk(self, chunk):
+        mnemonic, arg = self.parseChunk(chunk)
+        return self.assembleInstruction(mnemonic, arg)
 
-    if len(chunker.chunks) == 0:
-        # No chunks or label, just an empty line. Or a label!
-        emitNoCode()
-        return
+    # Get the opcode and optional argument
+    def parseChunk(self, chunk):
+        m = re.match(r'^(\w+)\s*(.*)', chunk)
+        if m is None:
+            self.bailout("Line: %d  Invalid line '%s'" % (self.lineNumber, chunk))
+
+        self.trace.tokenizer("Chunk '%s'  opcode '%s'  arg '%s'", chunk, m.group(1), m.group(2))
+        return (m.group(1), m.group(2))
+
+    # Returns a tuple of starting address and a byte array of the machine code.
+    def assembleInstruction(self, mnemonic, arg):
+        bytes = bytearray()
+        startAddr = self.address
+
+        if mnemonic in opTable:
+            opbase, func = opTable[mnemonic]
+            if func:
+                self.trace.emitter("Calling opcode func %s", func)
+                func(self, opbase, arg, bytes)
+            elif opbase is not None:
+                self.trace.emitter("Appending opbase %s", opbase)
+                bytes.append(opbase)
+            else:
+                self.bailout("Internal error - invalid table for opcode '%s'" % mnemonic)
+        else:
+            self.bailout("Line: %d  Invalid mnemonic '%s'" % (self.lineNumber, (mnemonic + " " + arg).strip()))
+
+        self.address += len(bytes)
+        return (startAddr, bytes)
 
-    firstChunk = True    # First chunk is special, it can be a directive.
-    startAddr = None
-    lineBytes = bytearray()
+    #
+    # Classify a chunk by its first word, with a single table lookup.
+    #
+    # Returns a tuple of ( key, statement, operand ). The statement is None if the first word is not
+    # in the table, and the operand is None if the rest of the chunk doesn't fit the statement.
+    #
+    def classifyChunk(self, chunk):
+        m = _firstWord.match(chunk)
+        if m is None:
+            return (None, None, None)
+
+        word, sep, rest = m.groups()
+        table = statementTables[self.altSyntax]
+        stmt = table.get(word)
+        if stmt is None:
+            # Directives are not case sensitive
+            key = word.upper()
+            stmt = table.get(key)
+            if stmt is None and word not in self.macros:
+                for prefix in _prefixDirectives:
+                    if key.startswith(prefix):
+                        return (prefix, table[prefix], chunk[len(prefix):])
+            if stmt is None or stmt.kind > STMT_DIRECTIVE:
+                return (word, None, None)
+            word = key
+
+        return (word, stmt, stmt.args(sep, rest))
+
+    # ----------------------------------------------------------------
+    #
+    # ----------------------------------------------------------------
 
-    for chunk in chunker.chunks:
+    # Emit the results of a line of code.
+    #
+    def emitCode(self, startAddr, bytes):
+        self.addToImage(startAddr, bytes)
 
-        # Only the first chunk can be a directive.
-        if firstChunk:
-            firstChunk = False
+        if self.listing is not None:
+            self.listing.code(startAddr, bytes, self.lineNumber, self.curLine)
 
-            # Directive?
-            if processDirective(chunk) is True:
-                # Yes, was a directive. Continue with next chunk
-                continue
+    # Add bytes to the program image
+    def addToImage(self, startAddr, bytes):
+        if startAddr < self.programBase:
+            self.bailout("Data written to address 0x%04X below the program base of 0x%04X" % (startAddr, self.programBase))
+
+        try:
+            self.image.add(startAddr, bytes)
+        except ProgramImage.ImageError as err:
+            self.bailout(str(err))
+
+    def processEquate(self, label, body):
+        body = body.strip()
+
+        if self.passNumber == 1:
+            self.addSymbolEquate(label, body)
+        self.emitNoCode()
+
+    def processOrigin(self, body):
+        v, __ = self.calcExpression(self.lineNumber, body)
+        if v is None:
+            self.bailout("Line: %d  Unable to resolve origin address for '%s'" % (self.lineNumber, body))
+
+        if self.objectMode and not self.needsRelocation(body):
+            # An absolute address starts a section that stays where it is. Otherwise this is a move
+            # within a relocatable section, like ORG $+10.
+            self.sections.append(ObjectFile.Section(v, False))
+            self.sectionIndex = len(self.sections) - 1
+        elif self.objectMode and not self.sections[self.sectionIndex].relocatable:
+            self.bailout("Line: %d  Origin '%s' depends on relocatable symbols" % (self.lineNumber, body))
+
+        self.emitNoCode()
+        self.address = v
 
-        body = chunk
+    #
+    # INCLUDE a source file, which is named relative to the file doing the including. Each file is
+    # only read once per run, however many times it is included. Its lines are processed on pass 1
+    # as soon as the INCLUDE line is done, and pass 2 replays them along with the rest.
+    #
+    def processInclude(self, body):
+        self.emitNoCode()
 
-        logDebug("Body '%s'" % body)
+        if self.passNumber == 2:
+            return
 
-        if altSyntax is True:
-            m = re.match(r'^DB\s+(.*)', body)
+        name = body.strip()
+        if len(name) >= 2 and name[0] == name[-1] and name[0] in "'\"":
+            name = name[1:-1]
+        path = os.path.join(os.path.dirname(self.fileName), name)
+        key = os.path.abspath(path)
+
+        if key in self.includeStack:
+            self.bailout("Line: %d  Recursive INCLUDE of '%s'" % (self.lineNumber, name))
+
+        lines = self.sourceFiles.get(key)
+        if lines is None:
+            try:
+                with open(path, 'r') as f:
+                    lines = f.readlines()
+            except OSError as err:
+                self.bailout("Line: %d  Unable to INCLUDE '%s': %s" % (self.lineNumber, name, err.strerror))
+            self.sourceFiles[key] = lines
+            self.dependencies.append(path)
+
+        self.trace.tokenizer("Include: '%s'  %d lines", path, len(lines))
+        self.pendingInclude = (path, lines)
+
+    def processPage(self):
+        self.emitNoCode()
+
+        if self.objectMode:
+            # Page boundaries only stay put if the section is placed on one.
+            self.sections[self.sectionIndex].align = 0x100
+
+        if self.address & 0xFF != 0:
+            # Adjust the address to the next 256-byte page start
+            page = self.address >> 8 & 0xFF
+            page += 1
+
+            self.address = page << 8
+
+    def processIf(self, body):
+        self.emitNoCode()
+
+        v, __ = self.calcExpression(self.lineNumber, body)
+        if v is None:
+            self.bailout("Line: %d  Unable to resolve conditional expression for '%s'" % (self.lineNumber, body))
+        c = ConditionalBlock(self.okToEmitCode, v != 0)
+        self.conditionalStack.append(c)
+        self.okToEmitCode = c.state
+        self.trace.emitter("cblock %s", c)
+        self.trace.emitter("Ok to emit code = %d", self.okToEmitCode)
+
+    def processElse(self):
+        self.emitNoCode()
+        if len(self.conditionalStack) < 1:
+            self.bailout("Line: %d: Found a conditional block 'else' while not in a conditional block" % self.lineNumber)
+        f = self.conditionalStack[-1].blockToElse()
+        if f is False:
+            self.bailout("Line: %d: Found a second conditional block 'else' while already in an else block" % self.lineNumber)
+        self.okToEmitCode = self.conditionalStack[-1].state
+        self.trace.emitter("cblock %s", self.conditionalStack[0])
+        self.trace.emitter("Ok to emit code = %d", self.okToEmitCode)
+
+    def processEndif(self):
+        self.emitNoCode()
+        if len(self.conditionalStack) < 1:
+            self.bailout("Line: %d: Found a conditional block 'end' while not in a conditional block" % self.lineNumber)
+
+        self.conditionalStack.pop()
+        if len(self.conditionalStack) > 0:
+            self.okToEmitCode = self.conditionalStack[-1].state
+            self.trace.emitter("cblock %s", self.conditionalStack[0])
         else:
-            m = re.match(r'^DC\s+(.*)', body)
+            self.okToEmitCode = True
+        self.trace.emitter("Ok to emit code = %d", self.okToEmitCode)
+
+    # Emit the contents of a source line that generated no code.
+    #
+    # This only emits text during pass 2, so it can be called during pass 1 with no ill effects.
+    #
+    def emitNoCode(self):
+        if self.listing is not None and (self.passNumber == 2 or self.onePass):
+            self.listing.noCode(self.address, self.lineNumber, self.curLine)
+
+    # ----------------------------------------------------------------
+    #
+    # ----------------------------------------------------------------
+
+    #
+    # Process a line of source on pass 1 (or the only pass, in one-pass mode)
+    #
+    # Returns a LineRecord describing what was found on the line.
+    #
+    # The lines of a macro expansion come with their tokens, which were made from the macro's template.
+    #
+    def processLine(self, line, tokens=None):
+        # line = line.rstrip()    # remove trailing whitespace
+
+        self.trace.tokenizer("------- Line '%s'", line)
+
+        self.curLine = line.rstrip()    # remove trailing whitespace, just because printing it on on the listing is silly.
+
+        # Some statements are only valid in a single chunk per line scenario, such as equates.
+        # FOO equ 0
+        #
+        # Some statements are only valid as the first chunk, such as equates and conditionals.
+
+        if tokens is None:
+            tokens = self.lineTokens.get(line)
+            if tokens is None:
+                tokens = tokenizeLine(line, self.altSyntax)
+                self.lineTokens[line] = tokens
+
+        if self.macroDef is not None:
+            return self.defineMacroLine(line, tokens)
+
+        if tokens.kind == TOKENS_MACRO:
+            return self.processMacro(tokens)
+
+        # Equate?
+        if tokens.kind == TOKENS_EQUATE:
+            # Line is an equate
+            if not self.okToEmitCode:
+                # No code emit also means don't process an equate
+                self.emitNoCode()
+                return noCodeRecord(LINE_SKIPPED, False)
+
+            label = tokens.label
+            self.trace.tokenizer("Equate: '%s'   body '%s'", label, tokens.body)
+            # The remainder of the equate line (everything after the "equ") must be a single chunk.
+            chunks = tokens.getChunks()
+            self.chunkCount += len(chunks)
+            self.trace.tokenizer("chunks: %s", chunks)
+            if len(chunks) != 1:
+                self.bailout("Line: %d  Equate body parse failed" % self.lineNumber)
+            self.trace.tokenizer("Equate: '%s'   value chunk '%s'", label, chunks[0])
+            self.processEquate(label, chunks[0])
+            return LineRecord(LINE_EQUATE, label, (("EQU", chunks[0]),), 0, True)
+
+        cond = self.okToEmitCode
+        label = None
+
+        # Label?
+        if tokens.kind == TOKENS_LABEL:
+            # Line has a label
+            if not self.okToEmitCode:
+                # No code emit also means don't process an equate
+                self.emitNoCode()
+                return noCodeRecord(LINE_SKIPPED, False)
+
+            label = tokens.label
+            self.trace.tokenizer("Label: '%s'   remainder '%s'", label, tokens.body)
+            # Add it to the symbol table!
+            self.addSymbolLabel(label, self.address)
+
+        # Everything after the label, with the comments gone.
+        chunks = tokens.getChunks()
+        self.chunkCount += len(chunks)
+
+        if len(chunks) == 0:
+            # No chunks or label, just an empty line. Or a label!
+            self.emitNoCode()
+            if label is None:
+                return noCodeRecord(LINE_BLANK, cond)
+            return LineRecord(LINE_BLANK, label, (), 0, cond)
+
+        firstChunk = True    # First chunk is special, it can be a directive.
+        firstFixup = len(self.fixups)
+        startAddr = None
+        lineBytes = bytearray()
+        statements = []
+
+        for chunk in chunks:
+            key, stmt, operand = self.classifyChunk(chunk)
+
+            # Only the first chunk can be a directive.
+            if firstChunk:
+                firstChunk = False
+
+                # Directive?
+                directive = self.processDirective(key, stmt, operand)
+                if directive is not False:
+                    # Yes, was a directive. Continue with next chunk
+                    statements.append(directive)
+                    continue
+
+                # Macro call?
+                if stmt is None and key in self.macros:
+                    if len(chunks) > 1:
+                        self.bailout("Line: %d  A call of macro '%s' has to be on a line by itself" % (self.lineNumber, key))
+                    self.callMacro(self.macros[key], chunk)
+                    statements.append((None, None))
+                    continue
+
+            self.trace.tokenizer("Statement '%s'  operand '%s'", key, operand)
+
+            if stmt is None or operand is None or stmt.kind <= STMT_DIRECTIVE:
+                # Not a valid instruction, this reports why.
+                self.assembleChunk(chunk)
+
+            statements.append((key, operand))
+            addr, bytes = stmt.handler(self, operand)
 
-        if m:
-            # Line is a DC directive
-            body = m.group(1)
-            addr, bytes = assembleDC(body)
             if startAddr is None:
+                # Capture the address of the first instructions of the line.
+                # (We may acumulate more instructions in subsequent chunks.)
                 startAddr = addr
             lineBytes.extend(bytes)
-        else:
-            m = re.match(r'^LOAD\s+(.*)', body)
-            if m:
-                # Line is a LOAD macro
-                body = m.group(1)
-                addr, bytes = assembleLOAD(body)
-                if startAddr is None:
-                    startAddr = addr
-                lineBytes.extend(bytes)
+
+        if self.onePass and len(lineBytes) > 0:
+            # Hold the code until the fixups have been applied.
+            for fixup in self.fixups[firstFixup:]:
+                fixup.target = lineBytes
+                fixup.offset = fixup.address - startAddr
+                fixup.section = self.sectionIndex
+            if self.objectMode:
+                section = self.sections[self.sectionIndex]
+                section.add(startAddr - section.origin, lineBytes)
             else:
-                # Looks like we have a normal statment, opcode style!
-                addr, bytes = assembleChunk(body)
-                if startAddr is None:
-                    # Capture the address of the first instructions of the line.
-                    # (We may acumulate more instructions in subsequent chunks.)
-                    startAddr = addr
-                lineBytes.extend(bytes)
+                self.deferredCode.append((startAddr, lineBytes, self.lineNumber))
+            if self.listing is not None:
+                self.listing.code(startAddr, lineBytes, self.lineNumber, self.curLine)
 
-    if passNumber == 2 and len(lineBytes) > 0:
-        # This is the code emiting pass, and we have machine code to emit.
-        emitCode(startAddr, lineBytes)
+        return LineRecord(LINE_CODE, label, tuple(statements), len(lineBytes), cond)
 
+    #
+    # Start the definition of a macro. The lines up to the ENDM are its body.
+    #
+    def processMacro(self, tokens):
+        self.emitNoCode()
+        cond = self.okToEmitCode
+        if not self.okToEmitCode:
+            return noCodeRecord(LINE_SKIPPED, False)
+
+        name = tokens.label
+        if name in self.macros:
+            self.bailout("Line: %d  Macro '%s' is already defined on line %d" % (self.lineNumber, name, self.macros[name].lineNumber))
+
+        chunks = tokens.getChunks()
+        if len(chunks) > 1:
+            self.bailout("Line: %d  Invalid macro parameters '%s'" % (self.lineNumber, tokens.body.strip()))
+        params = [p.strip() for p in chunks[0].split(",")] if chunks else []
+        for p in params:
+            if re.match(r'^[A-Za-z_]\w*$', p) is None or params.count(p) > 1:
+                self.bailout("Line: %d  Invalid macro parameter '%s'" % (self.lineNumber, p))
+
+        self.trace.tokenizer("Macro: '%s'  parameters %s", name, params)
+        self.macroDef = Macro(name, params, self.lineNumber)
+        return LineRecord(LINE_CODE, None, (("MACRO", name),), 0, cond)
 
-def processDirective(line):
+    #
+    # A line between MACRO and ENDM. It is kept in the macro's template, and only shows up in the listing.
+    #
+    def defineMacroLine(self, line, tokens):
+        self.emitNoCode()
+        cond = self.okToEmitCode
 
-    # IF?
-    m = re.match(r'^IF\s+(.+)', line, re.IGNORECASE)
-    if m:
-        # Line is an IF directive
-        body = m.group(1)
-        logDebug("If: '%s'" % (body))
-        processIf(body)
-        return True
+        if tokens.kind == TOKENS_PLAIN and tokens.chunks:
+            key, stmt, operand = self.classifyChunk(tokens.chunks[0])
+            if key == "ENDM" and stmt is not None and operand is not None:
+                self.trace.tokenizer("Macro: '%s'  %d lines", self.macroDef.name, len(self.macroDef.lines))
+                self.macros[self.macroDef.name] = self.macroDef
+                self.macroDef = None
+                return LineRecord(LINE_CODE, None, (("ENDM", operand),), 0, cond)
 
-    # ELSE?
-    m = re.match(r'^ELSE$', line, re.IGNORECASE)
-    if m:
-        # Line is an else directive
-        logDebug("Else")
-        processElse()
-        return True
+        if tokens.kind == TOKENS_MACRO:
+            self.bailout("Line: %d  MACRO inside the definition of macro '%s'" % (self.lineNumber, self.macroDef.name))
 
-    # ENDI?
-    m = re.match(r'^ENDI$', line, re.IGNORECASE)
-    if m:
-        # Line is an end if directive
-        logDebug("End If")
-        processEndif()
-        return True
+        self.macroDef.addLine(line, tokens)
+        return noCodeRecord(LINE_BLANK, cond)
 
-    if not okToEmitCode:
-        emitNoCode()
-        return True
+    #
+    # Call a macro. Its expansion is processed after the current line, each line of it with the
+    # line number of the call, and a "+" in front of it in the listing.
+    #
+    def callMacro(self, macro, chunk):
+        self.emitNoCode()
+
+        args = splitArguments(_firstWord.match(chunk).group(3))
+        if args is None:
+            self.bailout("Line: %d  Invalid macro arguments '%s'" % (self.lineNumber, chunk))
+        if len(args) != len(macro.params):
+            self.bailout("Line: %d  Macro '%s' takes %d arguments, but was given %d" % (self.lineNumber, macro.name, len(macro.params), len(args)))
+
+        self.trace.tokenizer("Macro call: '%s'  arguments %s", macro.name, args)
+        self.pendingExpansion = macro.expand(args)
+
+    # Directives that are only handled on pass 1, where they are found by processLine().
+    def processMacroDirective(self, key):
+        if self.passNumber == 1:
+            if key == "MACRO":
+                self.bailout("Line: %d  MACRO needs a name in front of it" % self.lineNumber)
+            self.bailout("Line: %d  ENDM without a MACRO" % self.lineNumber)
+        self.emitNoCode()
 
-    # - - - - - - - - - - - - - - - - -
+    #
+    # Process a line of source on pass 2, using the record of what pass 1 found on it.
+    #
+    # Returns the bytes of code produced.
+    #
+    def replayLine(self, line, rec):
+        self.curLine = line.rstrip()
 
-    # Org?
-    m = re.match(r'^ORG\s+(.*)', line, re.IGNORECASE)
-    if m:
-        # Line is an origin directive
-        body = m.group(1)
-        logDebug("Origin: '%s'" % (body))
-        processOrigin(body)
-        return True
+        if rec.label is not None and rec.kind != LINE_EQUATE:
+            # Make sure the address matches, for sanity checking.
+            self.confirmSymbolAddress(rec.label, self.address)
 
-    # PAGE?
-    m = re.match(r'^PAGE(.*)', line, re.IGNORECASE)
-    if m:
-        # Line is a page directive
-        logDebug("Page")
-        processPage()
-        return True
+        if rec.kind != LINE_CODE:
+            self.emitNoCode()
+            return None
 
-    # END?
-    m = re.match(r'^END(.*)', line, re.IGNORECASE)
-    if m:
-        # Line is a END directive
-        logDebug("End")
-        emitNoCode()
-        # TODO: Should ignore everything after this line?
-        return True
+        startAddr = None
+        lineBytes = bytearray()
 
-    return False
+        table = statementTables[self.altSyntax]
+        for op, operand in rec.statements:
+            if op is None:
+                self.emitNoCode()
+                continue
 
+            stmt = table[op]
+            if stmt.kind == STMT_DIRECTIVE:
+                stmt.handler(self, operand)
+                continue
 
-# ----------------------------------------------------------------
-#
-# ----------------------------------------------------------------
+            addr, bytes = stmt.handler(self, operand)
 
+            if startAddr is None:
+                startAddr = addr
+            lineBytes.extend(bytes)
 
-#
-# First pass - create the symbol table
-#
-def firstPass(lines):
-    global passNumber, lineNumber
+        if len(lineBytes) > 0:
+            self.emitCode(startAddr, lineBytes)
 
-    if verbose > 1:
-        print("=========================== First Pass ==============================")
-    elif verbose > 0:
-        print("First Pass...")
+        return lineBytes
 
-    passNumber = 1
-    lineNumber = 0
-    for line in lines:
-        lineNumber += 1
-        processLine(line)
+    #
+    # Returns False if the classified chunk is not a directive. Otherwise the directive is processed,
+    # and its ( op, operand ) statement for the line record is returned.
+    #
+    def processDirective(self, key, stmt, operand):
+        isDirective = stmt is not None and operand is not None
 
+        if isDirective and stmt.kind == STMT_CONDITIONAL:
+            self.trace.tokenizer("Conditional: '%s'  '%s'", key, operand)
+            stmt.handler(self, operand)
+            return (None, None)
 
-#
-# Second pass - actual assembly and output.
-#
-# In this pass, we do the actual assembly since we now have the complete symbol table that was
-# created in the first pass.
-#
-def secondPass(lines):
-    global passNumber, lineNumber, address
+        if not self.okToEmitCode:
+            self.emitNoCode()
+            return (None, None)
 
-    if verbose > 1:
-        print("=========================== Second Pass ==============================")
-    elif verbose > 0:
-        print("Second Pass...")
+        if isDirective and stmt.kind == STMT_DIRECTIVE:
+            self.trace.tokenizer("Directive: '%s'  '%s'", key, operand)
+            stmt.handler(self, operand)
+            return (key, operand)
 
-    passNumber = 2
-    lineNumber = 0
-    address = 0
-    for line in lines:
-        lineNumber += 1
-        processLine(line)
+        return False
 
+    # ----------------------------------------------------------------
+    #
+    # ----------------------------------------------------------------
 
-def assembleFile(src):
-    global binfile
+    #
+    # First pass - create the symbol table
+    #
+    def firstPass(self, lines):
+        if self.verbose > 1:
+            print("=========================== First Pass ==============================")
+        elif self.verbose > 0:
+            print("First Pass...")
 
-    lines = src.readlines()
+        self.passNumber = 1
+        self.lineRecords = []
+        self.sourceLines = []
 
-    firstPass(lines)
-    logVerbose("Last address used: 0x%04X" % (address - 1))
+        def lineFunc(i, line, tokens=None):
+            return self.processLine(line, tokens)
 
-    if sizeLimit:
-        if address >= sizeLimit + programBase:
-            bailout("Program too large by %d bytes" % ((address - (sizeLimit + programBase))))
+        self.passOneFile(self.sourceName, lines, lambda filename, lines: lineFunc)
 
-    resolveSymbols()
-    # if verbose > 1:
-    #     dumpSymbols()
+    #
+    # Run pass 1 over the lines of a source file, and the files it includes as they come up.
+    #
+    # fileFunc(filename, lines) is called at the start of each file (and macro expansion), and returns
+    # the function that handles its lines. That is called with the index and text of each line, and
+    # returns the line's LineRecord.
+    #
+    def passOneFile(self, filename, lines, fileFunc):
+        outerFile = self.fileName
+        self.fileName = filename
+        self.includeStack.append(os.path.abspath(filename))
+        lineFunc = fileFunc(filename, lines)
 
-    secondPass(lines)
+        for i, line in enumerate(lines):
+            self.lineNumber = i + 1
+            self.lineRecords.append(lineFunc(i, line))
+            self.sourceLines.append((line, filename, self.lineNumber))
+            self.passOnePending(fileFunc)
 
+        self.includeStack.pop()
+        self.fileName = outerFile
 
-# ----------------------------------------------------------------
-#
-# ----------------------------------------------------------------
+    #
+    # Process the file included, or the macro expanded, by the line just processed.
+    #
+    def passOnePending(self, fileFunc):
+        if self.pendingInclude is not None:
+            path, included = self.pendingInclude
+            self.pendingInclude = None
+            self.passOneFile(path, included, fileFunc)
 
-def process(src):
-    global listingDest, hexDest, recDest, eprom, binfile
+        if self.pendingExpansion is not None:
+            expansion = self.pendingExpansion
+            self.pendingExpansion = None
+            self.passOneExpansion(expansion, fileFunc)
 
-    binfile = bincopy.BinFile()
+    #
+    # Run pass 1 over the lines of a macro expansion. fileFunc is called with a filename of None, and
+    # its line function with each line's tokens as well.
+    #
+    def passOneExpansion(self, expansion, fileFunc):
+        if self.macroDepth >= MAX_MACRO_DEPTH:
+            self.bailout("Line: %d  Macros nested more than %d deep" % (self.lineNumber, MAX_MACRO_DEPTH))
 
-    rootname, __ = os.path.splitext(src.name)
+        self.macroDepth += 1
+        lineNumber = self.lineNumber
+        lineFunc = fileFunc(None, expansion)
 
-    if displayFlag is True:
-        listingDest = sys.stdout
-        hexDest = sys.stdout
-        recDest = sys.stdout
-    else:
-        listingFilename = rootname + ".lst"
-        listingDest = open(listingFilename, 'w')
-        hexFilename = rootname + ".hex"
-        hexDest = open(hexFilename, 'w')
-        recFilename = rootname + ".ihex"
-        recDest = open(recFilename, 'w')
+        for i, (line, tokens) in enumerate(expansion):
+            self.lineNumber = lineNumber
+            listed = "+" + line
+            self.lineRecords.append(lineFunc(i, listed, tokens))
+            self.sourceLines.append((listed, self.fileName, lineNumber))
+            self.passOnePending(fileFunc)
 
-    assembleFile(src)
+        self.macroDepth -= 1
 
-    src.close()
+    #
+    # Second pass - actual assembly and output.
+    #
+    # In this pass, we do the actual assembly since we now have the complete symbol table that was
+    # created in the first pass. Each line is assembled from its record, without classifying the text again.
+    #
+    def secondPass(self):
+        if self.verbose > 1:
+            print("=========================== Second Pass ==============================")
+        elif self.verbose > 0:
+            print("Second Pass...")
 
-    writeHexFile()
+        self.passNumber = 2
+        self.address = 0
+        for (line, self.fileName, self.lineNumber), rec in zip(self.sourceLines, self.lineRecords):
+            self.replayLine(line, rec)
 
-    dumpSymbols()
+    #
+    # Incremental first pass. A line is only processed again if it changed, or if anything it
+    # depended on last time is different: the conditional state, or the value of a symbol it looked
+    # up. Otherwise the symbols it defines are added, and the address moved past it, straight from
+    # its cached record.
+    #
+    # Each source file is matched against the cached copy of it. A file included more than once is
+    # only matched the first time.
+    #
+    # Returns a tuple of the set of indexes of the lines that were processed, and the list of the
+    # index of the matching cached line (or None) for each line.
+    #
+    def incrementalFirstPass(self, lines, cache, newCache):
+        if self.verbose > 1:
+            print("=========================== First Pass (incremental) ==============================")
+        elif self.verbose > 0:
+            print("First Pass...")
+
+        self.passNumber = 1
+        self.lineRecords = []
+        self.sourceLines = []
+        processed = set()
+        lineMatches = []
+
+        def startFile(filename, fileLines):
+            if filename is None:
+                # A macro expansion, which is always processed again.
+                return processLine
+
+            key = os.path.abspath(filename)
+            indexes = []
+            if key in newCache.files:
+                matches = [None] * len(fileLines)
+            else:
+                matches = cache.matchLines(key, fileLines)
+                newCache.files[key] = (fileLines, indexes)
 
-    if listingDest:
-        listingDest.close()
+            def lineFunc(i, line):
+                j = matches[i]
+                indexes.append(len(self.lineRecords))
+                lineMatches.append(j)
 
-    if hexDest:
-        hexDest.close()
+                if j is not None and self.reuseRecord(line, cache.records[j], cache.pass1Refs[j]):
+                    newCache.pass1Refs.append(cache.pass1Refs[j])
+                    return cache.records[j]
 
-    if recDest:
-        recDest.close()
+                return processLine(i, line)
 
+            return lineFunc
 
-def emitListing(text):
-    global listingDest
+        def processLine(i, line, tokens=None):
+            if tokens is not None:
+                lineMatches.append(None)
+            processed.add(len(self.lineRecords))
+            self.refLog = {}
+            rec = self.processLine(line, tokens)
+            newCache.pass1Refs.append(tuple(self.refLog.items()))
+            self.refLog = None
+            return rec
 
-    if listingDest:
-        listingDest.write(text + "\n")
+        self.passOneFile(self.sourceName, lines, startFile)
 
+        return (processed, lineMatches)
 
-def writeHexFile():
-    global hexDest, recDest, binfile
+    #
+    # Apply the pass 1 effects of an unchanged line from its cached record, if nothing the line
+    # depends on has changed. Lines with directives are always processed again.
+    #
+    # Returns True if the record was used.
+    #
+    def reuseRecord(self, line, rec, refs):
+        if rec.cond != self.okToEmitCode or self.macroDef is not None or not self.refsUnchanged(refs):
+            # The lines of a macro definition are always processed, to build its template.
+            return False
 
-    data = binfile.as_binary(minimum_address=programBase)
+        if rec.kind == LINE_SKIPPED:
+            return True
 
-    text = dataToHexStrings(data)
-    hexDest.write(text)
+        self.curLine = line.rstrip()
 
-    recDest.write(binfile.as_ihex())
+        if rec.kind == LINE_EQUATE:
+            self.processEquate(rec.label, rec.statements[0][1])
+            return True
 
+        if not isCodeOnly(rec, statementTables[self.altSyntax]):
+            return False
 
-def dataToHexStrings(data):
-    buf = ""
-    bytes = 0
-    for b in data:
-        buf = buf + "%02X" % b
-        bytes += 1
-        if bytes >= 16:
-            buf += "\n"
-            bytes = 0
+        # The line only defines its label and takes up space.
+        if rec.label is not None:
+            self.addSymbolLabel(rec.label, self.address)
+        self.address += rec.size
+        return True
 
-    return buf
+    #
+    # Incremental second pass. A line's cached code is used again if the line's record, its address,
+    # and the values of all of the symbols it looked up are the same as last time.
+    #
+    # Returns the set of indexes of the lines that were encoded again.
+    #
+    def incrementalSecondPass(self, cache, lineMatches, newCache):
+        if self.verbose > 1:
+            print("=========================== Second Pass (incremental) ==============================")
+        elif self.verbose > 0:
+            print("Second Pass...")
+
+        self.passNumber = 2
+        self.address = 0
+        encoded = set()
+        table = statementTables[self.altSyntax]
+
+        for i, ((line, self.fileName, self.lineNumber), rec) in enumerate(zip(self.sourceLines, self.lineRecords)):
+            j = lineMatches[i]
+            startAddr = self.address
+
+            if rec.kind != LINE_CODE:
+                self.replayLine(line, rec)
+                newCache.addresses.append(startAddr)
+                newCache.code.append(None)
+                newCache.pass2Refs.append(())
+                continue
 
+            if j is not None and cache.code[j] is not None and cache.addresses[j] == startAddr and \
+                    cache.records[j] == rec and isCodeOnly(rec, table) and self.refsUnchanged(cache.pass2Refs[j]):
+                self.curLine = line.rstrip()
+                if rec.label is not None:
+                    self.confirmSymbolAddress(rec.label, startAddr)
+                code = cache.code[j]
+                self.emitCode(startAddr, code)
+                self.address += len(code)
+                refs = cache.pass2Refs[j]
+            else:
+                self.refLog = {}
+                code = bytes(self.replayLine(line, rec))
+                refs = tuple(self.refLog.items())
+                self.refLog = None
+                encoded.add(i)
 
-# ----------------------------------------------------------------
-#
-# ----------------------------------------------------------------
+            newCache.addresses.append(startAddr)
+            newCache.code.append(code)
+            newCache.pass2Refs.append(refs)
 
-def logVerbose(msg):
-    if verbose > 0:
-        print(msg)
+        return encoded
 
+    #
+    # One-pass mode - the code is produced on the first pass, with any operands that can't be
+    # evaluated yet left as fixups. After the symbols are resolved only the fixups are patched.
+    #
+    def applyFixups(self):
+        self.logVerbose("Applying %d fixups..." % len(self.fixups))
 
-def logDebug(msg):
-    if verbose > 1:
-        print(msg)
+        endAddress = self.address
+        self.passNumber = 2      # Operands are evaluated just as they would be on the second pass.
+        for fixup in self.fixups:
+            self.applyFixup(fixup)
+        self.address = endAddress
 
+    #
+    # Encode a fixup's operand, now that everything it references has a value, and patch its bytes.
+    # This is also used by cosmaclink.py, with the fixups from the object files.
+    #
+    def applyFixup(self, fixup):
+        self.trace.emitter("Fixup %s", fixup)
+        self.lineNumber = fixup.lineNumber
+        self.address = fixup.origin
+        bytes = fixupEncoders[fixup.kind](self, fixup.param, fixup.body)
+        if len(bytes) != fixup.width:
+            self.bailout("Line: %d   Value of '%s' needs %d bytes but %d were reserved for it" % (self.lineNumber, fixup.body, len(bytes), fixup.width))
+        fixup.target[fixup.offset:fixup.offset + fixup.width] = bytes
 
-def logWarning(msg):
-    if passNumber == 2:
-        print("WARN: Line %d: %s" % (lineNumber, msg))
+    #
+    # Write out the listing and code that was held back in one-pass mode.
+    #
+    def flushDeferred(self):
+        held = self.deferredCode
+        self.deferredCode = None
+        for startAddr, bytes, self.lineNumber in held:
+            self.addToImage(startAddr, bytes)
 
+        if self.listing is not None:
+            self.listing.release()
 
-def bailout(msg):
-    if __name__ == '__main__':
-        print("*** %s" % msg)
-        sys.exit(-1)
-    else:
+    #
+    # Start out with the tokens and compiled expressions from the token cache, if the source is in it.
+    #
+    def loadTokens(self, src, text):
+        directory = os.path.join(os.path.dirname(os.path.abspath(src.name)), TokenCache.CACHE_DIRNAME)
+        salt = "%s %s" % (self.altSyntax, TokenCache.codeFingerprint(tokenizerFiles()))
+        self.tokenCache = TokenCache.TokenCache(directory, salt)
+
+        state = self.tokenCache.load(os.path.basename(src.name), text)
+        if state is not None:
+            tokens, self.expressions = state
+            Expression.cache.seed(self.expressions, self.altSyntax)
+            self.lineTokens = {line: LineTokens(*t) for line, t in tokens}
+            self.tokenCacheHit = True
+
+        self.logVerbose("Token cache: %s" % ("hit" if self.tokenCacheHit else "miss"))
+
+    def saveTokens(self, src, text):
+        tokens = [(line, t.astuple()) for line, t in self.lineTokens.items()]
+        self.tokenCache.save(os.path.basename(src.name), text, (tokens, self.expressions))
+
+    def assembleFile(self, src):
+        lines = src.readlines()
+
+        self.sourceName = src.name
+        self.fileName = src.name
+        self.dependencies = [src.name]
+
+        if self.cacheTokens:
+            text = "".join(lines)
+            self.loadTokens(src, text)
+
+        self.importSymbols()
+
+        if self.incremental:
+            rootname, __ = os.path.splitext(src.name)
+            self.cacheFilename = rootname + ".asmcache"
+            # Different imported symbols mean a full build.
+            imports = tuple((name, sym.value, sym.valueBytes) for name, sym in self.symbols.items())
+            config = (self.altSyntax, imports)
+            cache = BuildCache.load(self.cacheFilename, config) or BuildCache(config)
+            newCache = BuildCache(config)
+
+        if self.onePass:
+            self.deferredCode = []
+            if self.listing is not None:
+                self.listing.hold()
+
+        if self.objectMode:
+            # Everything up to the first ORG is relocatable.
+            self.sections = [ObjectFile.Section(0, True)]
+            self.sectionIndex = 0
+
+        self.notePhase(PHASE_PASS1, True)
+        if self.incremental:
+            processed, lineMatches = self.incrementalFirstPass(lines, cache, newCache)
+        else:
+            self.firstPass(lines)
+        self.notePhase(PHASE_PASS1, False)
+        if self.macroDef is not None:
+            self.lineNumber = self.macroDef.lineNumber
+            self.bailout("Line: %d  Macro '%s' has no ENDM" % (self.lineNumber, self.macroDef.name))
+        self.logVerbose("Last address used: 0x%04X" % (self.address - 1))
+
+        if self.sizeLimit:
+            if self.address >= self.sizeLimit + self.programBase:
+                self.bailout("Program too large by %d bytes" % ((self.address - (self.sizeLimit + self.programBase))))
+
+        if not self.objectMode:
+            # An object file's symbols can depend on other modules, the linker resolves them.
+            self.notePhase(PHASE_RESOLVE, True)
+            self.resolveSymbols()
+            self.notePhase(PHASE_RESOLVE, False)
+        # if verbose > 1:
+        #     dumpSymbols()
+
+        self.notePhase(PHASE_PASS2, True)
+        if self.objectMode:
+            self.flushDeferred()
+        elif self.onePass:
+            self.applyFixups()
+            self.flushDeferred()
+        elif self.incremental:
+            encoded = self.incrementalSecondPass(cache, lineMatches, newCache)
+            newCache.records = self.lineRecords
+            newCache.save(self.cacheFilename)
+            self.reprocessed = len(processed | encoded)
+            self.logVerbose("Incremental build: %d of %d lines reprocessed" % (self.reprocessed, len(self.sourceLines)))
+        else:
+            self.secondPass()
+        self.notePhase(PHASE_PASS2, False)
+        self.fileName = self.sourceName
+
+        if self.cacheTokens and not self.tokenCacheHit:
+            self.saveTokens(src, text)
+
+        self.logVerbose("Expression cache: %s" % Expression.cache)
+
+    # ----------------------------------------------------------------
+    #
+    # ----------------------------------------------------------------
+
+    def process(self, src):
+        rootname, __ = os.path.splitext(src.name)
+
+        if self.displayFlag is True:
+            self.listingDest = sys.stdout
+            if not self.objectMode:
+                self.outputDests = [(OutputFormats.formats[name], sys.stdout) for name in self.formats]
+        else:
+            outputs = []
+            if self.writeListing:
+                listingFilename = rootname + ".lst"
+                self.listingDest = open(listingFilename, 'w')
+                outputs.append(listingFilename)
+            for name in () if self.objectMode else self.formats:
+                fmt = OutputFormats.formats[name]
+                filename = rootname + fmt.extension
+                self.outputDests.append((fmt, open(filename, 'wb' if fmt.binary else 'w')))
+                outputs.append(filename)
+
+        if self.writeListing:
+            # On the terminal, the listing is kept in step with the other output.
+            self.listing = ListingWriter.ListingWriter(self.listingDest, batchSize=1 if self.displayFlag else 4096)
+
+        try:
+            self.assembleFile(src)
+
+            src.close()
+
+            self.notePhase(PHASE_OUTPUT, True)
+            if self.listing is not None:
+                self.notePhase(STEP_LISTING, True)
+                self.listing.flush()
+                self.notePhase(STEP_LISTING, False)
+
+            self.notePhase(STEP_IMAGE, True)
+            if self.objectMode:
+                if self.displayFlag:
+                    self.writeObjectFile(sys.stdout)
+                else:
+                    with open(rootname + ".obj", 'w') as f:
+                        self.writeObjectFile(f)
+                    outputs.append(rootname + ".obj")
+            else:
+                self.writeOutputs()
+            self.notePhase(STEP_IMAGE, False)
+
+            if self.listing is not None:
+                self.notePhase(STEP_SYMBOLS, True)
+                self.dumpSymbols()
+                self.notePhase(STEP_SYMBOLS, False)
+
+            if self.exportSymbols and self.displayFlag is False:
+                self.writeSymbolFile(rootname + ".sym")
+                outputs.append(rootname + ".sym")
+
+            if self.writeDeps and self.displayFlag is False:
+                self.writeDependencies(rootname + ".d", outputs)
+            self.notePhase(PHASE_OUTPUT, False)
+        finally:
+            if self.listing is not None:
+                self.listing.finish()
+            if self.displayFlag is False:
+                if self.listingDest is not None:
+                    self.listingDest.close()
+                for __, dest in self.outputDests:
+                    dest.close()
+
+    #
+    # Write a make dependency file, saying the output files depend on the source and everything it
+    # included. Each included file also gets an empty rule, so make doesn't stop if one is removed.
+    #
+    def writeDependencies(self, filename, targets):
+        def escape(name):
+            return name.replace(" ", "\\ ")
+
+        with open(filename, 'w') as f:
+            f.write("%s: %s\n" % (" ".join(map(escape, targets)), " ".join(map(escape, self.dependencies))))
+            for dep in self.dependencies[1:]:
+                f.write("\n%s:\n" % escape(dep))
+
+    #
+    # Write the module as an object file: its sections, the symbols it defines, and the fixups the
+    # linker has to apply.
+    #
+    def writeObjectFile(self, dest):
+        module = ObjectFile.ObjectModule(os.path.basename(self.sourceName))
+
+        # Sections with no code are left out, and the rest renumbered.
+        numbers = {}
+        for i, section in enumerate(self.sections):
+            if section.blocks:
+                numbers[i] = len(module.sections)
+                module.sections.append(section)
+
+        for name, sym in self.symbols.items():
+            if sym.kind == SYMBOL_IMPORTED:
+                continue
+            section = self.sections[self.symbolSections[name]]
+            if sym.kind == SYMBOL_LABEL:
+                # A label in an empty section is kept with the section's origin.
+                if self.symbolSections[name] not in numbers:
+                    module.equates.append((name, sym.value, sym.ebytes, sym.lineNumber))
+                else:
+                    module.labels.append((name, numbers[self.symbolSections[name]], sym.value - section.origin, sym.lineNumber))
+            elif self.isAbsoluteSymbol(name):
+                module.equates.append((name, sym.value, sym.ebytes, sym.lineNumber))
+            else:
+                if usesHere(sym.body):
+                    self.lineNumber = sym.lineNumber
+                    self.bailout("Line: %d  Equate '%s' uses '$' in a relocatable section, use a label instead" % (sym.lineNumber, name))
+                module.expressions.append((name, sym.body, sym.lineNumber))
+
+        for fixup in self.fixups:
+            section = self.sections[fixup.section]
+            module.fixups.append((fixup.kind, fixup.param, fixup.body, numbers[fixup.section],
+                                  fixup.address - section.origin, fixup.width, fixup.origin - section.origin, fixup.lineNumber))
+
+        ObjectFile.writeObject(dest, module)
+
+    def writeOutputs(self):
+        segments = self.image.segments()
+        for fmt, dest in self.outputDests:
+            fmt.writer(dest, segments, self.programBase)
+
+    # ----------------------------------------------------------------
+    #
+    # ----------------------------------------------------------------
+
+    # The counters for the --profile report.
+    def counters(self):
+        if self.objectMode:
+            emitted = sum(len(data) for section in self.sections for __, data in section.blocks)
+        else:
+            emitted = len(self.image)
+        return {
+            "lines": len(self.sourceLines),
+            "chunks": self.chunkCount,
+            "calcExpression": self.calcCount,
+            "resolverWalks": self.resolveStats["walks"] if self.resolveStats is not None else 0,
+            "bytesEmitted": emitted,
+            "listingLines": self.listing.linesWritten if self.listing is not None else 0
+        }
+
+    # Tell the phaseHook that a phase is starting, or has ended.
+    def notePhase(self, name, starting):
+        if self.phaseHook is not None:
+            self.phaseHook(name, starting)
+
+    def logVerbose(self, msg):
+        if self.verbose > 0:
+            print(msg)
+
+    def logWarning(self, msg):
+        if self.passNumber == 2:
+            if self.fileName != self.sourceName:
+                print("WARN: File: %s  Line %d: %s" % (self.fileName, self.lineNumber, msg))
+            else:
+                print("WARN: Line %d: %s" % (self.lineNumber, msg))
+
+    def bailout(self, msg):
+        if self.fileName != self.sourceName:
+            msg = "File: %s  %s" % (self.fileName, msg)
         raise Error(msg)
 
 
+#  kind : function to produce the bytes for a fixup, given the fixup's param and body.
+#  These are the same functions used to assemble the operand on pass 2.
+fixupEncoders = {
+    "dc": Assembler.dcOperand,
+    "load": Assembler.loadOperand,
+    "reg": Assembler.registerOperand,
+    "regn": Assembler.loadNOperand,
+    "imm": Assembler.immediateOperand,
+    "sbranch": Assembler.shortBranchOperand,
+    "lbranch": Assembler.longBranchOperand
+}
+
+
+#  mnemonic : [opcode], [func]
+#  opcode may be a base opcode used by the func (e.g. DEC)
+#  if no func, opcode used as-is
+opTable = {
+    "IDLE": (0x00, None),
+    "LDN": (0x00, Assembler.assembleLoadN),
+    "INC": (0x10, Assembler.assembleRegOp),
+    "DEC": (0x20, Assembler.assembleRegOp),
+
+    "BR": (0x30, Assembler.assembleShortBranch),
+    "BQ": (0x31, Assembler.assembleShortBranch),
+    "BZ": (0x32, Assembler.assembleShortBranch),
+    "BDF": (0x33, Assembler.assembleShortBranch),
+    "BPZ": (0x33, Assembler.assembleShortBranch),
+    "BGE": (0x33, Assembler.assembleShortBranch),
+    "B1": (0x34, Assembler.assembleShortBranch),
+    "B2": (0x35, Assembler.assembleShortBranch),
+    "B3": (0x36, Assembler.assembleShortBranch),
+    "B4": (0x37, Assembler.assembleShortBranch),
+    "NBR": (0x38, None),
+    "SKP": (0x38, None),
+    "BNQ": (0x39, Assembler.assembleShortBranch),
+    "BNZ": (0x3A, Assembler.assembleShortBranch),
+    "BNF": (0x3B, Assembler.assembleShortBranch),
+    "BM": (0x3B, Assembler.assembleShortBranch),
+    "BL": (0x3B, Assembler.assembleShortBranch),
+    "BN1": (0x3C, Assembler.assembleShortBranch),
+    "BN2": (0x3D, Assembler.assembleShortBranch),
+    "BN3": (0x3E, Assembler.assembleShortBranch),
+    "BN4": (0x3F, Assembler.assembleShortBranch),
+
+    "LDA": (0x40, Assembler.assembleRegOp),
+
+    "STR": (0x50, Assembler.assembleRegOp),
+
+    "IRX": (0x60, None),
+
+    "OUT": (0x60, Assembler.assembleInputOutput),    # 61 - 67
+    # 68 Reserved
+    "INP": (0x68, Assembler.assembleInputOutput),    # 69 - 6F
+
+    "RET": (0x70, None),
+    "DIS": (0x71, None),
+    "LDXA": (0x72, None),
+    "STXD": (0x73, None),
+    "ADC": (0x74, None),
+    "SDB": (0x75, None),
+    "SHRC": (0x76, None),
+    "RSHR": (0x76, None),
+    "SMB": (0x77, None),
+    "SAV": (0x78, None),
+    "MARK": (0x79, None),
+    "REQ": (0x7A, None),
+    "SEQ": (0x7B, None),
+    "ADCI": (0x7C, Assembler.assembleImmediate),
+    "SDBI": (0x7D, Assembler.assembleImmediate),
+    "SHLC": (0x7E, None),
+    "RSHL": (0x7E, None),
+    "SMBI": (0x7F, Assembler.assembleImmediate),
+
+    "GLO": (0x80, Assembler.assembleRegOp),
+    "GHI": (0x90, Assembler.assembleRegOp),
+
+    "PLO": (0xA0, Assembler.assembleRegOp),
+    "PHI": (0xB0, Assembler.assembleRegOp),
+
+    "LBR": (0xC0, Assembler.assembleLongBranch),
+    "LBQ": (0xC1, Assembler.assembleLongBranch),
+    "LBZ": (0xC2, Assembler.assembleLongBranch),
+    "LBDF": (0xC3, Assembler.assembleLongBranch),
+    "NOP": (0xC4, None),
+    "LSNQ": (0xC5, None),
+    "LSNZ": (0xC6, None),
+    "LSNF": (0xC7, None),
+    "LSKP": (0xC8, None),
+    "NLBR": (0xC8, None),
+    "LBNQ": (0xC9, Assembler.assembleLongBranch),
+    "LBNZ": (0xCA, Assembler.assembleLongBranch),
+    "LBNF": (0xCB, Assembler.assembleLongBranch),
+    "LSIE": (0xCC, None),
+    "LSQ": (0xCD, None),
+    "LSZ": (0xCE, None),
+    "LSDF": (0xCF, None),
+
+    "SEP": (0xD0, Assembler.assembleRegOp),
+
+    "SEX": (0xE0, Assembler.assembleRegOp),
+
+    "LDX": (0xF0, None),
+    "OR": (0xF1, None),
+    "AND": (0xF2, None),
+    "XOR": (0xF3, None),
+    "ADD": (0xF4, None),
+    "SD": (0xF5, None),
+    "SHR": (0xF6, None),
+    "SM": (0xF7, None),
+    "LDI": (0xF8, Assembler.assembleImmediate),
+    "ORI": (0xF9, Assembler.assembleImmediate),
+    "ANI": (0xFA, Assembler.assembleImmediate),
+    "XRI": (0xFB, Assembler.assembleImmediate),
+    "ADI": (0xFC, Assembler.assembleImmediate),
+    "SDI": (0xFD, Assembler.assembleImmediate),
+    "SHL": (0xFE, None),
+    "SMI": (0xFF, Assembler.assembleImmediate)
+}
+
+
+def instructionHandler(mnemonic):
+    return lambda asm, operand: asm.assembleInstruction(mnemonic, operand)
+
+
+#
+# Build the table of statements, keyed by their first word.
+#
+def buildStatementTable(dcName):
+    table = {}
+    for mnemonic in opTable:
+        table[mnemonic] = Statement(STMT_INSTRUCTION, instructionHandler(mnemonic), argsAny)
+
+    table[dcName] = Statement(STMT_PSEUDO, Assembler.assembleDC, argsRequired)
+    table["LOAD"] = Statement(STMT_PSEUDO, Assembler.assembleLOAD, argsRequired)
+
+    table["IF"] = Statement(STMT_CONDITIONAL, Assembler.processIf, argsRequired)
+    table["ELSE"] = Statement(STMT_CONDITIONAL, lambda asm, operand: asm.processElse(), argsNone)
+    table["ENDI"] = Statement(STMT_CONDITIONAL, lambda asm, operand: asm.processEndif(), argsNone)
+
+    table["ORG"] = Statement(STMT_DIRECTIVE, Assembler.processOrigin, argsRequired)
+    table["INCLUDE"] = Statement(STMT_DIRECTIVE, Assembler.processInclude, argsRequired)
+    table["PAGE"] = Statement(STMT_DIRECTIVE, lambda asm, operand: asm.processPage(), argsAny)
+    # TODO: Should END ignore everything after this line?
+    table["END"] = Statement(STMT_DIRECTIVE, lambda asm, operand: asm.emitNoCode(), argsAny)
+    table["MACRO"] = Statement(STMT_DIRECTIVE, lambda asm, operand: asm.processMacroDirective("MACRO"), argsAny)
+    table["ENDM"] = Statement(STMT_DIRECTIVE, lambda asm, operand: asm.processMacroDirective("ENDM"), argsAny)
+    return table
+
+
+# Statement tables for the standard and alternate syntax, keyed by altSyntax.
+statementTables = {
+    False: buildStatementTable("DC"),
+    True: buildStatementTable("DB")
+}
+
+
 def auto_int(x):
     """Simple helper to allow parsing arguments in bases other than 10."""
     return int(x, 0)
 
 
-def main(argv=None):
-    global verbose, sizeLimit, programBase, displayFlag, altSyntax
+def trace_list(x):
+    """Comma separated list of trace subsystems."""
+    names = [name.strip() for name in x.split(',')]
+    for name in names:
+        if name != "all" and name not in Trace.SUBSYSTEMS:
+            raise argparse.ArgumentTypeError("unknown subsystem '%s' (choose from all, %s)" % (name, ", ".join(Trace.SUBSYSTEMS)))
+    return names
 
+
+def format_list(x):
+    """Comma separated list of output formats."""
+    names = [name.strip() for name in x.split(',')]
+    for name in names:
+        if name not in OutputFormats.formats:
+            raise argparse.ArgumentTypeError("unknown format '%s' (choose from %s)" % (name, ", ".join(OutputFormats.formats)))
+    return names
+
+
+def buildArgParser(parserClass=argparse.ArgumentParser):
     description = """Assemble 1802 source"""
 
-    parser = argparse.ArgumentParser(description=description)
+    parser = parserClass(description=description)
 
     parser.set_defaults(verbose=1)
 
@@ -1363,6 +2519,44 @@ def main(argv=None):
                         action="store", type=auto_int, dest="base", default=0,
                         help="Base offset of the program image. Default is 0x0000. (optional)")
 
+    parser.add_argument("-1", "--onepass",
+                        action="store_true", dest="onePass", default=False,
+                        help="Assemble in a single pass, patching forward references once the symbols are known.")
+
+    parser.add_argument("-i", "--incremental",
+                        action="store_true", dest="incremental", default=False,
+                        help="Keep a cache of the build next to the source, and only reprocess the lines that changed since the last one.")
+
+    parser.add_argument("--cache",
+                        action="store_true", dest="cacheTokens", default=False,
+                        help="Keep the tokenized source in an %s directory next to it, so an unchanged source builds faster." % TokenCache.CACHE_DIRNAME)
+
+    parser.add_argument("-M", "--deps",
+                        action="store_true", dest="writeDeps", default=False,
+                        help="Write a make dependency file (.d) listing the source and every file it includes.")
+
+    parser.add_argument("-f", "--format",
+                        action="store", type=format_list, dest="formats", default=list(OutputFormats.DEFAULT_FORMATS),
+                        metavar="FORMATS",
+                        help="Output formats for the program image, comma separated: %s (default is %s)" %
+                        (", ".join(OutputFormats.formats), ",".join(OutputFormats.DEFAULT_FORMATS)))
+
+    parser.add_argument("-c", "--object",
+                        action="store_true", dest="objectMode", default=False,
+                        help="Write a relocatable object file (.obj) for cosmaclink.py instead of the program image.")
+
+    parser.add_argument("-x", "--export-symbols",
+                        action="store_true", dest="exportSymbols", default=False,
+                        help="Write the program's symbols to a symbol file (.sym) for other programs to import.")
+
+    parser.add_argument("-I", "--import-symbols",
+                        action="append", dest="importFiles", default=[], metavar="FILE",
+                        help="Define the symbols from a symbol file before assembling. Can be given more than once.")
+
+    parser.add_argument("--no-listing",
+                        action="store_false", dest="writeListing", default=True,
+                        help="Don't produce the listing.")
+
     parser.add_argument("-d", "--display",
                         action="store_true", dest="display", default=False,
                         help="Display output on terminal. No files are produced.")
@@ -1381,29 +2575,129 @@ def main(argv=None):
 
     parser.add_argument("--noisy",
                         action="store_const", const=2, dest="verbose",
-                        help="noisy")
+                        help="noisy, traces every subsystem")
+
+    parser.add_argument("--profile",
+                        action="store_true", dest="profile", default=False,
+                        help="Print the wall clock and CPU time of each phase of the assembly, and counts of what it did.")
+
+    parser.add_argument("--profile-json",
+                        action="store", dest="profileJSON", default=None, metavar="FILE",
+                        help="Write the --profile report as JSON to a file (- for the terminal)")
+
+    parser.add_argument("--memory",
+                        action="store_true", dest="memory", default=False,
+                        help="Print the peak and retained memory of each phase of the assembly, and the lines that allocated the most. Slows the assembly down.")
+
+    parser.add_argument("-t", "--trace",
+                        action="store", type=trace_list, dest="trace", default=None, metavar="SUBSYSTEMS",
+                        help="Trace only the given subsystems, comma separated: tokenizer, evaluator, resolver, emitter (or all)")
+
+    parser.add_argument("--trace-file",
+                        action="store", dest="traceFile", default=None, metavar="FILE",
+                        help="Write the trace output to a file instead of the terminal")
 
     parser.add_argument("source",
-                        type=argparse.FileType('r'),
                         metavar="SOURCE-FILE")
 
-    options = parser.parse_args(argv)
+    return parser
+
 
-    verbose = options.verbose
-    sizeLimit = options.size
-    programBase = options.base
-    displayFlag = options.display
-    altSyntax = options.altSyntax
+#
+# Assemble the open source file with the parsed command line options.
+#
+# Returns 0 on success, -1 if the assembly failed.
+#
+def run(options, src):
+    hooks = []
+    profiler = None
+    if options.profile or options.profileJSON is not None:
+        profiler = Profile.Profiler()
+        hooks.append(profiler)
+    memoryProfiler = None
+    if options.memory:
+        memoryProfiler = Profile.MemoryProfiler()
+        hooks.append(memoryProfiler)
+
+    asm = Assembler(sizeLimit=options.size, programBase=options.base, altSyntax=options.altSyntax,
+                    onePass=options.onePass, verbose=options.verbose, displayFlag=options.display,
+                    incremental=options.incremental, cacheTokens=options.cacheTokens,
+                    writeDeps=options.writeDeps, writeListing=options.writeListing,
+                    formats=options.formats, exportSymbols=options.exportSymbols,
+                    importFiles=options.importFiles, objectMode=options.objectMode,
+                    phaseHook=Profile.chainHooks(hooks) if hooks else None)
+
+    if options.trace is not None:
+        asm.trace.enable(options.trace)
+    elif options.verbose > 1:
+        asm.trace.enable(["all"])
+
+    traceFile = None
+    if options.traceFile is not None:
+        traceFile = open(options.traceFile, 'w')
+        asm.trace.setOutput(traceFile)
+
+    asm.trace.tokenizer("%s", options)
+
+    if memoryProfiler is not None:
+        memoryProfiler.start()
+
+    try:
+        asm.process(src)
+    except Error as err:
+        print("*** %s" % err.message)
+        return -1
+    finally:
+        src.close()
+        if memoryProfiler is not None:
+            memoryProfiler.stop()
+        if traceFile is not None:
+            asm.trace.setOutput(None)
+            traceFile.close()
+
+    if profiler is not None:
+        counters = asm.counters()
+        if options.profile:
+            print(profiler.report(counters))
+        if options.profileJSON == "-":
+            profiler.writeJSON(sys.stdout, counters, memoryProfiler)
+        elif options.profileJSON is not None:
+            with open(options.profileJSON, 'w') as f:
+                profiler.writeJSON(f, counters, memoryProfiler)
+
+    # With the JSON on the terminal, the memory report is only in that.
+    if memoryProfiler is not None and options.profileJSON != "-":
+        print(memoryProfiler.report())
+
+    return 0
 
-    logDebug(options)
 
-    # Get the filename
-    if options.source is not None:
-        process(options.source)
-    else:
-        print("No file name given.")
-        print(main.__doc__)
-        sys.exit(1)
+#
+# Check the options that can't be used together, reporting the first one found with parser.error().
+# This is done for every assembly, from the command line or a cosmacbatch manifest.
+#
+def checkOptions(options, parser):
+    if options.incremental and options.onePass:
+        parser.error("--incremental can't be used with --onepass")
+
+    if options.objectMode and (options.incremental or options.exportSymbols):
+        parser.error("--object can't be used with --incremental or --export-symbols")
+
+    if options.display and "bin" in options.formats:
+        parser.error("the bin format can't be displayed")
+
+
+def main(argv=None):
+    parser = buildArgParser()
+    options = parser.parse_args(argv)
+    checkOptions(options, parser)
+
+    try:
+        src = open(options.source, 'r')
+    except OSError as err:
+        parser.error("argument SOURCE-FILE: can't open '%s': %s" % (options.source, err))
+
+    return run(options, src)
 
 
 if __name__ == '__main__':
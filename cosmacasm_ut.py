@@ -2,25 +2,34 @@
 #
 
 
+import sys
+
 import cosmacasm
 
 
 
-cosmacasm.verbose = 0	# 2 for noisy
+# All of the tests use one Assembler, with the symbols below, and the alternate syntax ones another.
+def buildAssembler( altSyntax ):
+	asm = cosmacasm.Assembler( verbose=0, altSyntax=altSyntax )	# verbose=2 for noisy
 
-cosmacasm.passNumber = 2	# For pass 1, some opcodes are not assembled, so we force pass 2 to allow testing the
-							# assembleChunk() function.
+	asm.addSymbolLabel( "A_BOOP", 32 )
+	asm.addSymbolLabel( "A_MICE", 0x1234 )
 
+	asm.addSymbolEquate( "E_CAT", "88" )
+	asm.addSymbolEquate( "PC", "8" )
+	asm.addSymbolEquate( "DP", "4" )
+	asm.resolveSymbols()
 
-failCount = 0
+	asm.passNumber = 2	# For pass 1, some opcodes are not assembled, so we force pass 2 to allow testing the
+						# assembleChunk() function.
+	return asm
 
 
+asm = buildAssembler( False )
+asmAlt = buildAssembler( True )
 
-cosmacasm.addSymbolAddress( "A_BOOP", 32 )
-cosmacasm.addSymbolAddress( "A_MICE", 0x1234 )
 
-symECat = cosmacasm.addSymbolEquate( "E_CAT", "88" )
-symPC = cosmacasm.addSymbolEquate( "PC", "8" )
+failCount = 0
 
 
 
@@ -30,20 +39,12 @@ print( "---- obtainTokenValue() ----")
 def testObtainTokenValue(tests):
 	global failCount
 	for test in tests:
-		what, v, ebytes = cosmacasm.obtainTokenValue( 0, test[0] )
-		# print( test[0], ":", what, v, ebytes )
-		if what != test[1]:
+		# Returns a tuple of ( value, bytes ), with None for the value if it could not be obtained.
+		v, ebytes = asm.obtainTokenValue( test[0] )
+		# print( test[0], ":", v, ebytes )
+		if v != test[2]:
 			failCount += 1
-			print( "Failed: Type for '%s'. Expected %s but got %s" % ( test[0], test[1], what ) )
-		else:
-			if what == "sym":
-				if v.value != test[2]:
-					failCount += 1
-					print( "Failed: Address for '%s'. Expected %d but got" % ( test[0], test[2] ), v )
-			else:
-				if v != test[2]:
-					failCount += 1
-					print( "Failed: Value for '%s'. Expected %d but got %d" % ( test[0], test[2], v ) )
+			print( "Failed: Value for '%s' (%s). Expected %s but got %s" % ( test[0], test[1], test[2], v ) )
 
 
 
@@ -133,30 +134,20 @@ calcExpressionTestsAlt = [
 #	A.0(BEEP)
 
 
-def testCalcExpression( tests ):
+def testCalcExpression( asm, tests ):
 	global failCount
 	for test in tests:
-		# Returns a tuple of ( value, addrFlag, litFlag, bytes ). Will return None if a value could not be obtained.
-		v, aflag, lflag, ebytes = cosmacasm.calcExpression( 0, test[0] )
-		# print( v, aflag, lflag, ebytes )
-		if aflag != test[2]:
+		# Returns a tuple of ( value, bytes ). Will return None if a value could not be obtained.
+		# (The address and literal flags are no longer returned, so only the value is checked.)
+		v, ebytes = asm.calcExpression( 0, test[0] )
+		# print( v, ebytes )
+		if v != test[1]:
 			failCount += 1
-			print( "Failed: Address Flag for '%s'. Expected %d but got %d" % ( test[0], test[2], aflag ) )
-		else:
-			if lflag != test[3]:
-				failCount += 1
-				print( "Failed: Literal Flag for '%s'. Expected %d but got %d" % ( test[0], test[3], lflag ) )
-			else:
-				if v != test[1]:
-					failCount += 1
-					# print( "Failed: Type for '%s'. Expected %s but got %s" % ( test[0], test[1], what ) )
-					print( "Failed: Value for '%s'. Expected %d but got %d" % ( test[0], test[1], v ) )
+			print( "Failed: Value for '%s'. Expected %s but got %s" % ( test[0], test[1], v ) )
 
-testCalcExpression( calcExpressionTests )
+testCalcExpression( asm, calcExpressionTests )
 
-cosmacasm.altSyntax = True
-testCalcExpression( calcExpressionTestsAlt )
-cosmacasm.altSyntax = False
+testCalcExpression( asmAlt, calcExpressionTestsAlt )
 
 
 print( "---- Opcode Tests (should succeed) ----")
@@ -168,6 +159,7 @@ opcodeTests = [
 	( "SEX 3", b"\xE3" ),
 	( "SEX PC", b"\xE8" ),
 	( "SEX PC+2", b"\xEA" ),
+	( "GLO DP", b"\x84" ),		# Not RD, the name only starts with a hex digit
 	( "LDI 74H", b"\xF8\x74" ),
 	( "LDN R2", b"\x02" )
 ]
@@ -176,7 +168,8 @@ opcodeTests = [
 for test in opcodeTests:
 	tbytes = bytearray( test[1] )
 	try:
-		addr, abytes = cosmacasm.assembleChunk( test[0] )
+		asm.address = 0
+		addr, abytes = asm.assembleChunk( test[0] )
 	except cosmacasm.Error as err:
 		print( "*** caught an exception", err.message )
 		failCount += 1
@@ -196,7 +189,7 @@ print( "---- Opcode Tests (should fail) ----")
 
 
 try:
-	addr, abytes = cosmacasm.assembleChunk( "LDN R0" )
+	addr, abytes = asm.assembleChunk( "LDN R0" )
 except cosmacasm.Error as err:
 	# This should thrown an exception since R0 cxannot be used for LDN
 	pass
@@ -206,7 +199,7 @@ else:
 
 
 try:
-	addr, abytes = cosmacasm.assembleChunk( "SEX PC+8" )
+	addr, abytes = asm.assembleChunk( "SEX PC+8" )
 except cosmacasm.Error as err:
 	# This should thrown an exception since R0 cxannot be used for LDN
 	pass
@@ -215,21 +208,44 @@ else:
 	failCount += 1
 
 
+print( "---- Expression Tests (should fail) ----")
+
+missingArgumentTests = [
+	( asm, "A.1" ),
+	( asm, "E_CAT A.0" ),
+	( asmAlt, "HIGH" )
+]
+
+for test in missingArgumentTests:
+	try:
+		v, ebytes = test[0].calcExpression( 0, test[1] )
+	except cosmacasm.Error as err:
+		# An address byte operator with nothing after it is an error, not an unresolved value
+		if "Missing argument" not in err.message:
+			print( "Failed: '%s' gave the wrong error '%s'" % ( test[1], err.message ) )
+			failCount += 1
+	else:
+		print( "Failed: '%s' should have thrown an exception, got %s" % ( test[1], v ) )
+		failCount += 1
+
+
 
 
 
 print( "\nFailures: %d" % failCount)
 
+sys.exit( 1 if failCount else 0 )
+
 
-# Returns a tuple of ( sym/hex/dec, value, bytes ). Will return None if a value could not be obtained.
-# a, b, c = cosmacasm.obtainTokenValue( 0, "55" )
-# print( a, b, c )
+# Returns a tuple of ( value, bytes ). Will return None if a value could not be obtained.
+# a, b = asm.obtainTokenValue( "55" )
+# print( a, b )
 #
-# a, b, c = cosmacasm.obtainTokenValue( 0, "055H" )
-# print( a, b, c )
+# a, b = asm.obtainTokenValue( "055H" )
+# print( a, b )
 #
-# a, b, c = cosmacasm.obtainTokenValue( 0, "055AAH" )
-# print( a, b, c )
+# a, b = asm.obtainTokenValue( "055AAH" )
+# print( a, b )
 #
-# a, b, c = cosmacasm.obtainTokenValue( 0, "BEEP" )
-# print( a, b, c )
+# a, b = asm.obtainTokenValue( "BEEP" )
+# print( a, b )
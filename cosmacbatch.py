@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+#
+# 1802 Batch Assembler
+#
+# Assemble many sources in one invocation, spread across a pool of worker processes.
+#
+# ------------------------------------------
+#
+# The sources can be given on the command line, where they are assembled with the default
+# options, and/or listed in a manifest file. Each line of a manifest is a cosmacasm.py command
+# line (options and source file), so every source keeps its own base, size, syntax, etc.
+#
+#   # ROM variants
+#   --base 0x8000 --size 0x2000 rom/monitor.src
+#   --altsyntax rom/basic.src
+#   test/test.src
+#
+# Blank lines and lines starting with # are ignored. Relative source paths are taken relative
+# to the directory holding the manifest.
+#
+# The output files are exactly what a single cosmacasm.py run on the same line would produce.
+# At the end a summary of each file's status and time is printed.
+#
+
+
+import os
+import sys
+import argparse
+import shlex
+import time
+import io
+import contextlib
+import concurrent.futures
+
+import cosmacasm
+
+
+class Job:
+    """
+    One source to assemble.
+
+    options - parsed cosmacasm command line options
+    origin - where the job came from, for error messages
+    status - "ok", "FAILED" or "CRASHED" once run
+    seconds - time taken by the assembly
+    output - everything the assembly printed
+    """
+
+    def __init__(self, options, origin):
+        self.options = options
+        self.origin = origin
+        self.status = None
+        self.seconds = 0.0
+        self.output = ""
+
+
+class ManifestError(Exception):
+    pass
+
+
+#
+# Returns the list of Jobs for a manifest file.
+#
+def readManifest(filename, parser):
+    jobs = []
+    baseDir = os.path.dirname(filename)
+
+    with open(filename, 'r') as f:
+        for lineNumber, line in enumerate(f, 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+
+            origin = "%s:%d" % (filename, lineNumber)
+            try:
+                argv = shlex.split(line)
+                options = parser.parse_args(argv)
+                cosmacasm.checkOptions(options, parser)
+            except (ValueError, cosmacasm.Error) as err:
+                raise ManifestError("%s  %s" % (origin, err))
+
+            options.source = os.path.join(baseDir, options.source)
+            options.importFiles = [os.path.join(baseDir, name) for name in options.importFiles]
+            if options.traceFile is not None:
+                options.traceFile = os.path.join(baseDir, options.traceFile)
+            if options.profileJSON is not None and options.profileJSON != "-":
+                options.profileJSON = os.path.join(baseDir, options.profileJSON)
+            jobs.append(Job(options, origin))
+
+    return jobs
+
+
+#
+# Assemble one source. This is run in the worker processes.
+#
+# Returns a tuple of ( status, seconds, output ).
+#
+def assembleJob(options):
+    startTime = time.perf_counter()
+    output = io.StringIO()
+
+    with contextlib.redirect_stdout(output):
+        try:
+            src = open(options.source, 'r')
+            result = cosmacasm.run(options, src)
+            status = "ok" if result == 0 else "FAILED"
+        except OSError as err:
+            print("*** Unable to open '%s': %s" % (options.source, err.strerror))
+            status = "FAILED"
+        except Exception as err:
+            print("*** %s: %s" % (type(err).__name__, err))
+            status = "CRASHED"
+
+    return (status, time.perf_counter() - startTime, output.getvalue())
+
+
+#
+# Run all of the jobs, in a pool of 'workers' processes.
+#
+def assembleAll(jobs, workers):
+    if workers == 1:
+        for job in jobs:
+            job.status, job.seconds, job.output = assembleJob(job.options)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(assembleJob, job.options): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            job.status, job.seconds, job.output = future.result()
+
+
+def printSummary(jobs, elapsed, workers, quiet):
+    failed = [job for job in jobs if job.status != "ok"]
+
+    if not quiet or failed:
+        print("%-8s %8s  %s" % ("Status", "Seconds", "Source"))
+        for job in jobs:
+            if quiet and job.status == "ok":
+                continue
+            print("%-8s %8.3f  %s" % (job.status, job.seconds, job.options.source))
+            if job.status != "ok":
+                for line in job.output.splitlines():
+                    if line.startswith("***") or line.startswith("WARN"):
+                        print("                   %s" % line)
+
+    if not quiet:
+        print("%d files, %d ok, %d failed, %.3f s elapsed (%.3f s assembling, %d workers)" %
+              (len(jobs), len(jobs) - len(failed), len(failed), elapsed, sum(job.seconds for job in jobs), workers))
+
+
+class _ManifestArgParser(argparse.ArgumentParser):
+    """The cosmacasm argument parser, raising errors instead of exiting."""
+
+    def error(self, message):
+        raise cosmacasm.Error(message)
+
+
+def main(argv=None):
+    description = """Assemble many 1802 sources at once, in parallel.
+    Sources named on the command line use the default options, the lines of a manifest
+    file each give the cosmacasm.py options and source file for one assembly."""
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument("-m", "--manifest",
+                        action="append", dest="manifests", default=[], metavar="FILE",
+                        help="Manifest file, one cosmacasm.py command line per line. May be repeated.")
+
+    parser.add_argument("-j", "--jobs",
+                        action="store", type=int, dest="jobs", default=os.cpu_count() or 1,
+                        help="Number of worker processes. (default is the number of CPUs)")
+
+    parser.add_argument("-q", "--quiet",
+                        action="store_true", dest="quiet", default=False,
+                        help="Only report the files that failed")
+
+    parser.add_argument("sources", nargs="*",
+                        metavar="SOURCE-FILE")
+
+    options = parser.parse_args(argv)
+
+    asmParser = cosmacasm.buildArgParser(_ManifestArgParser)
+
+    jobs = []
+    try:
+        for source in options.sources:
+            jobs.append(Job(asmParser.parse_args(["--quiet", source]), source))
+        for manifest in options.manifests:
+            jobs.extend(readManifest(manifest, asmParser))
+    except OSError as err:
+        print("*** Unable to read manifest '%s': %s" % (err.filename, err.strerror))
+        return -1
+    except ManifestError as err:
+        print("*** %s" % err)
+        return -1
+
+    if len(jobs) == 0:
+        parser.error("no sources given")
+
+    # Two jobs for the same source would write over each other's output files.
+    roots = {}
+    for job in jobs:
+        root, __ = os.path.splitext(os.path.abspath(job.options.source))
+        if root in roots:
+            print("*** %s  output files would overwrite those of %s" % (job.origin, roots[root]))
+            return -1
+        roots[root] = job.origin
+
+    workers = max(1, min(options.jobs, len(jobs)))
+
+    startTime = time.perf_counter()
+    assembleAll(jobs, workers)
+    printSummary(jobs, time.perf_counter() - startTime, workers, options.quiet)
+
+    if any(job.status != "ok" for job in jobs):
+        return -1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+#
+# 1802 Linker
+#
+# Link object files written by cosmacasm.py --object into a program image.
+#
+# ------------------------------------------
+#
+# Each module of a program is assembled on its own into an object file, so a change to one module
+# only means assembling that one again and linking:
+#
+#   cosmacasm.py --object main.src
+#   cosmacasm.py --object forth.src
+#   cosmaclink.py -o rom main.obj forth.obj        (writes rom.hex and rom.ihex)
+#
+# The absolute sections (code after an ORG) stay where they are. The relocatable sections are
+# placed one after another, in the order the object files are given, starting at the --origin
+# address and skipping over anything already there. A section that uses PAGE starts on a page.
+#
+# Every symbol of every module can be used by the others, so a name can only be defined once.
+# The fixups are then encoded with the assembler's own operand functions, which also checks that
+# each short branch is still on the same page as its target.
+#
+
+import os
+import sys
+import argparse
+
+import cosmacasm
+import ObjectFile
+import OutputFormats
+import SymbolFile
+
+
+class Linker:
+    """
+    Links a set of object modules.
+
+    modules - ( filename, ObjectModule ) for each object file, in the order given
+    origin - the address the relocatable sections are placed from
+    asm - the Assembler used to resolve the symbols, encode the fixups and hold the image
+    definedIn - the filename of the module each symbol was defined in, keyed by name
+    labels - names of the symbols that are labels
+    """
+
+    def __init__(self, modules, origin=0, programBase=0, verbose=1):
+        self.modules = modules
+        self.origin = origin
+        self.verbose = verbose
+        self.asm = cosmacasm.Assembler(programBase=programBase, verbose=verbose, displayFlag=True, writeListing=False)
+        self.asm.passNumber = 2     # Everything is evaluated as it is on the second pass
+        self.definedIn = {}
+        self.labels = set()
+
+    def __repr__(self):
+        return "%d modules from 0x%04X" % (len(self.modules), self.origin)
+
+    def link(self):
+        self.placeSections()
+        self.defineSymbols()
+        self.asm.resolveSymbols()
+        self.applyFixups()
+        self.buildImage()
+
+    #
+    # Give each relocatable section its origin. Absolute sections are placed first, then each
+    # relocatable one goes at the first address after the last that it fits at.
+    #
+    def placeSections(self):
+        used = []
+        for filename, module in self.modules:
+            for section in module.sections:
+                if not section.relocatable:
+                    used.append((section.origin, section.origin + section.size()))
+
+        address = self.origin
+        for filename, module in self.modules:
+            for i, section in enumerate(module.sections):
+                if section.relocatable:
+                    address = self.findSpace(address, section.size(), section.align, used)
+                    section.origin = address
+                    used.append((address, address + section.size()))
+                    address += section.size()
+
+                self.logVerbose("%-24s section %d at 0x%04X, %d bytes%s" %
+                                (filename, i, section.origin, section.size(), "" if section.relocatable else " (absolute)"))
+
+    # Returns the first address from start, on a multiple of align, with room for size bytes.
+    def findSpace(self, start, size, align, used):
+        address = start
+        while True:
+            address = (address + align - 1) // align * align
+            clash = [end for begin, end in used if begin < address + size and address < end]
+            if not clash:
+                break
+            address = max(clash)
+
+        if address + size > 0x10000:
+            self.bailout("No room for a %d byte section" % size)
+        return address
+
+    #
+    # Put every module's symbols into the one symbol table. Labels and equates with known values
+    # go in as they are, the equates that depend on other modules are resolved afterwards.
+    #
+    def defineSymbols(self):
+        asm = self.asm
+        for filename, module in self.modules:
+            asm.fileName = filename
+
+            def define(name, sym):
+                if name in self.definedIn:
+                    self.bailout("Symbol '%s' is defined in both %s and %s" % (name, self.definedIn[name], filename))
+                asm.symbols[name] = sym
+                self.definedIn[name] = filename
+
+            for name, section, offset, lineNumber in module.labels:
+                value = module.sections[section].origin + offset
+                define(name, cosmacasm.Symbol.imported(name, value, value.to_bytes(2, 'big')))
+                self.labels.add(name)
+
+            for name, value, valueBytes, lineNumber in module.equates:
+                define(name, cosmacasm.Symbol.imported(name, value, valueBytes))
+
+            for name, body, lineNumber in module.expressions:
+                asm.lineNumber = lineNumber
+                define(name, cosmacasm.Symbol(asm, name, body=body))
+        asm.fileName = None
+
+    #
+    # Encode the operands of every fixup, now that the sections have their places and the symbols
+    # their values, and patch them into the code.
+    #
+    def applyFixups(self):
+        asm = self.asm
+        count = 0
+        for filename, module in self.modules:
+            asm.fileName = filename
+            for kind, param, body, section, offset, width, originOffset, lineNumber in module.fixups:
+                target = module.sections[section]
+                for name in asm.compileExpression(body).symbols():
+                    if name not in asm.symbols:
+                        asm.lineNumber = lineNumber
+                        self.bailout("Line: %d   Undefined symbol '%s'" % (lineNumber, name))
+
+                fixup = cosmacasm.Fixup(kind, param, body, target.origin + offset, width, target.origin + originOffset, lineNumber)
+                for blockOffset, data in target.blocks:
+                    if blockOffset <= offset < blockOffset + len(data):
+                        fixup.target = data
+                        fixup.offset = offset - blockOffset
+                        break
+                else:
+                    self.bailout("Line: %d   Fixup for '%s' is outside of the code" % (lineNumber, body))
+
+                asm.applyFixup(fixup)
+                count += 1
+        asm.fileName = None
+        self.logVerbose("Applied %d fixups" % count)
+
+    def buildImage(self):
+        asm = self.asm
+        for filename, module in self.modules:
+            asm.fileName = filename
+            for section in module.sections:
+                for offset, data in section.blocks:
+                    asm.addToImage(section.origin + offset, data)
+        asm.fileName = None
+
+    # The end of the image, one past the highest address used.
+    def endAddress(self):
+        segments = self.asm.image.segments()
+        if not segments:
+            return self.asm.programBase
+        address, data = segments[-1]
+        return address + len(data)
+
+    def writeOutputs(self, rootname, formats):
+        segments = self.asm.image.segments()
+        for name in formats:
+            fmt = OutputFormats.formats[name]
+            with open(rootname + fmt.extension, 'wb' if fmt.binary else 'w') as dest:
+                fmt.writer(dest, segments, self.asm.programBase)
+
+    # Write all of the symbols, with their final values, to a symbol file.
+    def writeSymbolFile(self, filename):
+        records = []
+        for name, sym in self.asm.symbols.items():
+            if name in self.labels:
+                records.append((name, SymbolFile.LABEL, sym.value, None))
+            else:
+                records.append((name, SymbolFile.EQUATE, sym.value, sym.ebytes))
+
+        with open(filename, 'w') as f:
+            SymbolFile.writeSymbols(f, records, os.path.basename(filename))
+
+    def logVerbose(self, msg):
+        if self.verbose > 0:
+            print(msg)
+
+    def bailout(self, msg):
+        self.asm.bailout(msg)
+
+
+def readModules(filenames):
+    modules = []
+    for filename in filenames:
+        try:
+            with open(filename) as f:
+                modules.append((filename, ObjectFile.readObject(f)))
+        except OSError as err:
+            raise cosmacasm.Error("Unable to read '%s': %s" % (filename, err.strerror))
+        except ObjectFile.ObjectFileError as err:
+            raise cosmacasm.Error("File: %s  %s" % (filename, err))
+    return modules
+
+
+def main(argv=None):
+    description = """Link 1802 object files written by cosmacasm.py --object into a program image."""
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument("-o", "--output",
+                        action="store", dest="output", default=None, metavar="NAME",
+                        help="Root name of the output files (default is the name of the first object file)")
+
+    parser.add_argument("-r", "--origin",
+                        action="store", type=cosmacasm.auto_int, dest="origin", default=0,
+                        help="Address the relocatable sections are placed from. Default is 0x0000.")
+
+    parser.add_argument("-b", "--base",
+                        action="store", type=cosmacasm.auto_int, dest="base", default=0,
+                        help="Base offset of the program image. Default is 0x0000. (optional)")
+
+    parser.add_argument("-s", "--size",
+                        action="store", type=cosmacasm.auto_int, dest="size",
+                        help="Maximum size of output. Error if this size is exceeded. (optional)")
+
+    parser.add_argument("-f", "--format",
+                        action="store", type=cosmacasm.format_list, dest="formats", default=list(OutputFormats.DEFAULT_FORMATS),
+                        metavar="FORMATS",
+                        help="Output formats for the program image, comma separated: %s (default is %s)" %
+                        (", ".join(OutputFormats.formats), ",".join(OutputFormats.DEFAULT_FORMATS)))
+
+    parser.add_argument("-x", "--export-symbols",
+                        action="store_true", dest="exportSymbols", default=False,
+                        help="Write the linked program's symbols to a symbol file (.sym).")
+
+    parser.add_argument("-q", "--quiet",
+                        action="store_const", const=0, dest="verbose", default=1,
+                        help="quiet")
+
+    parser.add_argument("objects", nargs="+",
+                        metavar="OBJECT-FILE")
+
+    options = parser.parse_args(argv)
+
+    rootname = options.output
+    if rootname is None:
+        rootname, __ = os.path.splitext(options.objects[0])
+
+    try:
+        linker = Linker(readModules(options.objects), origin=options.origin, programBase=options.base, verbose=options.verbose)
+        linker.link()
+
+        if options.size and linker.endAddress() > options.size + options.base:
+            linker.bailout("Program too large by %d bytes" % (linker.endAddress() - (options.size + options.base)))
+
+        linker.writeOutputs(rootname, options.formats)
+        if options.exportSymbols:
+            linker.writeSymbolFile(rootname + ".sym")
+    except cosmacasm.Error as err:
+        print("*** %s" % err.message)
+        return -1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
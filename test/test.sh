@@ -66,5 +66,164 @@ echo Testing Offset listing
 cmp offset.lst reference/offset.lst
 
 
+echo ========================================
+echo Compiling
+../cosmacasm.py --quiet macro.src
+
+echo ----------------------------------------
+echo Testing Macro hex
+cmp macro.hex reference/macro.hex
+
+echo ----------------------------------------
+echo Testing Macro listing
+cmp macro.lst reference/macro.lst
+
+
+echo ========================================
+echo Compiling
+../cosmacasm.py --quiet regs.src
+
+echo ----------------------------------------
+echo Testing Regs hex
+cmp regs.hex reference/regs.hex
+
+echo ----------------------------------------
+echo Testing Regs listing
+cmp regs.lst reference/regs.lst
+
+
+echo ========================================
+echo One-pass mode
+for f in test test_dc test_exp FIG_Forth offset macro regs
+do
+    echo Compiling $f
+    ../cosmacasm.py --quiet --onepass $f.src
+    cmp $f.hex reference/$f.hex
+    cmp $f.lst reference/$f.lst
+done
+
+
+echo ========================================
+echo Batch mode
+../cosmacbatch.py --quiet --jobs 2 --manifest batch.manifest
+for f in test test_dc test_exp FIG_Forth offset
+do
+    cmp $f.hex reference/$f.hex
+    cmp $f.lst reference/$f.lst
+done
+echo "--onepass --incremental test.src" > bad.manifest
+../cosmacbatch.py --quiet --manifest bad.manifest > bad.out && echo "*** Options that can't be used together were accepted in a manifest"
+grep -q "can't be used with --onepass" bad.out || echo "*** Wrong error for options that can't be used together in a manifest"
+rm -f bad.manifest bad.out
+echo "--profile-json regs.json --trace-file regs.trace ../regs.src" > link/paths.manifest
+../cosmacbatch.py --quiet --manifest link/paths.manifest
+test -f link/regs.json -a -f link/regs.trace || echo "*** Output paths in a manifest were not relative to its directory"
+rm -f link/paths.manifest link/regs.json link/regs.trace regs.json regs.trace
+
+
+echo ========================================
+echo Incremental mode
+for f in test test_dc test_exp FIG_Forth offset macro regs
+do
+    echo Compiling $f
+    rm -f $f.asmcache
+    ../cosmacasm.py --quiet --incremental $f.src
+    ../cosmacasm.py --quiet --incremental $f.src
+    cmp $f.hex reference/$f.hex
+    cmp $f.lst reference/$f.lst
+    rm -f $f.asmcache
+done
+
+
+echo ========================================
+echo Token cache
+rm -rf __asmcache__
+for f in test test_dc test_exp FIG_Forth offset macro regs
+do
+    echo Compiling $f
+    ../cosmacasm.py --quiet --cache $f.src
+    ../cosmacasm.py --quiet --cache $f.src
+    cmp $f.hex reference/$f.hex
+    cmp $f.lst reference/$f.lst
+done
+rm -rf __asmcache__
+
+
+echo ========================================
+echo Include
+rm -rf include
+mkdir include
+head -n 100 FIG_Forth.src > include/defs.inc
+sed -n '101,2000p' FIG_Forth.src > include/core.inc
+printf " INCLUDE 'words.inc'\n" >> include/core.inc
+sed -n '2001,$p' FIG_Forth.src > include/words.inc
+printf " INCLUDE defs.inc\n INCLUDE core.inc\n" > include/fig.src
+echo Compiling split FIG
+../cosmacasm.py --quiet --deps include/fig.src
+cmp include/fig.hex reference/FIG_Forth.hex
+printf "include/fig.lst include/fig.hex include/fig.ihex: include/fig.src include/defs.inc include/core.inc include/words.inc\n\ninclude/defs.inc:\n\ninclude/core.inc:\n\ninclude/words.inc:\n" | cmp - include/fig.d
+rm -rf include
+
+
+echo ========================================
+echo No listing
+rm -f FIG_Forth.hex
+../cosmacasm.py --quiet --no-listing FIG_Forth.src
+cmp FIG_Forth.hex reference/FIG_Forth.hex
+
+
+echo
+echo Output formats
+rm -f FIG_Forth.bin FIG_Forth.srec
+../cosmacasm.py --quiet --no-listing --format=bin,srec FIG_Forth.src
+python3 -c "import sys; sys.exit(open('FIG_Forth.bin', 'rb').read() != bytes.fromhex(open('reference/FIG_Forth.hex').read()))" || echo "*** Binary image differs"
+[ "$(head -1 FIG_Forth.srec) $(tail -1 FIG_Forth.srec)" = "S0030000FC S9030000FC" ] || echo "*** S-record file is wrong"
+rm -f FIG_Forth.bin FIG_Forth.srec
+
+
+echo
+echo Symbol files
+rm -f FIG_Forth.sym addon.hex addon.lst
+../cosmacasm.py --quiet --no-listing --export-symbols FIG_Forth.src
+cmp FIG_Forth.sym reference/FIG_Forth.sym
+../cosmacasm.py --quiet --base=0x2000 --import-symbols FIG_Forth.sym addon.src
+cmp addon.hex reference/addon.hex
+cmp addon.lst reference/addon.lst
+rm -f FIG_Forth.sym addon.hex addon.lst addon.ihex
+
+
+echo
+echo Linking
+rm -f link/*.obj link/linked.* link/all.*
+../cosmacasm.py --quiet --object link/main.src
+../cosmacasm.py --quiet --object link/regs.src
+../cosmacasm.py --quiet --object link/lib.src
+../cosmaclink.py --quiet -o link/linked link/main.obj link/regs.obj link/lib.obj
+cat link/main.src link/regs.src link/lib.src > link/all.src
+../cosmacasm.py --quiet link/all.src
+cmp link/linked.hex link/all.hex
+cmp link/linked.ihex link/all.ihex
+../cosmacasm.py --quiet --onepass link/all.src
+cmp link/linked.hex link/all.hex
+../cosmaclink.py --quiet --origin=0xE8 -o link/linked link/main.obj link/regs.obj link/lib.obj > link/linked.out && echo "*** Short branch across a page was not caught"
+grep -q "Branch out of range" link/linked.out || echo "*** Wrong error for a short branch across a page"
+rm -f link/*.obj link/*.lst link/linked.* link/all.*
+
+
+echo
+echo Profile
+rm -f FIG_Forth.prof
+../cosmacasm.py --quiet --no-listing --profile-json FIG_Forth.prof FIG_Forth.src
+python3 -c "import json, sys; p = json.load(open('FIG_Forth.prof')); c = p['counters']; sys.exit(c['lines'] != 4193 or c['bytesEmitted'] != 8025 or not {'pass1', 'resolve', 'pass2', 'output'} <= set(p['phases']))" || echo "*** Profile report is wrong"
+../cosmacasm.py --quiet --no-listing --memory --profile-json FIG_Forth.prof FIG_Forth.src > /dev/null
+python3 -c "import json, sys; m = json.load(open('FIG_Forth.prof'))['memory']; sys.exit(m['phases']['pass1']['peak'] <= 0 or not m['setup']['sites'][0]['site'].startswith('cosmacasm.py:'))" || echo "*** Memory report is wrong"
+rm -f FIG_Forth.prof
+
+
+echo
+echo Unit tests
+python3 ../cosmacasm_ut.py | grep -v -e "^----" -e "^$" -e "^Failures: 0$"
+
+
 echo
 echo Tests completed. If no warnings or errors above, then we passed!